@@ -1,8 +1,9 @@
 import argparse                               # Args
 import socket                                 # Networking
-import multiprocessing                        # Concurrency
+import multiprocessing, threading             # Concurrency
 import traceback, time, importlib             # Misc
-import ui_proc, cnxn_proc
+import ui_proc, cnxn_proc, async_engine, worker_proc, ipc, capture, session_store
+import cnxn_utils, rewrite_rules
 
 arg_parser = argparse.ArgumentParser(allow_abbrev=False, add_help=False, conflict_handler='resolve') # Options needed for argparser shenanigans later
 arg_parser.add_argument(
@@ -33,11 +34,64 @@ arg_parser.add_argument(
 )
 arg_parser.add_argument(
     "--max_connections", type=int, default=5,
-    help="Max number of simultaneous connections supported."
+    help="Max number of simultaneous connections supported. With --engine "
+         "asyncio, also how many threads are shared between connections to "
+         "run handlers on."
+)
+arg_parser.add_argument(
+    "--engine", type=str, choices=["process", "asyncio"], default="process",
+    help="How connections are serviced. 'process' forks a process for each "
+         "connection. 'asyncio' services every connection from one event loop "
+         "in the main process, which scales much better to many concurrent "
+         "connections."
+)
+arg_parser.add_argument(
+    "--workers", type=int, default=0,
+    help="Number of pre-started worker processes which share the listener and "
+         "each service many connections. 0 (the default) forks a new process "
+         "for each connection instead. With --engine asyncio, each worker runs "
+         "its own event loop."
+)
+arg_parser.add_argument(
+    "--listener_shards", type=int, default=0,
+    help="Number of separate listening sockets to bind to the listen port with "
+         "SO_REUSEPORT, so the kernel spreads incoming connections across them "
+         "instead of one accept loop taking them all. Each listener gets its "
+         "own --workers worker processes (at least one). 0 (the default) binds "
+         "a single listener. Linux and the BSDs only."
+)
+arg_parser.add_argument(
+    "--eager_connect", action="store_true",
+    help="Connect to the server as soon as a client connects (while the "
+         "client-facing handlers are still being set up, where the handlers "
+         "allow it), instead of waiting for the client's first message. Cuts "
+         "a round trip through the user interface and the server's handshake "
+         "out of the first message's latency, and is required for protocols "
+         "where the server talks first, like SMTP or FTP."
 )
 arg_parser.add_argument(
     "--read_size", type=int, default=4096,
-    help="Number of bytes read from wire before forwarding."
+    help="Number of bytes read from wire before forwarding. Reads grow from "
+         "here (up to --max_read_size) while they keep filling up, and shrink "
+         "back when they don't."
+)
+arg_parser.add_argument(
+    "--max_read_size", type=int, default=262144,
+    help="Largest number of bytes read from the wire at once. Set equal to "
+         "--read_size to always read --read_size bytes."
+)
+arg_parser.add_argument(
+    "--coalesce_budget", type=float, default=0,
+    help="Milliseconds to wait for more data after a short read of traffic that "
+         "isn't being intercepted, so that it can be sent (and displayed) "
+         "together. Trades latency for fewer sends and fewer messages on bulk "
+         "transfers. Only applies when the handlers add nothing on top of TCP. "
+         "0 (the default) disables this."
+)
+arg_parser.add_argument(
+    "--connection_stats", action="store_true",
+    help="If this is supplied, report read sizes and send counts for each "
+         "connection when it closes."
 )
 arg_parser.add_argument(
     "--pass_client", action="store_true",
@@ -49,6 +103,118 @@ arg_parser.add_argument(
     help="If this is supplied, then by default alsanna will intercept server "
          "traffic for editing."
 )
+arg_parser.add_argument(
+    "--watch_mode", type=str, choices=["full", "summary"], default="full",
+    help="How traffic that isn't being intercepted is displayed; it's forwarded "
+         "without waiting on the user interface either way. 'full' displays "
+         "every message. 'summary' only displays how many bytes went past every "
+         "--summary_interval seconds, and forwards as fast as possible - "
+         "without the bytes leaving the kernel, if the handlers add nothing on "
+         "top of TCP."
+)
+arg_parser.add_argument(
+    "--summary_interval", type=float, default=1.0,
+    help="Seconds between summaries of traffic passed through with "
+         "--watch_mode summary."
+)
+arg_parser.add_argument(
+    "--display_backlog", type=int, default=256,
+    help="Maximum number of messages that aren't being intercepted which can be "
+         "waiting to be displayed. They're forwarded regardless, but once the "
+         "terminal falls this far behind, further messages aren't displayed; "
+         "you're told how many were skipped instead."
+)
+arg_parser.add_argument(
+    "--payload_transport", type=str, choices=["pipe", "shm"], default="pipe",
+    help="How intercepted messages get to the user interface and back. 'pipe' "
+         "pickles them onto the display queue and back down a pipe. 'shm' "
+         "passes them through a shared memory segment per connection and "
+         "direction instead, so only a small descriptor is pickled, which "
+         "helps with big messages."
+)
+arg_parser.add_argument(
+    "--payload_shm_size", type=int, default=16,
+    help="Megabytes of shared memory per connection and direction with "
+         "--payload_transport shm, set up the first time it intercepts a "
+         "message. Messages whose printable form is bigger go by pipe."
+)
+arg_parser.add_argument(
+    "--display_budget", type=int, default=4096,
+    help="Roughly how many bytes of a message that isn't being intercepted are "
+         "displayed. Longer messages are shown as their start and end, with a "
+         "marker giving how much was left out, the full length and a hash. "
+         "Intercepted messages are always shown in full for editing. 0 "
+         "displays everything."
+)
+arg_parser.add_argument(
+    "--capture", type=str, default=None,
+    help="File to record every message forwarded to, in a compact binary "
+         "format: both the original and the edited version of intercepted "
+         "messages, with timestamps. Read it back with 'python capture.py "
+         "dump <file>', or convert it for Wireshark with 'python capture.py "
+         "pcapng <file> <output.pcapng>'. Needs --watch_mode full, since "
+         "summary mode never sees the bytes."
+)
+arg_parser.add_argument(
+    "--store", type=str, default=None,
+    help="SQLite file to keep an indexed, searchable store of the --capture "
+         "in as it's written, by connection, direction, time, size, protocol "
+         "fields and text. It's kept up to date by a process of its own, so "
+         "forwarding never waits on it. Search it with 'python "
+         "session_store.py query <file> ...'."
+)
+arg_parser.add_argument(
+    "--rules", type=str, default=None,
+    help="JSON file of rewrite rules to apply to every message as it arrives, "
+         "without the editor: regular expression replacements for handlers "
+         "whose messages are bytes, and field changes for ones whose messages "
+         "are objects (like ldap). Rules can also drop messages, or decide "
+         "whether they're intercepted. See rewrite_rules.py for the format. "
+         "Needs --watch_mode full."
+)
+arg_parser.add_argument(
+    "--rules_report", type=float, default=10.0,
+    help="How often, in seconds, to note how many messages each of the --rules "
+         "has applied to, if that's changed."
+)
+arg_parser.add_argument(
+    "--headless", action="store_true",
+    help="Run without a terminal: nothing is intercepted, nothing is printed, "
+         "and every message (and error, and note) is written to --session_log "
+         "as a line of JSON instead. Connections wait for the log to keep up "
+         "rather than skipping messages, so the record is complete."
+)
+arg_parser.add_argument(
+    "--session_log", type=str, default="alsanna_session.jsonl",
+    help="File to write the session to with --headless."
+)
+arg_parser.add_argument(
+    "--session_log_size", type=int, default=64,
+    help="Megabytes --session_log can grow to before it's set aside as "
+         "<session_log>.000001 (then .000002, and so on) and a new one started."
+)
+arg_parser.add_argument(
+    "--session_log_keep", type=int, default=0,
+    help="Number of set-aside session logs to keep, deleting the oldest. 0 (the "
+         "default) keeps them all."
+)
+arg_parser.add_argument(
+    "--session_log_flush", type=float, default=1.0,
+    help="Most seconds a record can sit in the session log's buffer before "
+         "it's written out."
+)
+arg_parser.add_argument(
+    "--session_log_compress", action="store_true",
+    help="If this is supplied, set-aside session logs are gzipped in the "
+         "background."
+)
+arg_parser.add_argument(
+    "--session_log_raw", action="store_true",
+    help="If this is supplied with --headless, record messages that are bytes "
+         "as they are (base64-encoded) rather than in printable form, which "
+         "also saves making them printable. Other messages are still recorded "
+         "in printable form."
+)
 arg_parser.add_argument(
     "--intercept_client_keypress", type=str, default='c',
     help="The key which, when pressed, toggles interception of client traffic "
@@ -61,7 +227,10 @@ arg_parser.add_argument(
 )
 arg_parser.add_argument(
     "--editor", type=str, default="nano",
-    help="Command to use for launching editor. Trivial command injection."
+    help="Command to use for launching editor. Trivial command injection. "
+         "'builtin' uses a small editor built into alsanna instead (see "
+         "builtin_editor.py), which saves starting an editor for every "
+         "message."
 )
 arg_parser.add_argument(
     "--client_color", type=int, default=13,
@@ -87,53 +256,137 @@ for i in range(len(args.handlers)):
     handler_module = importlib.import_module('handlers.' + args.handlers[i])
     args.handlers[i] = handler_module.Handler(arg_parser, final)
     arg_parser = args.handlers[i].arg_parser
+    if i > 0 and hasattr(args.handlers[i], "set_previous"):  # See handlers/prototype
+        args.handlers[i].set_previous(args.handlers[i-1])
 handlers = args.handlers  # Save the list of modules
 args = args.handlers[-1].args # The final handler finished building the real arg_parser
 args.handlers = handlers  # Replace the list of strings with a list of modules
+if args.capture is not None and args.watch_mode == "summary":
+    arg_parser.error("--capture needs --watch_mode full.")
+if args.store is not None and args.capture is None:
+    arg_parser.error("--store needs --capture.")
+if args.rules is not None:
+    if args.watch_mode == "summary":
+        arg_parser.error("--rules needs --watch_mode full.")
+    try:
+        args.rules = rewrite_rules.Rules(args.rules)  # Compiled once, here
+    except ValueError as e:
+        arg_parser.error(str(e))
+if args.session_log_raw and not args.headless:
+    arg_parser.error("--session_log_raw only works with --headless.")
+if args.listener_shards > 0 and not hasattr(socket, "SO_REUSEPORT"):
+    arg_parser.error("--listener_shards needs SO_REUSEPORT, which this platform "
+                     "doesn't have.")
 
 
 def main():
     """
     Highest-level server logic. Sets up the synchronous message processor, sets 
-    up connections, and spins up a subprocess to handle each connection.
+    up connections, and spins up a subprocess to handle each connection (or
+    hands them to a pool of workers or a single event loop, depending on
+    --workers, --listener_shards and --engine).
     """
     display_q = multiprocessing.Queue()
 
+    # Shared with every process, so keypresses in the UI take effect everywhere.
+    # Headless, there's nobody to intercept for.
+    args.intercept = ipc.InterceptState(
+        client=not args.pass_client and not args.headless,
+        server=args.intercept_server and not args.headless
+    )
+    args.display_ring = ipc.DisplayRing(args.display_backlog, wait=args.headless)
+    args.capture = capture.Capture(args.capture) if args.capture else None
+    args.payload_size = 0
+    if args.payload_transport == "shm":
+        args.payload_size = args.payload_shm_size * 1024 * 1024
+        # Start the process that cleans up shared memory now, so connections
+        # all share it rather than each starting their own.
+        multiprocessing.resource_tracker.ensure_running()
+
     message_processor = multiprocessing.Process(target=ui_proc.user_interface,
                                                 kwargs={"display_q": display_q,
                                                         "args": args})
     message_processor.daemon = True
     message_processor.start()
 
-    connection_id = 0
-    connections = {}
+    if args.store is not None:
+        indexer = multiprocessing.Process(target=session_store.follow,
+                                          kwargs={"capture_path": args.capture.path,
+                                                  "store_path": args.store,
+                                                  "handler": args.handlers[-1],
+                                                  "display_q": display_q})
+        indexer.daemon = True
+        indexer.start()
+
+    if args.rules is not None and args.rules_report > 0:
+        threading.Thread(target=cnxn_utils.report_rules,
+                         args=(display_q, args), daemon=True).start()
+
+    # Shared so connection ids stay unique no matter which process accepts.
+    cnxn_counter = multiprocessing.Value('L', 0)
 
+    # Bind every listener up front, so problems like the port being in use
+    # show up here rather than in a worker.
+    l_socks = [bind_listener(reuse_port=args.listener_shards > 0)
+               for shard in range(max(args.listener_shards, 1))]
+
+    try:
+        if args.workers > 0 or args.listener_shards > 0:
+            worker_proc.run_pool(l_socks, display_q, cnxn_counter, args)
+        elif args.engine == "asyncio":
+            async_engine.serve(l_socks[0], display_q, cnxn_counter, args)
+        else:
+            accept_connections(l_socks[0], display_q, cnxn_counter)
+    except:
+        display_q.put(("Err", ("Parent process dying, exiting alsanna.\n",
+                               traceback.format_exc())
+                        ))
+        time.sleep(1)  # Give processor time to print the stack trace.
+    finally:
+        for l_sock in l_socks:
+            l_sock.close()
+
+
+def bind_listener(reuse_port=False):
+    """
+    Bind and listen on a socket on the listen address. With reuse_port, several
+    of these can be bound to the same address at once, and the kernel balances
+    incoming connections between them.
+    """
     l_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
 
     # Allow socket to be reused quickly after quitting.
     l_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        l_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     l_sock.bind((args.listen_ip, args.listen_port))
     l_sock.listen(args.max_connections)
-    with l_sock:
-        while True:
-            try:
-                listen_sock, addr = l_sock.accept()
-
-                connections[connection_id] = multiprocessing.Process(
-                    target=cnxn_proc.manage_connections,
-                    args=(listen_sock,
-                          display_q,
-                          connection_id,
-                          args))
-                connections[connection_id].start()
-                connection_id += 1
-            except:
-                display_q.put(("Err", ("Parent process dying, exiting alsanna.\n",
-                                       traceback.format_exc())
-                                ))
-                time.sleep(1)  # Give processor time to print the stack trace.
-                break
+    return l_sock
+
+
+def accept_connections(l_sock, display_q, cnxn_counter):
+    """
+    Accept connections forever, spinning up a subprocess for each one.
+    """
+    connections = {}
+    while True:
+        listen_sock, addr = l_sock.accept()
+
+        # Reap connections that have finished so they don't pile up forever.
+        for dead_id in [cid for cid, cnxn in connections.items()
+                        if not cnxn.is_alive()]:
+            connections.pop(dead_id).join()
+
+        connection_id = cnxn_proc.next_connection_id(cnxn_counter)
+        connections[connection_id] = multiprocessing.Process(
+            target=cnxn_proc.manage_connections,
+            args=(listen_sock,
+                  display_q,
+                  connection_id,
+                  args))
+        connections[connection_id].start()
+        listen_sock.close()  # The child has its own copy now
 
 if __name__ == '__main__':
     main()
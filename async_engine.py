@@ -0,0 +1,471 @@
+import asyncio
+import time
+import traceback
+import concurrent.futures
+import cnxn_proc, cnxn_utils, ipc, capture
+
+# An alternative to the process-per-connection model in cnxn_proc.py. A single
+# event loop owns the listener and every client/server pair, so accepting a
+# connection costs a coroutine instead of a fork. When the handler chain is
+# plain TCP (see passthrough_socket() in handlers/prototype), bytes are read and
+# written by the loop itself. Otherwise handlers are written against blocking
+# sockets (TLS handshakes, LDAP's STARTTLS locks, and so on), so rather than
+# rewriting every one of them we run their calls on a pool of threads shared by
+# every connection, through AsyncSock below. The loop waits for a handler
+# socket to have something to read before a thread is asked to recv() from
+# it, so idle connections never sit on a thread, and --max_connections threads
+# go a long way. Anything else that might block (handlers making messages
+# printable, waiting on the user interface with --headless) runs on the pool
+# too. The loop itself never blocks.
+
+def serve(l_sock, display_q, cnxn_counter, args):
+    """
+    Run the asyncio engine until the listener dies. l_sock is the bound,
+    listening socket set up by alsanna.main(), and cnxn_counter the counter
+    connection ids are drawn from.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.max_connections, thread_name_prefix="handler")
+    try:
+        loop.run_until_complete(accept_connections(l_sock, display_q, cnxn_counter,
+                                                   executor, args))
+    finally:
+        executor.shutdown(wait=False)
+        loop.close()
+
+
+async def accept_connections(l_sock, display_q, cnxn_counter, executor, args):
+    """
+    Accept connections forever, starting a manage_connection() task for each.
+    """
+    loop = asyncio.get_running_loop()
+    l_sock.setblocking(False)
+    connections = set()  # The loop only keeps weak references to tasks
+    while True:
+        listen_sock, addr = await loop.sock_accept(l_sock)
+        listen_sock.setblocking(True)  # Handlers expect blocking sockets
+        connection_id = cnxn_proc.next_connection_id(cnxn_counter)
+        task = loop.create_task(manage_connection(listen_sock, display_q,
+                                                  connection_id, executor, args))
+        connections.add(task)
+        task.add_done_callback(connections.discard)
+
+
+async def manage_connection(listen_sock, display_q, connection_id, executor,
+                            args):
+    """
+    The coroutine equivalent of cnxn_proc.manage_connections(). Sets up the
+    client-facing handler chain and a forward() task for each direction.
+    """
+    loop = asyncio.get_running_loop()
+    cnxn_locals = {'cnxn_id': str(connection_id), 'display_q': display_q}
+
+    # Registered with the user interface by forward() once they're needed.
+    c_result_q = ipc.ResultChannel(payload_size=args.payload_size)
+    s_result_q = ipc.ResultChannel(payload_size=args.payload_size)
+
+    sockets = {"client": {"sock": None,
+                          "sizer": cnxn_utils.ReadSizer(args),
+                          "watched": {"skipped": 0}},
+               "server": {"sock": None,
+                          "sizer": cnxn_utils.ReadSizer(args),
+                          "watched": {"skipped": 0},
+                          "connected": asyncio.Event(),
+                          "connector": None}}  # Task for --eager_connect
+
+    if args.eager_connect and cnxn_utils.connect_early(args):
+        sockets["server"]["connector"] = loop.create_task(
+            connect_server(sockets, display_q, cnxn_locals, executor, args)
+        )
+
+    try:
+        try:
+            # Clients that connect and say nothing don't get a thread to say
+            # nothing to, even if the first handler has a handshake to do.
+            await wait_readable(listen_sock, None)
+            client_sock = await loop.run_in_executor(executor, setup_client_facing,
+                                                     listen_sock, cnxn_locals, args)
+            sockets["client"]["sock"] = AsyncSock(client_sock, executor)
+        except:
+            display_q.put(("Err", ("Error setting up listener.",
+                                   traceback.format_exc())
+                            ))
+            listen_sock.close()
+            if sockets["server"]["connector"] is not None:
+                await sockets["server"]["connector"]
+            return
+
+        if args.eager_connect and sockets["server"]["connector"] is None:
+            sockets["server"]["connector"] = loop.create_task(
+                connect_server(sockets, display_q, cnxn_locals, executor, args)
+            )
+
+        c_to_s = loop.create_task(forward(sockets, "client", "server", display_q,
+                                          AsyncQueue(c_result_q),
+                                          cnxn_locals, executor, args))
+        # Only begin server->client once there's a server to listen to, or the
+        # client direction has given up before ever getting that far.
+        connected = loop.create_task(sockets["server"]["connected"].wait())
+        await asyncio.wait([c_to_s, connected],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not sockets["server"]["connected"].is_set() \
+           and sockets["server"]["connector"] is not None:
+            await sockets["server"]["connector"]  # Might still get there
+        if sockets["server"]["connected"].is_set():
+            s_to_c = loop.create_task(forward(sockets, "server", "client",
+                                              display_q,
+                                              AsyncQueue(s_result_q),
+                                              cnxn_locals, executor, args))
+            await asyncio.gather(c_to_s, s_to_c)
+        else:
+            connected.cancel()
+            await c_to_s
+    except:
+        display_q.put(("Err", ("Forwarder " + cnxn_locals["cnxn_id"] + " dying.",
+                               traceback.format_exc())
+                        ))
+    finally:
+        await cleanup(sockets, "client", "server")
+        for host in ("client", "server"):
+            # Nothing left for skipped counts to go along with, so say them now
+            cnxn_utils.report_skipped(host, display_q, cnxn_locals,
+                                      sockets[host]["watched"])
+        if args.connection_stats:
+            display_q.put(("Note", "Connection " + cnxn_locals['cnxn_id']
+                                   + " client: " + sockets["client"]["sizer"].summary()
+                                   + "\nConnection " + cnxn_locals['cnxn_id']
+                                   + " server: " + sockets["server"]["sizer"].summary()))
+        # Unlike a dead process, a finished task leaves its queues registered
+        # with the UI, so always tell the UI to let go of them.
+        display_q.put(("Kill", cnxn_locals['cnxn_id'] + "client"))
+        display_q.put(("Kill", cnxn_locals['cnxn_id'] + "server"))
+        c_result_q.close()
+        s_result_q.close()
+
+
+async def connect_server(sockets, display_q, cnxn_locals, executor, args):
+    """
+    The coroutine equivalent of cnxn_proc.connect_server(). Returns whether we
+    connected.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        server_sock = await loop.run_in_executor(executor,
+                                                 cnxn_utils.setup_server_facing,
+                                                 cnxn_locals, args)
+    except:
+        display_q.put(("Err", ("Error connecting to server.",
+                               traceback.format_exc())
+                        ))
+        return False
+    sockets["server"]["sock"] = AsyncSock(server_sock, executor)
+    sockets["server"]["connected"].set()
+    return True
+
+
+async def forward(sockets, listen, send, display_q, result_q, cnxn_locals,
+                  executor, args):
+    """
+    The coroutine equivalent of cnxn_proc.forward(); see there for details.
+    Anything that might block (rules, recording, handlers making messages
+    printable and back, waiting on the user interface to show a message) runs
+    on the executor, so the loop never does.
+    """
+    loop = asyncio.get_running_loop()
+
+    def blocking(function, *function_args):
+        return loop.run_in_executor(executor, function, *function_args)
+
+    def watch(msg_obj, rewritten):
+        cnxn_utils.record(msg_obj, listen,
+                          capture.EDITED if rewritten else capture.WATCHED,
+                          cnxn_locals, args)
+        cnxn_utils.watch(msg_obj, listen, display_q, cnxn_locals, watched, args)
+
+    watched = sockets[listen]["watched"]  # Messages the UI had no room for
+    while True:
+        msg_obj = None
+        try:
+            if not args.intercept[listen] and args.watch_mode == "summary" \
+               and sockets[send]["sock"] is not None:
+                if not await pass_through(sockets[listen]["sock"],
+                                          sockets[send]["sock"], listen,
+                                          display_q, cnxn_locals,
+                                          sockets[listen]["sizer"], executor,
+                                          args):
+                    cnxn_utils.half_close(sockets[send]["sock"].sock)
+                    return  # Stream closed while passing through
+                continue  # Interception was switched back on
+
+            msg_obj = await sockets[listen]["sock"].recv(sockets[listen]["sizer"].size)
+            if msg_obj is None:
+                if sockets[send].get("connector") is not None:
+                    await sockets[send]["connector"]  # Hang up on it too
+                if sockets[send]["sock"] is not None:
+                    cnxn_utils.half_close(sockets[send]["sock"].sock)
+                return
+            sockets[listen]["sizer"].update(cnxn_utils.message_size(msg_obj))
+
+            intercept = args.intercept[listen]
+            if not intercept:  # Just watching; nothing will come back
+                msg_obj = await sockets[listen]["sock"].coalesce(
+                    msg_obj, sockets[listen]["sizer"], args)
+            if args.rules is not None:
+                msg_obj, intercept, rewritten = await blocking(cnxn_utils.rewrite,
+                                                               msg_obj, listen,
+                                                               intercept,
+                                                               cnxn_locals, args)
+            else:
+                rewritten = False
+            if msg_obj is None:
+                continue  # Dropped by a rule
+
+            if intercept:
+                if not rewritten:  # Otherwise rewrite() recorded the original
+                    await blocking(cnxn_utils.record, msg_obj, listen,
+                                   capture.ORIGINAL, cnxn_locals, args)
+                readable, unprintable_state = await blocking(
+                    args.handlers[-1].obj_to_printable, msg_obj)
+                result_q.register(display_q, cnxn_locals['cnxn_id']+listen)
+                display_q.put((cnxn_locals['cnxn_id']+listen,
+                               result_q.channel.wrap(readable)))
+                readable = result_q.channel.unwrap(await result_q.get())  # Yields until message available
+                if readable is not None:  # None if it came back unchanged
+                    msg_obj = await blocking(args.handlers[-1].printable_to_obj,
+                                             readable, unprintable_state)
+                    await blocking(cnxn_utils.record, msg_obj, listen,
+                                   capture.EDITED, cnxn_locals, args)
+                elif rewritten:
+                    await blocking(cnxn_utils.record, msg_obj, listen,
+                                   capture.EDITED, cnxn_locals, args)
+                else:
+                    await blocking(cnxn_utils.record, None, listen,
+                                   capture.UNCHANGED, cnxn_locals, args)
+            else:  # Can wait on the user interface, with --headless
+                await blocking(watch, msg_obj, rewritten)
+            if listen == "client" and not sockets["server"]["connected"].is_set():
+                if sockets["server"]["connector"] is not None:
+                    connected = await sockets["server"]["connector"]
+                else:
+                    connected = await connect_server(sockets, display_q,
+                                                     cnxn_locals, executor, args)
+                if not connected:
+                    msg_obj = None  # Nowhere to send it
+                    return
+        except:
+            display_q.put(("Err", ("Error in forwarder.",
+                                   traceback.format_exc())
+                            ))
+            return
+        finally:
+            try:
+                if msg_obj is not None:  # We got a message but had an error after
+                    await sockets[send]["sock"].send(msg_obj,
+                                                     sockets[listen]["sizer"])
+            except:
+                display_q.put(("Err", ("Error sending data.",
+                                        traceback.format_exc())
+                              ))
+                await cleanup(sockets, listen, send)
+                return
+
+
+async def pass_through(listen_sock, send_sock, listen, display_q, cnxn_locals,
+                       sizer, executor, args):
+    """
+    The coroutine equivalent of cnxn_utils.pass_through(). Plain TCP is read
+    into one reused buffer and written out again by the loop; handler sockets
+    have their messages shuttled across without being made printable, as
+    HandlerMover does. Waits for something to read at most
+    cnxn_utils.INTERCEPT_CHECK seconds at a time, so switching interception on
+    catches the very next message. Summaries go through the executor, since
+    with --headless they wait on the user interface.
+    """
+    loop = asyncio.get_running_loop()
+    passed = {"bytes": 0, "reads": 0}
+    last_summary = None  # Report the first read straight away
+    buffer = bytearray(sizer.size) if listen_sock.raw is not None else None
+    try:
+        while not args.intercept[listen]:
+            if not await listen_sock.readable(cnxn_utils.INTERCEPT_CHECK) \
+               or args.intercept[listen]:
+                continue
+            if buffer is None:
+                msg_obj = await listen_sock.recv(sizer.size)
+                if msg_obj is None:
+                    return False
+                sizer.update(cnxn_utils.message_size(msg_obj))
+                await send_sock.send(msg_obj, sizer)
+                moved = cnxn_utils.message_size(msg_obj) or 0
+            else:
+                if len(buffer) < sizer.size:  # Reads have grown since
+                    buffer = bytearray(sizer.size)
+                try:
+                    moved = listen_sock.raw.recv_into(buffer, sizer.size)
+                except BlockingIOError:  # Readable, but someone else got there first
+                    continue
+                except ConnectionResetError:
+                    moved = 0
+                if moved == 0:
+                    return False
+                sizer.update(moved)
+                with memoryview(buffer) as view:
+                    await send_sock.send(view[:moved], sizer)
+            passed["bytes"] += moved
+            passed["reads"] += 1
+            if last_summary is None \
+               or time.monotonic() - last_summary >= args.summary_interval:
+                await loop.run_in_executor(executor, cnxn_utils.summarize,
+                                           passed, listen, display_q,
+                                           cnxn_locals, args)
+                last_summary = time.monotonic()
+        return True
+    finally:
+        await loop.run_in_executor(executor, cnxn_utils.summarize,
+                                   passed, listen, display_q, cnxn_locals, args)
+
+
+def setup_client_facing(listen_sock, cnxn_locals, args):
+    """
+    Run the client-facing half of the handler chain. Blocking (e.g. the TLS
+    handshake), so this is run on the executor.
+    """
+    for handler in args.handlers:
+        listen_sock = handler.setup_client_facing(listen_sock=listen_sock,
+                                                  cnxn_locals=cnxn_locals)
+    return listen_sock
+
+
+async def cleanup(sockets, listen, send):
+    """
+    Ensures the sockets for listening and sending are both closed.
+    """
+    for host in (listen, send):
+        try:
+            await sockets[host]["sock"].close()
+        except:
+            pass
+
+
+async def wait_readable(sock, timeout):
+    """
+    Wait up to timeout seconds (forever if None) for a kernel socket to have
+    something to read, or to be closed. Returns whether it does.
+    """
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(sock.fileno(),
+                    lambda: ready.done() or ready.set_result(True))
+    try:
+        return await asyncio.wait_for(ready, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+class AsyncSock():
+    """
+    Adapter giving a handler socket awaitable methods. If the handler chain is
+    plain TCP, the socket beneath it (raw) is made non-blocking and read and
+    written by the loop itself. Otherwise handler sockets may block however
+    they like, so their calls go to the executor, but recv() only once the
+    loop has seen there's something to read (see cnxn_utils.recv_source()).
+
+    The handler chain is the same both ways, so a connection's two sockets are
+    either both plain TCP or neither is.
+    """
+    def __init__(self, sock, executor):
+        self.sock = sock  # The last handler's socket
+        self.executor = executor
+        self.raw = cnxn_utils.raw_socket(sock)
+        if self.raw is not None:
+            self.raw.setblocking(False)
+
+    async def close(self):
+        self.sock.close()
+
+    async def send(self, msg_obj, sizer=None):
+        loop = asyncio.get_running_loop()
+        if self.raw is None:
+            return await loop.run_in_executor(self.executor, cnxn_utils.send_message,
+                                              self.sock, msg_obj, sizer)
+        try:
+            await loop.sock_sendall(self.raw, b''.join(msg_obj)
+                                    if isinstance(msg_obj, list) else msg_obj)
+        except ConnectionResetError:  # As the rawbytes handler's send() does
+            pass
+        if sizer is not None:
+            sizer.sent(len(msg_obj) if isinstance(msg_obj, list) else 1)
+
+    async def recv(self, num_bytes):
+        loop = asyncio.get_running_loop()
+        if self.raw is None:
+            await self.readable(None)
+            return await loop.run_in_executor(self.executor, self.sock.recv,
+                                              num_bytes)
+        try:
+            recvd = await loop.sock_recv(self.raw, num_bytes)
+        except ConnectionResetError:  # Socket is closed here, give up
+            return None
+        return recvd or None  # None for closed, like handler sockets
+
+    async def readable(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for there to be something
+        to read, or for the socket to be closed. Returns whether there is.
+        """
+        if self.raw is not None:
+            return await wait_readable(self.raw, timeout)
+        buffered, kernel_sock = cnxn_utils.recv_source(self.sock)
+        if buffered or kernel_sock is None:
+            return True  # Or we can't tell, and recv() blocks a thread instead
+        return await wait_readable(kernel_sock, timeout)
+
+    async def coalesce(self, msg_obj, sizer, args):
+        """
+        The coroutine equivalent of cnxn_utils.coalesce(), which only does
+        anything when we can see raw.
+        """
+        if self.raw is None or args.coalesce_budget <= 0 \
+           or cnxn_utils.message_size(msg_obj) is None:
+            return msg_obj
+        chunks = [msg_obj]
+        total = len(msg_obj)
+        deadline = time.monotonic() + args.coalesce_budget / 1000
+        while total < sizer.size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await self.readable(remaining):
+                break
+            chunk = await self.recv(sizer.size - total)
+            if chunk is None:  # Closed; the next recv() will say so again
+                break
+            sizer.update(len(chunk))
+            chunks.append(chunk)
+            total += len(chunk)
+        return chunks if len(chunks) > 1 else msg_obj
+
+
+class AsyncQueue():
+    """
+    Adapter giving the channel the UI returns messages on an awaitable get().
+    Waits for the channel to become readable on the loop itself, so unlike
+    AsyncSock this never ties up a thread.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+
+    def register(self, display_q, name):
+        self.channel.register(display_q, name)
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.channel.fileno(), readable.set_result, None)
+        try:
+            await readable
+        finally:
+            loop.remove_reader(self.channel.fileno())
+        return self.channel.get()
@@ -0,0 +1,95 @@
+"""
+Measure how fast alsanna can take on new connections: open CONNECTIONS short
+connections from CLIENTS threads at once through an alsanna forwarding to a
+local echo server, and report connections per second. Pass alsanna options to
+compare, e.g.:
+
+    python benchmarks/accept_storm.py --workers 4
+    python benchmarks/accept_storm.py --workers 1 --listener_shards 4
+
+Run from the repository root. Traffic isn't intercepted, and only summaries are
+displayed, so this is mostly the cost of accepting and setting up connections.
+"""
+import os, sys
+import socket
+import subprocess
+import threading
+import time
+
+LISTEN_PORT = 4100
+ECHO_PORT = 4101
+CLIENTS = 32
+CONNECTIONS = int(os.environ.get("CONNECTIONS", 2000))
+MESSAGE = b"ping"
+
+
+def echo_server(l_sock):
+    while True:
+        sock, addr = l_sock.accept()
+        threading.Thread(target=echo, args=(sock,), daemon=True).start()
+
+
+def echo(sock):
+    """
+    Answer one message and hang up, like an HTTP/1.0 server, so both directions
+    of each connection through alsanna finish.
+    """
+    with sock:
+        data = sock.recv(4096)
+        if data:
+            sock.sendall(data)
+
+
+def client(count, failures):
+    for i in range(count):
+        try:
+            with socket.create_connection(("127.0.0.1", LISTEN_PORT)) as sock:
+                sock.settimeout(10)
+                sock.sendall(MESSAGE)
+                if sock.recv(len(MESSAGE)) != MESSAGE:
+                    failures.append(i)
+        except OSError:
+            failures.append(i)
+
+
+if __name__ == '__main__':
+    l_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    l_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    l_sock.bind(("127.0.0.1", ECHO_PORT))
+    l_sock.listen(128)
+    threading.Thread(target=echo_server, args=(l_sock,), daemon=True).start()
+
+    # alsanna's UI wants a terminal, so give it one nobody's looking at.
+    pty_main, pty_sub = os.openpty()
+    alsanna = subprocess.Popen([sys.executable, "alsanna.py",
+                                "--handlers", "rawbytes",
+                                "--listen_ip", "127.0.0.1",
+                                "--listen_port", str(LISTEN_PORT),
+                                "--server_ip", "127.0.0.1",
+                                "--server_port", str(ECHO_PORT),
+                                "--max_connections", "128",
+                                "--pass_client", "--watch_mode", "summary"]
+                               + sys.argv[1:],
+                               stdin=pty_sub, stdout=pty_sub, stderr=pty_sub)
+    # Throw away whatever it prints so it never blocks on a full terminal.
+    threading.Thread(target=lambda: [os.read(pty_main, 65536) for _ in iter(int, 1)],
+                     daemon=True).start()
+    time.sleep(2)  # Let it start up
+
+    try:
+        failures = []
+        clients = [threading.Thread(target=client,
+                                    args=(CONNECTIONS // CLIENTS, failures))
+                   for i in range(CLIENTS)]
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        alsanna.kill()
+
+    total = CONNECTIONS // CLIENTS * CLIENTS
+    print("{0} connections ({1} failed) in {2:.2f} s: {3:.0f} connections/s".format(
+          total, len(failures), elapsed, total / elapsed))
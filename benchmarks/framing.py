@@ -0,0 +1,117 @@
+"""
+Time cutting a stream into messages the naive way (recv_buf += sock.recv(n),
+then recv_buf = recv_buf[msg_len:]) against handlers/framing.py's FrameReader,
+for each kind of framer, with the stream arriving in reads of --read_size
+bytes. Checks both get the same messages, too.
+
+Run from the repository root: python benchmarks/framing.py
+"""
+import argparse
+import os, sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from handlers import framing
+
+
+class StreamSock():
+    """
+    Pretends to be a socket whose peer sent data, returning it read_size bytes
+    at a time.
+    """
+    def __init__(self, data, read_size):
+        self.data = memoryview(data)
+        self.read_size = read_size
+        self.sent = 0
+
+    def recv(self, num_bytes):
+        num_bytes = min(num_bytes, self.read_size)
+        chunk = bytes(self.data[self.sent:self.sent + num_bytes])
+        self.sent += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer, num_bytes):
+        num_bytes = min(num_bytes, self.read_size, len(self.data) - self.sent)
+        buffer[:num_bytes] = self.data[self.sent:self.sent + num_bytes]
+        self.sent += num_bytes
+        return num_bytes
+
+
+def naive(sock, msg_length, read_size):
+    """
+    Every message, framed the way handlers used to: msg_length(recv_buf)
+    says how long the first message is, or None if it can't say yet.
+    """
+    recv_buf = b""
+    messages = []
+    while True:
+        msg_len = msg_length(recv_buf)
+        while msg_len is None or len(recv_buf) < msg_len:
+            recvd = sock.recv(read_size)
+            if not recvd:
+                return messages
+            recv_buf += recvd
+            msg_len = msg_length(recv_buf)
+        messages.append(recv_buf[:msg_len])
+        recv_buf = recv_buf[msg_len:]
+
+
+def framed(sock, framer, read_size):
+    reader = framing.FrameReader(sock, framer)
+    messages = []
+    while True:
+        message = reader.recv(read_size)
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+def naive_delimited(buf):
+    found = buf.find(b"\r\n")
+    return None if found == -1 else found + 2
+
+
+def naive_length_prefixed(buf):
+    return None if len(buf) < 4 else 4 + int.from_bytes(buf[:4], "big")
+
+
+# For each framer, how to make a stream of count messages of about size bytes,
+# how the naive loop finds a message's length, and a new framer.
+KINDS = {
+    "fixed": (lambda size, count: os.urandom(size * count),
+              lambda size: (lambda buf: size),
+              lambda size: framing.Fixed(size)),
+    "length": (lambda size, count: (size.to_bytes(4, "big") + os.urandom(size)) * count,
+               lambda size: naive_length_prefixed,
+               lambda size: framing.LengthPrefixed(4)),
+    "delimited": (lambda size, count: (os.urandom(size).replace(b"\r", b"r") + b"\r\n") * count,
+                  lambda size: naive_delimited,
+                  lambda size: framing.Delimited(b"\r\n")),
+    "ber": (lambda size, count: (b"\x04\x84" + size.to_bytes(4, "big") + os.urandom(size)) * count,
+            lambda size: (lambda buf: framing.ber_message_length(memoryview(buf))),
+            lambda size: framing.BER()),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--read_size", type=int, default=65536)
+    parser.add_argument("--total", type=int, default=16 * 1024 * 1024,
+                        help="Bytes in each stream.")
+    args = parser.parse_args()
+    print("{0:>10} {1:>10} {2:>12} {3:>12}".format("framer", "msg size",
+                                                   "naive", "FrameReader"))
+    for kind, (stream, msg_length, framer) in KINDS.items():
+        for size in [64, 4096, 1024 * 1024]:
+            data = stream(size, max(1, args.total // size))
+            start = time.perf_counter()
+            expected = naive(StreamSock(data, args.read_size), msg_length(size),
+                             args.read_size)
+            naive_time = time.perf_counter() - start
+            start = time.perf_counter()
+            got = framed(StreamSock(data, args.read_size), framer(size),
+                         args.read_size)
+            framed_time = time.perf_counter() - start
+            assert got == expected, kind
+            print("{0:>10} {1:>10} {2:>9.1f} ms {3:>9.1f} ms".format(
+                kind, size, naive_time * 1000, framed_time * 1000))
@@ -0,0 +1,92 @@
+"""
+Compare the old per-connection Manager queues against ipc.ResultChannel for the
+two things a connection does with them: set them up and register them with the
+UI, then bounce messages off the UI and back.
+
+Run from the repository root: python benchmarks/ipc_roundtrip.py
+"""
+import multiprocessing
+import os, sys
+import statistics
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ipc
+
+ROUNDS = 2000
+SETUPS = 20
+MESSAGE = "b'" + "A" * 512 + "'"
+
+
+def fake_ui(display_q):
+    """
+    Stand-in for ui_proc.user_interface(), minus the terminal: registers result
+    queues and returns every message unmodified.
+    """
+    forwarding_queues = {}
+    while True:
+        connection_id, message = display_q.get()
+        if connection_id == "Kill":
+            forwarding_queues.pop(message, None)
+        elif connection_id not in forwarding_queues:
+            forwarding_queues[connection_id] = message
+        else:
+            forwarding_queues[connection_id].put(message)
+
+
+def manager_setup(display_q, cnxn_id):
+    q_manager = multiprocessing.Manager()
+    c_result_q = q_manager.Queue()
+    display_q.put((cnxn_id + "client", c_result_q))
+    s_result_q = q_manager.Queue()
+    display_q.put((cnxn_id + "server", s_result_q))
+    return q_manager, c_result_q, s_result_q
+
+
+def channel_setup(display_q, cnxn_id):
+    c_result_q = ipc.ResultChannel()
+    display_q.put((cnxn_id + "client", c_result_q))
+    s_result_q = ipc.ResultChannel()
+    display_q.put((cnxn_id + "server", s_result_q))
+    return None, c_result_q, s_result_q
+
+
+def run(name, setup, display_q):
+    setup_times = []
+    for i in range(SETUPS):
+        cnxn_id = name + str(i)
+        start = time.perf_counter()
+        owner, c_result_q, s_result_q = setup(display_q, cnxn_id)
+        # Setup isn't done until the UI can actually reach us.
+        display_q.put((cnxn_id + "client", "ping"))
+        c_result_q.get()
+        setup_times.append(time.perf_counter() - start)
+        display_q.put(("Kill", cnxn_id + "client"))
+        display_q.put(("Kill", cnxn_id + "server"))
+        if owner is not None:
+            owner.shutdown()
+
+    owner, c_result_q, s_result_q = setup(display_q, name + "rt")
+    round_trips = []
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        display_q.put((name + "rtclient", MESSAGE))
+        c_result_q.get()
+        round_trips.append(time.perf_counter() - start)
+    if owner is not None:
+        owner.shutdown()
+
+    round_trips.sort()
+    print("{0:>8}: setup median {1:8.3f} ms | round trip median {2:7.1f} us, "
+          "p99 {3:7.1f} us".format(name,
+                                   statistics.median(setup_times) * 1000,
+                                   statistics.median(round_trips) * 1000000,
+                                   round_trips[int(len(round_trips) * 0.99)] * 1000000))
+
+
+if __name__ == '__main__':
+    display_q = multiprocessing.Queue()
+    ui = multiprocessing.Process(target=fake_ui, args=(display_q,), daemon=True)
+    ui.start()
+    run("manager", manager_setup, display_q)
+    run("channel", channel_setup, display_q)
@@ -0,0 +1,57 @@
+"""
+Measure the round trip an intercepted message makes between a connection and
+the user interface, without the connection or the user interface: send a
+printable message of SIZE bytes to another process over a display queue, have
+it read the message and send it straight back, and time ROUNDS of that with
+--payload_transport pipe and shm.
+
+Run from the repository root: python benchmarks/payload_transport.py
+"""
+import multiprocessing
+import os, sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ipc
+
+SIZE = int(os.environ.get("SIZE", 8 * 1024 * 1024))
+ROUNDS = int(os.environ.get("ROUNDS", 20))
+
+
+def echo_ui(display_q):
+    """
+    Stands in for the user interface: take the channel, then send every
+    message back as-is (but not as None, so it really makes the trip).
+    """
+    name, channel = display_q.get()
+    while True:
+        name, message = display_q.get()
+        if message is None:
+            return
+        channel.put(channel.wrap(channel.unwrap(message)))
+
+
+def round_trips(payload_size, message):
+    display_q = multiprocessing.Queue()
+    ui = multiprocessing.Process(target=echo_ui, args=(display_q,))
+    ui.start()
+    channel = ipc.ResultChannel(payload_size=payload_size)
+    channel.register(display_q, "0client")
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        display_q.put(("0client", channel.wrap(message)))
+        assert len(channel.unwrap(channel.get())) == len(message)
+    elapsed = time.perf_counter() - start
+    display_q.put(("0client", None))
+    ui.join()
+    channel.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    multiprocessing.resource_tracker.ensure_running()  # As alsanna.main() does
+    message = str(bytes(range(256)) * (SIZE // 256))  # What rawbytes would show
+    for transport, payload_size in (("pipe", 0), ("shm", len(message))):
+        elapsed = round_trips(payload_size, message)
+        print("{0}: {1} round trips of {2} bytes in {3:.2f} s: {4:.1f} ms each".format(
+              transport, ROUNDS, len(message), elapsed, elapsed / ROUNDS * 1000))
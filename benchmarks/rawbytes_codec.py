@@ -0,0 +1,53 @@
+"""
+Time the round trip an intercepted rawbytes message makes through its printable
+form - made printable for the editor, then read back - for the old str() and
+ast.literal_eval() path and each --rawbytes_format, on text-like and random
+binary payloads from 1 KB to 10 MB. Checks every round trip is exact, too.
+
+Run from the repository root: python benchmarks/rawbytes_codec.py
+"""
+import ast
+import os, sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from handlers.rawbytes import codec
+
+SIZES = [1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+REPEAT = float(os.environ.get("REPEAT", 0.5))  # Seconds to spend on each timing
+
+PATHS = {"literal_eval": (lambda data: str(data), ast.literal_eval),
+         "literal": codec.FORMATS["literal"],
+         "hexdump": codec.FORMATS["hexdump"]}
+
+
+def payloads(size):
+    text = (b"GET /index.html HTTP/1.1\r\nHost: example.com\r\n"
+            b"Accept: */*\r\n\r\n") * (size // 60 + 1)
+    return {"text": text[:size], "binary": os.urandom(size)}
+
+
+def round_trip(encode, decode, data):
+    """
+    Seconds per encode and decode of data, best of however many fit in REPEAT.
+    """
+    best = None
+    deadline = time.perf_counter() + REPEAT
+    while best is None or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        result = decode(encode(data))
+        elapsed = time.perf_counter() - start
+        assert result == data
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    print("{0:>10} {1:>7} ".format("size", "payload")
+          + " ".join("{0:>14}".format(name) for name in PATHS))
+    for size in SIZES:
+        for kind, data in payloads(size).items():
+            times = [round_trip(encode, decode, data)
+                     for encode, decode in PATHS.values()]
+            print("{0:>10} {1:>7} ".format(size, kind)
+                  + " ".join("{0:>11.2f} ms".format(t * 1000) for t in times))
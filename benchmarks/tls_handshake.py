@@ -0,0 +1,85 @@
+"""
+Time TLS handshakes through the tls handler, for server names it hasn't seen
+(so it has to make a leaf certificate), names it has a certificate for on disk
+but not in memory (as in a new connection process), and names it has a context
+for already. Compares making certificates by running openssl with making them
+in-process with cryptography, for each --tls_key_type. Certificates are made
+in a temporary directory, not handlers/tls/certs.
+
+Run from the repository root: python benchmarks/tls_handshake.py
+"""
+import argparse
+import os, sys
+import socket, ssl
+import statistics
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from handlers import tls
+
+
+def make_handler(cert_dir, key_type):
+    sys.argv = [sys.argv[0],
+                "--tls_serv_cert", os.path.join(cert_dir, "tls_cert.pem"),
+                "--tls_serv_key", os.path.join(cert_dir, "tls_key.pem"),
+                "--tls_key_type", key_type]
+    handler = tls.Handler(argparse.ArgumentParser(add_help=False), final=False)
+    handler.cert_dir = cert_dir
+    return handler
+
+
+def handshake(handler, server_name):
+    """
+    Seconds from the client starting a handshake for server_name to the
+    handler's end finishing it.
+    """
+    client_sock, server_sock = socket.socketpair()
+    client_context = ssl._create_unverified_context()
+    server = threading.Thread(target=lambda: handler.setup_client_facing(server_sock, {}))
+    start = time.perf_counter()
+    server.start()
+    client = client_context.wrap_socket(client_sock, server_hostname=server_name)
+    server.join()
+    elapsed = time.perf_counter() - start
+    client.close()
+    server_sock.close()
+    return elapsed
+
+
+def report(label, times):
+    print("{0:<36} {1:>9.2f} ms median {2:>9.2f} ms max  ({3} handshakes)".format(
+        label, statistics.median(times) * 1000, max(times) * 1000, len(times)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--names", type=int, default=20,
+                        help="New server names to try with cryptography.")
+    parser.add_argument("--openssl_names", type=int, default=3,
+                        help="New server names to try with openssl, which is slow.")
+    bench_args = parser.parse_args()
+    have_cryptography = tls.x509
+    for minter, key_type in [("openssl", "rsa"), ("openssl", "ec"),
+                             ("cryptography", "rsa"), ("cryptography", "ec")]:
+        if minter == "cryptography" and have_cryptography is None:
+            print("cryptography isn't installed; skipping", key_type)
+            continue
+        tls.x509 = None if minter == "openssl" else have_cryptography
+        names = bench_args.openssl_names if minter == "openssl" else bench_args.names
+        label = minter + " " + key_type
+        with tempfile.TemporaryDirectory() as cert_dir:
+            handler = make_handler(cert_dir, key_type)
+            start = time.perf_counter()
+            handshake(handler, "warmup.example.com")  # Makes the root CA
+            print("{0:<36} {1:>9.2f} ms".format(label + ", root CA + 1st leaf",
+                                               (time.perf_counter() - start) * 1000))
+            report(label + ", new name",
+                   [handshake(handler, "new%d.example.com" % i) for i in range(names)])
+            handler = make_handler(cert_dir, key_type)  # Nothing in memory
+            report(label + ", on disk",
+                   [handshake(handler, "new%d.example.com" % i) for i in range(names)])
+            report(label + ", cached",
+                   [handshake(handler, "new%d.example.com" % i) for i in range(names)])
+    tls.x509 = have_cryptography
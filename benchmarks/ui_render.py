@@ -0,0 +1,66 @@
+"""
+Measure how many watched-only messages per second the user interface can put
+on the terminal: start ui_proc.user_interface() on a pseudo-terminal, queue up
+MESSAGES messages as fast as possible, and time until the last one has been
+printed.
+
+Run from the repository root: python benchmarks/ui_render.py
+"""
+import argparse
+import multiprocessing
+import os, sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ipc
+
+MESSAGES = int(os.environ.get("MESSAGES", 20000))
+MESSAGE = "b'" + "A" * 80 + "'"
+
+
+def run_ui(display_q, args, pty_sub):
+    # The user interface takes over whatever terminal is on stdin.
+    for fd in (0, 1, 2):
+        os.dup2(pty_sub, fd)
+    import ui_proc
+    ui_proc.user_interface(display_q, args)
+
+
+if __name__ == '__main__':
+    args = argparse.Namespace(intercept_client_keypress="c",
+                              intercept_server_keypress="s",
+                              client_color=13, server_color=14, error_color=9,
+                              notification_color=11, editor="true",
+                              headless=False)
+    args.intercept = ipc.InterceptState(client=False, server=False)
+    args.display_ring = ipc.DisplayRing(MESSAGES)
+
+    pty_main, pty_sub = os.openpty()
+    # Throw away whatever's printed so the UI never blocks on a full terminal.
+    threading.Thread(target=lambda: [os.read(pty_main, 65536) for _ in iter(int, 1)],
+                     daemon=True).start()
+
+    display_q = multiprocessing.Queue()
+    ui = multiprocessing.Process(target=run_ui, args=(display_q, args, pty_sub),
+                                 daemon=True)
+    ui.start()
+
+    # The UI replies to a registered channel once it gets to our last message.
+    done = ipc.ResultChannel()
+    display_q.put(("0client", done))
+    display_q.put(("0client", "ready"))
+    done.get()
+
+    start = time.perf_counter()
+    for i in range(MESSAGES):
+        args.display_ring.offer()
+        display_q.put(("View", ipc.View("0server", MESSAGE, 0, len(MESSAGE),
+                                        time.time(), "message")))
+    display_q.put(("0client", "done"))
+    done.get()
+    elapsed = time.perf_counter() - start
+    ui.terminate()
+
+    print("{0} messages in {1:.2f} s: {2:.0f} messages/s".format(
+          MESSAGES, elapsed, MESSAGES / elapsed))
@@ -0,0 +1,197 @@
+import curses
+import os
+
+# --editor builtin: a small curses editor that runs inside the user interface
+# process, so editing an intercepted message doesn't cost starting an editor
+# (and writing the message to a temporary file, and reading it back). curses is
+# set up once, the first time it's needed, and the terminal is only handed
+# back in between messages, so the editor's startup is paid once a session.
+#
+# It does about what you need for tampering with messages and nothing else:
+# long lines are soft wrapped (never hard wrapped, so rawbytes messages don't
+# get corrupted), arrow keys/Home/End/PgUp/PgDn move around, and
+#     Ctrl+X  sends the message as it is now
+#     Ctrl+R  reverts it to how it arrived
+#     Ctrl+K  deletes from the cursor to the end of the line
+
+SEND = "\x18"  # Ctrl+X
+REVERT = "\x12"  # Ctrl+R
+KILL_LINE = "\x0b"  # Ctrl+K
+
+session = None  # The BuiltinEditor, once there's been something to edit
+
+
+def edit(message, title=""):
+    """
+    Edit message (a string) in the built-in editor, returning the result.
+    """
+    global session
+    if session is None:
+        session = BuiltinEditor()
+    return session.edit(message, title)
+
+
+class BuiltinEditor():
+    """
+    One editing session. Only the editor thread of the user interface should
+    use it, and only while it has the terminal (see ui_utils.print_and_edit).
+    """
+    def __init__(self):
+        os.environ.setdefault("ESCDELAY", "25")  # Don't stall on a lone Esc
+        self.screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()  # Keep ctrl+c, which kills alsanna as usual (see ui_utils.abort)
+        self.screen.keypad(True)
+        curses.endwin()  # Until there's something to edit
+
+    def edit(self, message, title):
+        self.original = message
+        self.lines = message.split("\n")
+        self.y, self.x = 0, 0  # Cursor, as line and character within it
+        self.top = (0, 0)  # First line shown, and which of its rows
+        self.title = title
+        self.screen.clear()
+        try:
+            while True:
+                self.draw()
+                key = self.screen.get_wch()
+                if key == SEND:
+                    return "\n".join(self.lines)
+                self.handle(key)
+        finally:
+            curses.endwin()  # Give the terminal back for printing
+
+    ###########################################################################
+    # Soft wrapping. A line of n characters takes n // width + 1 rows, and the
+    # cursor at character x of a line is on row x // width of it.
+    ###########################################################################
+
+    def width(self):
+        return max(self.screen.getmaxyx()[1] - 1, 1)  # Room for the cursor
+
+    def height(self):
+        return max(self.screen.getmaxyx()[0] - 1, 1)  # Less the status line
+
+    def rows(self, line):
+        return len(self.lines[line]) // self.width() + 1
+
+    def rows_between(self, start, end):
+        """
+        How many rows down end, a (line, row) pair, is from start.
+        """
+        count = 0
+        line, row = start
+        while line < end[0]:
+            count += self.rows(line) - row
+            line, row = line + 1, 0
+        return count + end[1] - row
+
+    def scroll(self):
+        """
+        Move self.top so the cursor is on screen.
+        """
+        cursor = (self.y, self.x // self.width())
+        if cursor < self.top:
+            self.top = cursor
+        while self.rows_between(self.top, cursor) >= self.height():
+            line, row = self.top
+            self.top = (line, row + 1) if row + 1 < self.rows(line) else (line + 1, 0)
+
+    def draw(self):
+        width, height = self.width(), self.height()
+        if self.top[0] >= len(self.lines) or self.top[1] >= self.rows(self.top[0]):
+            # Deleting lines, or a wider terminal, left it past the end
+            self.top = (min(self.top[0], len(self.lines) - 1), 0)
+        self.scroll()
+        self.screen.erase()
+        line, row = self.top
+        for screen_row in range(height):
+            if line >= len(self.lines):
+                break
+            chunk = self.lines[line][row * width:(row + 1) * width]
+            # Anything the terminal would act on rather than print is shown
+            # as '?', so the screen never goes out of step with the buffer.
+            self.screen.addstr(screen_row, 0, "".join(
+                c if c.isprintable() else "?" for c in chunk))
+            line, row = (line, row + 1) if row + 1 < self.rows(line) else (line + 1, 0)
+        status = (" " + self.title + "  ^X send  ^R revert  ^K cut to end of line"
+                  + "  line " + str(self.y + 1) + "/" + str(len(self.lines)))
+        self.screen.addstr(height, 0, status[:width], curses.A_REVERSE)
+        self.screen.move(self.rows_between(self.top, (self.y, self.x // width)),
+                         self.x % width)
+        self.screen.refresh()
+
+    ###########################################################################
+    # Keys
+    ###########################################################################
+
+    def handle(self, key):
+        line = self.lines[self.y]
+        width = self.width()
+        if key == REVERT:
+            self.lines = self.original.split("\n")
+            self.y, self.x = 0, 0
+            self.top = (0, 0)
+        elif key == KILL_LINE:
+            self.lines[self.y] = line[:self.x]
+        elif key == curses.KEY_LEFT:
+            if self.x > 0:
+                self.x -= 1
+            elif self.y > 0:
+                self.y -= 1
+                self.x = len(self.lines[self.y])
+        elif key == curses.KEY_RIGHT:
+            if self.x < len(line):
+                self.x += 1
+            elif self.y < len(self.lines) - 1:
+                self.y, self.x = self.y + 1, 0
+        elif key == curses.KEY_UP:
+            self.up(width)
+        elif key == curses.KEY_DOWN:
+            self.down(width)
+        elif key == curses.KEY_PPAGE:
+            for i in range(self.height() - 1):
+                self.up(width)
+        elif key == curses.KEY_NPAGE:
+            for i in range(self.height() - 1):
+                self.down(width)
+        elif key == curses.KEY_HOME:
+            self.x -= self.x % width
+        elif key == curses.KEY_END:
+            self.x = min(self.x - self.x % width + width - 1, len(line))
+        elif key in (curses.KEY_BACKSPACE, "\x7f", "\x08"):
+            if self.x > 0:
+                self.lines[self.y] = line[:self.x - 1] + line[self.x:]
+                self.x -= 1
+            elif self.y > 0:  # Join onto the line above
+                self.y -= 1
+                self.x = len(self.lines[self.y])
+                self.lines[self.y] += self.lines.pop(self.y + 1)
+        elif key == curses.KEY_DC:
+            if self.x < len(line):
+                self.lines[self.y] = line[:self.x] + line[self.x + 1:]
+            elif self.y < len(self.lines) - 1:  # Join the line below onto this
+                self.lines[self.y] += self.lines.pop(self.y + 1)
+        elif key in (curses.KEY_ENTER, "\n", "\r"):
+            self.lines[self.y:self.y + 1] = [line[:self.x], line[self.x:]]
+            self.y, self.x = self.y + 1, 0
+        elif isinstance(key, str) and (key.isprintable() or key == "\t"):
+            self.lines[self.y] = line[:self.x] + key + line[self.x:]
+            self.x += 1
+        # Anything else (function keys, resizes, ...) just gets a redraw
+
+    def up(self, width):
+        if self.x >= width:  # Up a row within this line
+            self.x -= width
+        elif self.y > 0:  # To the same column on the last row of the line above
+            self.y -= 1
+            above = len(self.lines[self.y])
+            self.x = min(above - above % width + self.x, above)
+
+    def down(self, width):
+        line = len(self.lines[self.y])
+        if self.x // width < line // width:  # Down a row within this line
+            self.x = min(self.x + width, line)
+        elif self.y < len(self.lines) - 1:  # To the same column on the next line
+            self.y += 1
+            self.x = min(self.x % width, len(self.lines[self.y]))
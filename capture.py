@@ -0,0 +1,385 @@
+import mmap
+import multiprocessing
+import os, sys
+import struct
+import threading
+import time
+
+# --capture: a binary record of every message alsanna forwards, kept in one
+# file for the whole session however many processes are forwarding.
+#
+# Writers reserve room at the end of the file under a lock shared by every
+# process, writing the record's header there and then, then copy the payload
+# into their own memory map of the file without the lock, so recording a
+# message costs a short critical section and a memcpy. The type goes in last,
+# once the payload's there. The file grows EXTENT bytes at a time, and may end
+# in zeroes.
+#
+# The file is a header, then records, each RECORD bytes of header then its
+# payload, padded to a multiple of 8 bytes:
+#     type       MESSAGE or INDEX (or 0 if it isn't finished, or never will be
+#                if its writer died; it can still be skipped, by its length)
+#     role       for a MESSAGE, WATCHED, ORIGINAL, EDITED or UNCHANGED
+#     direction  CLIENT or SERVER, whichever sent it
+#     flags      NOT_WIRE if the payload isn't the bytes that went on the wire,
+#                because the handler couldn't say what those were
+#     length     of the payload
+#     connection the connection id
+#     timestamp  time.monotonic_ns() when it was recorded (never 0, so an all
+#                zero header is where the records end)
+# An intercepted message gets an ORIGINAL record as it arrives, then an EDITED
+# record of what was sent instead, or an empty UNCHANGED record. Messages that
+# were only watched get one WATCHED record, unless --rules changed them, in
+# which case they get an ORIGINAL and an EDITED record too.
+#
+# Every INDEX_EVERY messages, an INDEX record lists their timestamps and
+# offsets, and the offset of the index before it; the file header keeps the
+# offset of the latest. So a reader can find a point in time by walking the
+# indexes back instead of reading every record (see Reader.seek()).
+#
+# Run this file to look at a capture:
+#     python capture.py dump <capture>
+#     python capture.py pcapng <capture> <output.pcapng>
+
+MAGIC = b"ALSNCAP1"
+FILE_HEADER = struct.Struct("<8sIdQQ")  # magic, version, wall clock time and
+                                        # monotonic_ns at start, last index
+HEADER_SIZE = 64  # FILE_HEADER, padded
+LAST_INDEX = 28  # Where the last index offset is in the file header
+RECORD = struct.Struct("<BBBBIQQ")
+INDEX = struct.Struct("<QI")  # Offset of the previous index, entry count
+INDEX_ENTRY = struct.Struct("<QQ")  # timestamp, offset
+EXTENT = 64 * 1024 * 1024
+INDEX_EVERY = 1024
+INDEX_BODY = INDEX.size + INDEX_EVERY * INDEX_ENTRY.size
+STALE = 10 * 10**9  # ns after which a live reader gives up on an unfinished
+                    # record's writer, and skips it
+
+MESSAGE, INDEX_RECORD = 1, 2
+WATCHED, ORIGINAL, EDITED, UNCHANGED = 0, 1, 2, 3
+ROLES = ("watched", "original", "edited", "unchanged")
+CLIENT, SERVER = 0, 1
+NOT_WIRE = 1
+
+# Slots in Capture.state
+NEXT, SIZE, LAST, COUNT = range(4)
+
+
+def padded(length):
+    return (length + 7) & ~7
+
+
+class Capture():
+    """
+    The writing end of a capture. Made once by alsanna.main(), before any
+    connection process starts, and shared with all of them through args.
+    """
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, EXTENT)
+            os.pwrite(fd, FILE_HEADER.pack(MAGIC, 1, time.time(),
+                                           time.monotonic_ns(), 0), 0)
+        finally:
+            os.close(fd)
+        self.lock = multiprocessing.Lock()
+        self.state = multiprocessing.RawArray('Q', [HEADER_SIZE, EXTENT, 0, 0])
+        self.entries = multiprocessing.RawArray('Q', 2 * INDEX_EVERY)
+        self.local = None  # This process's map of the file, see mapping()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["local"] = None  # Maps don't cross processes
+        return state
+
+    def record(self, connection_id, direction, role, msg_obj, handler):
+        """
+        Record one message. msg_obj is what the last handler's recv() returned
+        (or a list of byte chunks read together), or None for UNCHANGED.
+        """
+        payload, flags = wire_bytes(msg_obj, handler)
+        length = sum(len(chunk) for chunk in payload)
+        size = RECORD.size + padded(length)
+        direction = SERVER if direction == "server" else CLIENT
+        index = None
+        with self.lock:
+            offset = self.state[NEXT]
+            timestamp = time.monotonic_ns()
+            count = self.state[COUNT]
+            self.entries[2 * count] = timestamp
+            self.entries[2 * count + 1] = offset
+            self.state[COUNT] = count + 1
+            end = offset + size
+            if count + 1 == INDEX_EVERY:
+                index = (end, self.state[LAST], self.entries[:])
+                end += RECORD.size + padded(INDEX_BODY)
+                self.state[LAST] = index[0]
+                self.state[COUNT] = 0
+            self.state[NEXT] = end
+            if end > self.state[SIZE]:
+                self.state[SIZE] = (end // EXTENT + 1) * EXTENT
+                os.truncate(self.path, self.state[SIZE])
+            # Headers go in before anyone can reserve past them, so however
+            # the rest goes, readers can tell where the next record starts.
+            with self.mapping(end) as buf:
+                buf[offset:offset + RECORD.size] = RECORD.pack(
+                    0, role, direction, flags, length, int(connection_id),
+                    timestamp)
+                if index is not None:
+                    buf[index[0]:index[0] + RECORD.size] = RECORD.pack(
+                        0, 0, 0, 0, INDEX_BODY, 0, timestamp)
+
+        with self.mapping(end) as buf:
+            position = offset + RECORD.size
+            for chunk in payload:
+                buf[position:position + len(chunk)] = chunk
+                position += len(chunk)
+            buf[offset] = MESSAGE  # Last, so readers never see half a record
+            if index is not None:
+                self.write_index(buf, *index)
+
+    def write_index(self, buf, offset, previous, entries):
+        body = INDEX.pack(previous, INDEX_EVERY) + struct.pack(
+            "<" + str(2 * INDEX_EVERY) + "Q", *entries)
+        buf[offset + RECORD.size:offset + RECORD.size + len(body)] = body
+        buf[offset] = INDEX_RECORD
+        buf[LAST_INDEX:LAST_INDEX + 8] = offset.to_bytes(8, "little")
+
+    def mapping(self, end):
+        """
+        This process's map of the file, remade if it doesn't reach end yet,
+        held for as long as the with block. Threads in one process share it.
+        """
+        if self.local is None or self.local["pid"] != os.getpid():
+            self.local = {"pid": os.getpid(), "lock": threading.Lock(),
+                          "map": None}
+        return Mapping(self.path, self.local, end)
+
+
+class Mapping():
+    """
+    Holds a process's map of the capture (see Capture.mapping()) for a with
+    block, remapping first if the file's grown past it.
+    """
+    def __init__(self, path, local, end):
+        self.path = path
+        self.local = local
+        self.end = end
+
+    def __enter__(self):
+        self.local["lock"].acquire()
+        try:
+            if self.local["map"] is None or len(self.local["map"]) < self.end:
+                if self.local["map"] is not None:
+                    self.local["map"].close()
+                with open(self.path, "r+b") as f:
+                    self.local["map"] = mmap.mmap(f.fileno(), 0)
+        except:
+            self.local["lock"].release()
+            raise
+        return self.local["map"]
+
+    def __exit__(self, *exc):
+        self.local["lock"].release()
+
+
+def wire_bytes(msg_obj, handler):
+    """
+    The bytes of a message as a list of chunks, and flags to record with them.
+    Handlers whose messages aren't bytes can say what they look like on the
+    wire with obj_to_bytes() (see handlers/prototype); failing that, we record
+    str() of the message and flag it NOT_WIRE.
+    """
+    if msg_obj is None:
+        return [], 0
+    if isinstance(msg_obj, list):
+        return msg_obj, 0
+    if isinstance(msg_obj, (bytes, bytearray, memoryview)):
+        return [msg_obj], 0
+    if hasattr(handler, "obj_to_bytes"):
+        return [handler.obj_to_bytes(msg_obj)], 0
+    return [str(msg_obj).encode("utf-8", "backslashreplace")], NOT_WIRE
+
+
+###############################################################################
+# Reading captures back
+###############################################################################
+
+class Reader():
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.wall_start, self.monotonic_start, last = \
+            FILE_HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(path + " isn't an alsanna capture")
+
+    def refresh(self):
+        """
+        Map the file again if it's grown since we mapped it, for reading a
+        capture that's still being written.
+        """
+        if os.path.getsize(self.path) > len(self.map):
+            self.map.close()
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def records(self, offset=HEADER_SIZE, live=False):
+        """
+        Yield (offset, type, role, direction, flags, connection, timestamp,
+        payload) for each finished record from offset on, skipping those that
+        aren't, whose writers died halfway. If live, the capture's still being
+        written, so stop at the first record that isn't finished yet rather
+        than skipping it, unless it's been unfinished for longer than STALE;
+        the offset after the last record yielded is where to carry on from
+        later.
+        """
+        while offset + RECORD.size <= len(self.map):
+            rtype, role, direction, flags, length, connection, timestamp = \
+                RECORD.unpack_from(self.map, offset)
+            if timestamp == 0:
+                return  # The end of what was written
+            if rtype == 0 and live and time.monotonic_ns() - timestamp < STALE:
+                return  # Still being written, most likely
+            start = offset + RECORD.size
+            if rtype:
+                yield (offset, rtype, role, direction, flags, connection,
+                       timestamp, self.map[start:start + length])
+            offset = start + padded(length)
+
+    def messages(self, offset=HEADER_SIZE, live=False):
+        for record in self.records(offset, live):
+            if record[1] == MESSAGE:
+                yield record
+
+    def seek(self, timestamp):
+        """
+        The offset of a record no later than the first one at or after
+        timestamp (monotonic_ns), found through the indexes, so that reading
+        messages() from there soon gets there.
+        """
+        index = int.from_bytes(self.map[LAST_INDEX:LAST_INDEX + 8], "little")
+        while index:
+            previous, count = INDEX.unpack_from(self.map, index + RECORD.size)
+            entries = struct.unpack_from("<" + str(2 * count) + "Q", self.map,
+                                         index + RECORD.size + INDEX.size)
+            if entries[0] <= timestamp:
+                for i in range(count - 1, -1, -1):
+                    if entries[2 * i] <= timestamp:
+                        return entries[2 * i + 1]
+            index = previous
+        return HEADER_SIZE
+
+    def close(self):
+        self.map.close()
+
+
+def dump(path):
+    reader = Reader(path)
+    for offset, rtype, role, direction, flags, connection, timestamp, payload \
+            in reader.messages():
+        print("{0:.6f} {1}{2} {3}{4} {5} bytes: {6}".format(
+              (timestamp - reader.monotonic_start) / 1e9, connection,
+              "server" if direction == SERVER else "client", ROLES[role],
+              " (not wire bytes)" if flags & NOT_WIRE else "", len(payload),
+              payload[:64]))
+    reader.close()
+
+
+###############################################################################
+# pcapng export. Each message becomes TCP segments between made-up hosts
+# (10.0.0.1, the client, port 10000 + connection id, and 10.0.0.2, the server,
+# port 1) in a raw IPv4 capture, so Wireshark can follow the streams and
+# dissect the protocol. What's exported is what was sent on: EDITED bytes for
+# edited messages, ORIGINAL for unchanged ones. Edited messages get a comment.
+###############################################################################
+
+LINKTYPE_RAW = 101
+MAX_SEGMENT = 65535 - 40
+
+
+def pcapng_block(block_type, body):
+    body += b"\0" * (-len(body) % 4)
+    length = 12 + len(body)
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+
+def pcapng_comment(text):
+    text = text.encode("utf-8")
+    return (struct.pack("<HH", 1, len(text)) + text + b"\0" * (-len(text) % 4)
+            + struct.pack("<HH", 0, 0))
+
+
+def ipv4_checksum(header):
+    total = sum(struct.unpack("!10H", header))
+    total = (total & 0xffff) + (total >> 16)
+    total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def tcp_segment(src, dst, sport, dport, seq, ack, payload):
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, seq & 0xffffffff,
+                      ack & 0xffffffff, 5 << 4, 0x18, 65535, 0, 0)  # PSH, ACK
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp) + len(payload), 0,
+                     0x4000, 64, 6, 0, src, dst)
+    ip = ip[:10] + struct.pack("!H", ipv4_checksum(ip)) + ip[12:]
+    return ip + tcp + payload
+
+
+def export_pcapng(path, out_path):
+    reader = Reader(path)
+    client, server = bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2])
+    sequence = {}  # (connection, direction): next sequence number
+    pending = {}  # (connection, direction): ORIGINAL waiting for its outcome
+    with open(out_path, "wb") as out:
+        out.write(pcapng_block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+        out.write(pcapng_block(1, struct.pack("<HHI", LINKTYPE_RAW, 0, 0)
+                               + struct.pack("<HHB3x", 9, 1, 9)  # if_tsresol: ns
+                               + struct.pack("<HH", 0, 0)))
+        for offset, rtype, role, direction, flags, connection, timestamp, payload \
+                in reader.messages():
+            key = (connection, direction)
+            if role == ORIGINAL:
+                pending[key] = payload
+                continue
+            comment = None
+            if role == UNCHANGED:
+                data = pending.pop(key, b"")
+            elif role == EDITED:
+                original = pending.pop(key, b"")
+                data = payload
+                comment = ("edited by alsanna; originally " + str(len(original))
+                           + " bytes")
+            else:
+                data = payload
+            ports = (10000 + connection % 55000, 1)
+            if direction == CLIENT:
+                src, dst, sport, dport = client, server, ports[0], ports[1]
+            else:
+                src, dst, sport, dport = server, client, ports[1], ports[0]
+            wall = int(reader.wall_start * 1e9) + timestamp - reader.monotonic_start
+            for start in range(0, max(len(data), 1), MAX_SEGMENT):
+                chunk = data[start:start + MAX_SEGMENT]
+                seq = sequence.get(key, 1)
+                packet = tcp_segment(src, dst, sport, dport, seq,
+                                     sequence.get((connection, 1 - direction), 1),
+                                     chunk)
+                sequence[key] = seq + len(chunk)
+                options = pcapng_comment(comment) if comment else b""
+                out.write(pcapng_block(6, struct.pack(
+                    "<IIIII", 0, wall >> 32, wall & 0xffffffff, len(packet),
+                    len(packet)) + packet + b"\0" * (-len(packet) % 4) + options))
+                comment = None  # Once per message is plenty
+    reader.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "dump":
+        dump(sys.argv[2])
+    elif len(sys.argv) == 4 and sys.argv[1] == "pcapng":
+        export_pcapng(sys.argv[2], sys.argv[3])
+    else:
+        print("Usage: python capture.py dump <capture>\n"
+              "       python capture.py pcapng <capture> <output.pcapng>")
@@ -1,7 +1,7 @@
 import os
 import traceback
-import socket
-import threading, multiprocessing
+import threading
+import ipc, cnxn_utils, capture
 
 def manage_connections(listen_sock, display_q, connection_id, args):
     """
@@ -17,65 +17,143 @@ def manage_connections(listen_sock, display_q, connection_id, args):
     """
 
     # Keep track of anything needed for maintaining state.
-    cnxn_locals = {'cnxn_id': str(connection_id)}
+    cnxn_locals = {'cnxn_id': str(connection_id), 'display_q': display_q}
 
-    q_manager = multiprocessing.Manager()
-    c_result_q = q_manager.Queue()
-    display_q.put((cnxn_locals['cnxn_id'] + "client", c_result_q))
-    s_result_q = q_manager.Queue()
-    display_q.put((cnxn_locals['cnxn_id'] + "server", s_result_q))
+    # Registered with the user interface by forward() once they're needed.
+    c_result_q = ipc.ResultChannel(payload_size=args.payload_size)
+    s_result_q = ipc.ResultChannel(payload_size=args.payload_size)
 
-    sockets = {"client": {"sock": listen_sock},
+    sockets = {"client": {"sock": listen_sock,
+                          "sizer": cnxn_utils.ReadSizer(args),
+                          "watched": {"skipped": 0}},
                "server": {"sock": None,
-                          "connected": threading.Event()}}
+                          "sizer": cnxn_utils.ReadSizer(args),
+                          "watched": {"skipped": 0},
+                          "connected": threading.Event(),
+                          "connector": None}}  # Thread for --eager_connect
+
+    # With --eager_connect, get the server connection going while the client's
+    # handshake happens, if the handler chain doesn't need the handshake first.
+    if args.eager_connect and cnxn_utils.connect_early(args):
+        start_connector(sockets, display_q, cnxn_locals, args)
 
     with sockets["client"]["sock"]:  # TODO: Consider moving this inside forward() like its sibling
         try:
-            for handler in args.handlers:
-                sockets["client"]["sock"] = handler.setup_client_facing(
-                    listen_sock=sockets["client"]["sock"],
-                    cnxn_locals=cnxn_locals
-                )
-        except:
-            display_q.put(("Err", ("Error setting up listener.",
-                                   traceback.format_exc())
-                            ))
-            return
+            try:
+                for handler in args.handlers:
+                    sockets["client"]["sock"] = handler.setup_client_facing(
+                        listen_sock=sockets["client"]["sock"],
+                        cnxn_locals=cnxn_locals
+                    )
+            except:
+                display_q.put(("Err", ("Error setting up listener.",
+                                       traceback.format_exc())
+                                ))
+                if sockets["server"]["connector"] is not None:
+                    sockets["server"]["connector"].join()
+                cleanup(sockets, "client", "server")
+                return
 
-        c_to_s_thread = threading.Thread(target=forward,
-                                         kwargs={"sockets": sockets,
-                                                 "listen": "client",
-                                                 "send": "server",
-                                                 "display_q": display_q,
-                                                 "result_q": c_result_q,
-                                                 "cnxn_locals": cnxn_locals,
-                                                 "args": args},
-                                         daemon=True)
-        s_to_c_thread = threading.Thread(target=forward,
-                                         kwargs={"sockets": sockets,
-                                                 "listen": "server",
-                                                 "send": "client",
-                                                 "display_q": display_q,
-                                                 "result_q": s_result_q,
-                                                 "cnxn_locals": cnxn_locals,
-                                                 "args": args},
-                                         daemon=True)
+            if args.eager_connect and sockets["server"]["connector"] is None:
+                start_connector(sockets, display_q, cnxn_locals, args)
+
+            c_to_s_thread = threading.Thread(target=forward,
+                                             kwargs={"sockets": sockets,
+                                                     "listen": "client",
+                                                     "send": "server",
+                                                     "display_q": display_q,
+                                                     "result_q": c_result_q,
+                                                     "cnxn_locals": cnxn_locals,
+                                                     "args": args},
+                                             daemon=True)
+            s_to_c_thread = threading.Thread(target=forward,
+                                             kwargs={"sockets": sockets,
+                                                     "listen": "server",
+                                                     "send": "client",
+                                                     "display_q": display_q,
+                                                     "result_q": s_result_q,
+                                                     "cnxn_locals": cnxn_locals,
+                                                     "args": args},
+                                             daemon=True)
 
-        try:
             c_to_s_thread.start()
-            sockets["server"]["connected"].wait() # Wait for connection to server
-            s_to_c_thread.start()                 # Only now begin server->client
+            # Only begin server->client once there's a server to listen to, or
+            # give up on it once nothing is going to connect to the server any
+            # more (e.g. the client hung up before saying anything).
+            while not sockets["server"]["connected"].wait(timeout=1):
+                connector = sockets["server"]["connector"]
+                if not c_to_s_thread.is_alive() \
+                   and (connector is None or not connector.is_alive()):
+                    break
+            if sockets["server"]["connected"].is_set():
+                s_to_c_thread.start()
+                s_to_c_thread.join()
             c_to_s_thread.join()
-            s_to_c_thread.join()
         except:
             display_q.put(("Err", ("Forwarder " + cnxn_locals["cnxn_id"] + "dying.",
                                    traceback.format_exc())
                             ))
+        finally:
+            for host in ("client", "server"):  # Nothing left to carry the counts
+                cnxn_utils.report_skipped(host, display_q, cnxn_locals,
+                                          sockets[host]["watched"])
+            if args.connection_stats:
+                display_q.put(("Note", "Connection " + cnxn_locals['cnxn_id']
+                                       + " client: " + sockets["client"]["sizer"].summary()
+                                       + "\nConnection " + cnxn_locals['cnxn_id']
+                                       + " server: " + sockets["server"]["sizer"].summary()))
+            # Connections can outlive their process's other connections when
+            # run by a worker, so always let go of the channels on both ends.
             display_q.put(("Kill", cnxn_locals['cnxn_id'] + "client"))
             display_q.put(("Kill", cnxn_locals['cnxn_id'] + "server"))
+            c_result_q.close()
+            s_result_q.close()
         return
 
 
+def start_connector(sockets, display_q, cnxn_locals, args):
+    """
+    Start connecting to the server in the background, for --eager_connect.
+    Whoever needs the server first can join() sockets["server"]["connector"].
+    """
+    sockets["server"]["connector"] = threading.Thread(target=connect_server,
+                                                      args=(sockets,
+                                                            display_q,
+                                                            cnxn_locals,
+                                                            args),
+                                                      daemon=True)
+    sockets["server"]["connector"].start()
+
+
+def connect_server(sockets, display_q, cnxn_locals, args):
+    """
+    Set up the server-facing socket and connect it to the server, letting
+    anyone waiting on sockets["server"]["connected"] know once it's ready.
+    Returns whether that worked.
+    """
+    try:
+        sockets["server"]["sock"] = cnxn_utils.setup_server_facing(cnxn_locals,
+                                                                   args)
+    except:
+        display_q.put(("Err", ("Error connecting to server.",
+                               traceback.format_exc())
+                        ))
+        return False
+    sockets["server"]["connected"].set()
+    return True
+
+
+def next_connection_id(cnxn_counter):
+    """
+    Hand out the next connection id from the counter shared by every process
+    that accepts connections.
+    """
+    with cnxn_counter.get_lock():
+        connection_id = cnxn_counter.value
+        cnxn_counter.value += 1
+    return connection_id
+
+
 def forward(sockets, listen, send, display_q, result_q, cnxn_locals, args):
     """
     Forwards a TCP stream in one direction, from listen to send.
@@ -96,38 +174,84 @@ def forward(sockets, listen, send, display_q, result_q, cnxn_locals, args):
 
     cnxn_locals is a dictionary which holds any state that needs to be shared
     across different handlers or by alsanna itself.
+
+    Messages only make the round trip through the user interface while this
+    direction is intercepted. Otherwise they're sent on immediately and the
+    user interface is just told what went past (see --watch_mode).
     """
+    watched = sockets[listen]["watched"]  # Messages the UI had no room for
     while True:
         msg_obj = None
         if os.getppid() == 1: # If orphaned, clean up toys and die
             cleanup(sockets, listen, send)
             return
         try:
-            msg_obj = sockets[listen]["sock"].recv(args.read_size)
+            if not args.intercept[listen] and args.watch_mode == "summary" \
+               and sockets[send]["sock"] is not None:
+                if not cnxn_utils.pass_through(sockets[listen]["sock"],
+                                               sockets[send]["sock"], listen,
+                                               display_q, cnxn_locals,
+                                               sockets[listen]["sizer"], args):
+                    cnxn_utils.half_close(sockets[send]["sock"])
+                    return  # Stream closed while passing through
+                continue  # Interception was switched back on
+
+            msg_obj = sockets[listen]["sock"].recv(sockets[listen]["sizer"].size)
             if msg_obj is None:
+                if sockets[send].get("connector") is not None:
+                    sockets[send]["connector"].join()  # Hang up on it too
+                cnxn_utils.half_close(sockets[send]["sock"])
                 return
+            sockets[listen]["sizer"].update(cnxn_utils.message_size(msg_obj))
+
+            intercept = args.intercept[listen]
+            if not intercept:  # Just watching; nothing will come back
+                msg_obj = cnxn_utils.coalesce(sockets[listen]["sock"], msg_obj,
+                                              sockets[listen]["sizer"], args)
+            # --rules get the first go, and can also decide about interception.
+            msg_obj, intercept, rewritten = cnxn_utils.rewrite(msg_obj, listen,
+                                                               intercept,
+                                                               cnxn_locals, args)
+            if msg_obj is None:
+                continue  # Dropped by a rule
 
-            readable, unprintable_state = args.handlers[-1].obj_to_printable(msg_obj)
-            display_q.put((cnxn_locals['cnxn_id']+listen, readable))
-            readable = result_q.get()  # Blocks until message available
-            msg_obj = args.handlers[-1].printable_to_obj(readable, unprintable_state)
-            # Set up socket to talk to server, typically on first iteration
-            # If server talks first, this needs to change
-            if listen == "client" and sockets["server"]["sock"] is None:
-                sockets["server"]["sock"] = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-                try:
-                    for handler in args.handlers:
-                        sockets["server"]["sock"] = handler.setup_server_facing(
-                            send_sock=sockets["server"]["sock"],
-                            cnxn_locals=cnxn_locals
-                        )
-                    sockets["server"]["sock"].connect((args.server_ip,
-                                                       args.server_port))
-                    sockets["server"]["connected"].set()
-                except:
-                    display_q.put(("Err", ("Error setting up listener.",
-                                           traceback.format_exc())
-                                    ))
+            if intercept:
+                if not rewritten:  # Otherwise rewrite() recorded the original
+                    cnxn_utils.record(msg_obj, listen, capture.ORIGINAL,
+                                      cnxn_locals, args)
+                readable, unprintable_state = args.handlers[-1].obj_to_printable(msg_obj)
+                result_q.register(display_q, cnxn_locals['cnxn_id']+listen)
+                display_q.put((cnxn_locals['cnxn_id']+listen,
+                               result_q.wrap(readable)))
+                readable = result_q.unwrap(result_q.get())  # Blocks until message available
+                if readable is not None:  # None if it came back unchanged
+                    msg_obj = args.handlers[-1].printable_to_obj(readable, unprintable_state)
+                    cnxn_utils.record(msg_obj, listen, capture.EDITED,
+                                      cnxn_locals, args)
+                elif rewritten:
+                    cnxn_utils.record(msg_obj, listen, capture.EDITED,
+                                      cnxn_locals, args)
+                else:
+                    cnxn_utils.record(None, listen, capture.UNCHANGED,
+                                      cnxn_locals, args)
+            else:
+                cnxn_utils.record(msg_obj, listen,
+                                  capture.EDITED if rewritten else capture.WATCHED,
+                                  cnxn_locals, args)
+                cnxn_utils.watch(msg_obj, listen, display_q, cnxn_locals,
+                                 watched, args)
+            # Set up socket to talk to server, typically on first iteration,
+            # unless --eager_connect already has (in which case the server
+            # may also have talked first).
+            if listen == "client" and not sockets["server"]["connected"].is_set():
+                if sockets["server"]["connector"] is not None:
+                    sockets["server"]["connector"].join()
+                    connected = sockets["server"]["connected"].is_set()
+                else:
+                    connected = connect_server(sockets, display_q, cnxn_locals,
+                                               args)
+                if not connected:
+                    msg_obj = None  # Nowhere to send it
                     return
         except:
             display_q.put(("Err", ("Error in forwarder.",
@@ -137,7 +261,8 @@ def forward(sockets, listen, send, display_q, result_q, cnxn_locals, args):
         finally:
             try:
                 if msg_obj is not None:  # We got a message but had an error after
-                    sockets[send]["sock"].send(msg_obj)
+                    cnxn_utils.send_message(sockets[send]["sock"], msg_obj,
+                                            sockets[listen]["sizer"])
             except:
                 display_q.put(("Err", ("Error sending data.",
                                         traceback.format_exc())
@@ -0,0 +1,480 @@
+import os
+import ipc, capture
+import select
+import socket
+import ssl
+import time
+from handlers import buffering, preview
+
+###############################################################################
+# Helpers for cnxn_proc.forward(), mostly concerned with moving traffic that
+# isn't being intercepted as cheaply as possible.
+###############################################################################
+
+def setup_server_facing(cnxn_locals, args):
+    """
+    Run the server-facing half of the handler chain and connect to the server,
+    returning the last handler's socket.
+    """
+    send_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+    try:
+        for handler in args.handlers:
+            send_sock = handler.setup_server_facing(send_sock=send_sock,
+                                                    cnxn_locals=cnxn_locals)
+        send_sock.connect((args.server_ip, args.server_port))
+    except:
+        send_sock.close()
+        raise
+    return send_sock
+
+
+def connect_early(args):
+    """
+    Whether --eager_connect can set up the server-facing socket at the same
+    time as the client-facing one, rather than only after it (see
+    needs_client_handshake in handlers/prototype).
+    """
+    return not any(getattr(handler, "needs_client_handshake", False)
+                   for handler in args.handlers)
+
+
+def watch(msg_obj, listen, display_q, cnxn_locals, watched, args):
+    """
+    Show the user interface a message it isn't going to intercept, if it has
+    room for it. If it doesn't, the message is only counted in
+    watched["skipped"], and the count goes along with the next message shown
+    (or, if there isn't one, report_skipped() has it).
+
+    msg_obj may also be a list of byte chunks that were coalesced into one send;
+    these are only joined up if they're actually going to be displayed.
+    """
+    if not args.display_ring.offer():
+        watched["skipped"] += 1
+        return
+    if isinstance(msg_obj, list):
+        msg_obj = b''.join(msg_obj)
+    size = message_size(msg_obj)
+    if args.session_log_raw and size is not None:
+        readable = bytes(msg_obj)  # Recorded as-is, never made printable
+    else:
+        readable = displayable(msg_obj, args)
+    display_q.put(("View", ipc.View(cnxn_locals['cnxn_id']+listen, readable,
+                                    watched["skipped"], size, time.time(),
+                                    "message")))
+    watched["skipped"] = 0
+
+
+def report_skipped(listen, display_q, cnxn_locals, watched):
+    """
+    Once a direction's done, tell the user interface how many messages watch()
+    skipped since the last one it showed, if any, since there won't be another
+    message for the count to go along with.
+    """
+    if watched["skipped"]:
+        display_q.put(("Note", "[" + str(watched["skipped"]) + " messages from "
+                               + cnxn_locals['cnxn_id'] + listen + " not "
+                               "displayed to keep up]"))
+        watched["skipped"] = 0
+
+
+def displayable(msg_obj, args):
+    """
+    A printable form of a watched message, cut down to about args.display_budget
+    bytes (see handlers/preview.py). Handlers with an obj_to_preview() only make
+    printable what's shown; for the rest, the whole message is made printable
+    and then cut down, which at least saves sending it all to the terminal.
+    """
+    handler = args.handlers[-1]
+    if args.display_budget <= 0:
+        return handler.obj_to_printable(msg_obj)[0]
+    if hasattr(handler, "obj_to_preview"):
+        return handler.obj_to_preview(msg_obj, args.display_budget)
+    return preview.elide_text(handler.obj_to_printable(msg_obj)[0],
+                              args.display_budget)
+
+
+def record(msg_obj, listen, role, cnxn_locals, args):
+    """
+    Record a message in the --capture, if there is one. role is one of
+    capture.WATCHED, ORIGINAL, EDITED or UNCHANGED.
+    """
+    if args.capture is not None:
+        args.capture.record(cnxn_locals['cnxn_id'], listen, role, msg_obj,
+                            args.handlers[-1])
+
+
+def rewrite(msg_obj, listen, intercept, cnxn_locals, args):
+    """
+    Apply the --rules, if there are any, to a message as it arrives. intercept
+    is whether it'd be intercepted without them. If the rules change it, the
+    message as it arrived is recorded in the --capture as the ORIGINAL, and
+    what they made of it is later recorded as EDITED.
+
+    Returns the message to carry on with (None if a rule dropped it), whether
+    to intercept it, and whether the rules changed it.
+    """
+    if args.rules is None:
+        return msg_obj, intercept, False
+    return args.rules.apply(
+        msg_obj, listen, intercept,
+        on_change=lambda original: record(original, listen, capture.ORIGINAL,
+                                          cnxn_locals, args))
+
+
+def report_rules(display_q, args):
+    """
+    Note the --rules hit counts every args.rules_report seconds, whenever
+    they've changed. Runs in a thread of alsanna's main process.
+    """
+    reported = list(args.rules.hits)
+    while True:
+        time.sleep(args.rules_report)
+        hits = list(args.rules.hits)
+        if hits != reported:
+            display_q.put(("Note", args.rules.report()))
+            reported = hits
+
+
+class ReadSizer():
+    """
+    Picks how much to ask for on each read in one direction of a connection.
+    Starts at args.read_size, doubles (up to args.max_read_size) whenever a read
+    fills what was asked for, and halves (back down to args.read_size) whenever
+    a read uses less than a quarter of it. So bulk transfers quickly move to
+    big reads, and chatty protocols don't hold on to big buffers.
+
+    Also keeps the per-direction statistics reported with --connection_stats.
+    """
+    def __init__(self, args):
+        self.floor = args.read_size
+        self.ceiling = max(args.max_read_size, args.read_size)
+        self.size = self.floor
+        self.largest = self.size  # Largest size we've asked for
+        self.reads = 0
+        self.bytes = 0
+        self.sends = 0
+        self.chunks = 0  # Reads that went out in those sends
+
+    def update(self, num_bytes):
+        """
+        Record a read of num_bytes, or of a message with no meaningful size if
+        num_bytes is None, and adjust the size for the next read.
+        """
+        self.reads += 1
+        if num_bytes is None:
+            return
+        self.bytes += num_bytes
+        if num_bytes >= self.size:
+            self.size = min(self.size * 2, self.ceiling)
+            self.largest = max(self.largest, self.size)
+        elif num_bytes < self.size // 4:
+            self.size = max(self.size // 2, self.floor)
+
+    def sent(self, chunks):
+        self.sends += 1
+        self.chunks += chunks
+
+    def summary(self):
+        return (str(self.reads) + " reads (" + str(self.bytes) + " bytes) of up to "
+                + str(self.floor) + "-" + str(self.largest) + " bytes, now "
+                + str(self.size) + "; " + str(self.sends) + " sends carrying "
+                + str(self.chunks) + " reads")
+
+
+def message_size(msg_obj):
+    """
+    The size of a message in bytes if it's made of bytes, otherwise None.
+    """
+    if isinstance(msg_obj, (bytes, bytearray, memoryview)):
+        return len(msg_obj)
+    return None
+
+
+def raw_socket(handler_sock):
+    """
+    The plain TCP socket beneath a handler socket if the handler chain adds
+    nothing on top of it (see passthrough_socket() in handlers/prototype),
+    otherwise None.
+    """
+    return getattr(handler_sock, "passthrough_socket", lambda: None)()
+
+
+def coalesce(listen_sock, msg_obj, sizer, args):
+    """
+    If msg_obj is a small read, keep reading whatever else arrives within
+    args.coalesce_budget milliseconds, up to the current read size in total, so
+    it can all go out in one send and be displayed as one message. Only
+    possible when we can see readiness on the socket beneath listen_sock.
+
+    Returns msg_obj as-is, or a list of the chunks read starting with msg_obj.
+    """
+    raw = raw_socket(listen_sock)
+    if args.coalesce_budget <= 0 or raw is None or message_size(msg_obj) is None:
+        return msg_obj
+    chunks = [msg_obj]
+    total = len(msg_obj)
+    deadline = time.monotonic() + args.coalesce_budget / 1000
+    while total < sizer.size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([raw], [], [], remaining)[0]:
+            break
+        chunk = listen_sock.recv(sizer.size - total)
+        if chunk is None:  # Closed; the next recv() will say so again
+            break
+        sizer.update(len(chunk))
+        chunks.append(chunk)
+        total += len(chunk)
+    return chunks if len(chunks) > 1 else msg_obj
+
+
+def send_message(send_sock, msg_obj, sizer=None):
+    """
+    Send msg_obj on a handler socket. If msg_obj is a list of coalesced chunks,
+    they go out in a single sendmsg() when there's a plain TCP socket to use,
+    or joined up into one send() otherwise.
+    """
+    if not isinstance(msg_obj, list):
+        send_sock.send(msg_obj)
+    elif raw_socket(send_sock) is not None:
+        sendmsg_all(raw_socket(send_sock), msg_obj)
+    else:
+        send_sock.send(b''.join(msg_obj))
+    if sizer is not None:
+        sizer.sent(len(msg_obj) if isinstance(msg_obj, list) else 1)
+
+
+def half_close(send_sock):
+    """
+    Once the host we were listening to has closed its end of the stream, pass
+    that on by shutting down our sending side of send_sock, so the host at the
+    other end sees the stream end too (and, typically, hangs up itself, which
+    ends the other direction). Only possible when the handler chain is plain
+    TCP; otherwise the other end isn't told, as before.
+    """
+    raw = raw_socket(send_sock) if send_sock is not None else None
+    if raw is None:
+        return
+    try:
+        raw.shutdown(socket.SHUT_WR)
+    except OSError:  # Already gone
+        pass
+
+
+def sendmsg_all(raw, chunks):
+    """
+    Like sendall(), for a list of buffers sent with scatter/gather I/O.
+    """
+    views = [memoryview(chunk) for chunk in chunks]
+    while views:
+        sent = raw.sendmsg(views)
+        while views and sent >= len(views[0]):  # Drop buffers sent in full
+            sent -= len(views.pop(0))
+        if views and sent:  # And skip the part of the next one that was sent
+            views[0] = views[0][sent:]
+
+
+###############################################################################
+# --watch_mode summary
+###############################################################################
+
+# Longest pass_through() waits for data before checking whether interception
+# has been switched back on, in seconds.
+INTERCEPT_CHECK = 0.1
+
+
+def pass_through(listen_sock, send_sock, listen, display_q, cnxn_locals, sizer,
+                 args):
+    """
+    Move data from listen_sock to send_sock as fast as we're able for as long
+    as listen isn't intercepted, only telling the user interface how much went
+    past: the first read straight away, then at most every
+    args.summary_interval seconds, with whatever's left over reported once we
+    stop. listen_sock and send_sock are the last handler's sockets.
+
+    If the handler chain adds nothing on top of plain TCP, bytes never leave the
+    kernel (os.splice) or at least never get copied into a fresh object
+    (recv_into a reused buffer). Otherwise, messages are shuttled between the
+    handler sockets without ever being made printable.
+
+    Returns True if interception was switched back on, or False if listen
+    closed the stream.
+    """
+    listen_raw = raw_socket(listen_sock)
+    send_raw = raw_socket(send_sock)
+    if listen_raw is not None and send_raw is not None:
+        if hasattr(os, "splice"):  # Linux, Python 3.10+
+            mover = SpliceMover(listen_raw, send_raw, sizer, args)
+        else:
+            mover = BufferMover(listen_raw, send_raw, sizer, args)
+    else:
+        mover = HandlerMover(listen_sock, send_sock, sizer, args)
+
+    passed = {"bytes": 0, "reads": 0}
+    last_summary = None  # Report the first read straight away
+    try:
+        while not args.intercept[listen]:
+            # Only move once there's something to, so switching interception
+            # on catches the very next message rather than the one after.
+            if not readable(listen_sock, INTERCEPT_CHECK):
+                continue
+            try:
+                moved = mover.move()
+            except ConnectionResetError:
+                moved = None
+            if moved is None:
+                return False
+            passed["bytes"] += moved
+            passed["reads"] += 1
+            if last_summary is None \
+               or time.monotonic() - last_summary >= args.summary_interval:
+                summarize(passed, listen, display_q, cnxn_locals, args)
+                last_summary = time.monotonic()
+        return True
+    finally:
+        summarize(passed, listen, display_q, cnxn_locals, args)
+        mover.close()
+
+
+def recv_source(handler_sock):
+    """
+    Looks down through each handler's underlying transport (its sock) for
+    where handler_sock's next recv() will come from. Returns whether any bytes
+    are buffered already along the way, and the kernel socket at the bottom,
+    or None if there isn't one to find.
+    """
+    layer = handler_sock
+    while not isinstance(layer, socket.socket):
+        recv_buf = getattr(getattr(layer, "frames", layer), "recv_buf", None)
+        if isinstance(recv_buf, buffering.RecvBuffer) and len(recv_buf):
+            return True, None
+        layer = getattr(layer, "sock", None)
+        if layer is None:
+            return False, None
+    if isinstance(layer, ssl.SSLSocket) and layer.pending():
+        return True, layer  # Decrypted already, so select() wouldn't see it
+    return False, layer
+
+
+def readable(handler_sock, timeout):
+    """
+    Whether handler_sock has anything to recv() within timeout seconds, as far
+    as we can tell: bytes already buffered by a handler, or the kernel socket
+    at the bottom (see recv_source()) select()ing as readable. If there isn't
+    one to find, says True, and recv() blocks the way it always did.
+    """
+    buffered, kernel_sock = recv_source(handler_sock)
+    if buffered or kernel_sock is None:
+        return True
+    return bool(select.select([kernel_sock], [], [], timeout)[0])
+
+
+def summarize(passed, listen, display_q, cnxn_locals, args):
+    """
+    Tell the user interface how much has been passed through since we last
+    did, then reset the counts.
+    """
+    if passed["reads"] == 0 or not args.display_ring.offer():
+        return  # If the user interface is behind, keep counting for next time
+    display_q.put(("View", ipc.View(cnxn_locals['cnxn_id']+listen,
+                                    "[passed through " + str(passed["bytes"])
+                                    + " bytes in " + str(passed["reads"])
+                                    + " reads]", 0, passed["bytes"], time.time(),
+                                    "summary")))
+    passed["bytes"] = 0
+    passed["reads"] = 0
+
+
+class SpliceMover():
+    """
+    Moves up to a read's worth of bytes per call from one kernel socket to
+    another through a pipe, without the bytes ever visiting userspace.
+    """
+    def __init__(self, listen_raw, send_raw, sizer, args):
+        self.listen_fd = listen_raw.fileno()
+        self.send_fd = send_raw.fileno()
+        self.sizer = sizer
+        self.pipe_r, self.pipe_w = os.pipe()
+
+    def move(self):
+        """
+        Returns the number of bytes moved, or None once the source is closed.
+        """
+        moved = os.splice(self.listen_fd, self.pipe_w, self.sizer.size)
+        if moved == 0:
+            return None
+        self.sizer.update(moved)
+        remaining = moved
+        while remaining > 0:
+            remaining -= os.splice(self.pipe_r, self.send_fd, remaining)
+        self.sizer.sent(1)
+        return moved
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+class BufferMover():
+    """
+    Like SpliceMover, for platforms without os.splice: bytes are read into one
+    reused buffer instead of a new bytes object per read. Whatever else arrives
+    within args.coalesce_budget goes into the same buffer and the same send.
+    """
+    def __init__(self, listen_raw, send_raw, sizer, args):
+        self.listen_raw = listen_raw
+        self.send_raw = send_raw
+        self.sizer = sizer
+        self.budget = args.coalesce_budget / 1000
+        self.buffer = bytearray(sizer.size)
+        self.view = memoryview(self.buffer)
+
+    def move(self):
+        size = self.sizer.size
+        if len(self.buffer) < size:  # The sizer wants bigger reads now
+            self.view.release()
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+        moved = self.listen_raw.recv_into(self.view[:size])
+        if moved == 0:
+            return None
+        self.sizer.update(moved)
+        reads = 1
+        deadline = time.monotonic() + self.budget
+        while moved < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.listen_raw], [], [], remaining)[0]:
+                break
+            recvd = self.listen_raw.recv_into(self.view[moved:size])
+            if recvd == 0:  # Closed; the next move() will say so again
+                break
+            self.sizer.update(recvd)
+            moved += recvd
+            reads += 1
+        self.send_raw.sendall(self.view[:moved])
+        self.sizer.sent(reads)
+        return moved
+
+    def close(self):
+        self.view.release()
+
+
+class HandlerMover():
+    """
+    Shuttles one message per call between handler sockets, e.g. through TLS.
+    Returns the size of the message if it has one.
+    """
+    def __init__(self, listen_sock, send_sock, sizer, args):
+        self.listen_sock = listen_sock
+        self.send_sock = send_sock
+        self.sizer = sizer
+
+    def move(self):
+        msg_obj = self.listen_sock.recv(self.sizer.size)
+        if msg_obj is None:
+            return None
+        self.sizer.update(message_size(msg_obj))
+        send_message(self.send_sock, msg_obj, self.sizer)
+        return message_size(msg_obj) or 0
+
+    def close(self):
+        pass
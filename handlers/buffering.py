@@ -0,0 +1,108 @@
+###############################################################################
+# Buffers for handler sockets which need to collect bytes until they have a
+# whole message. Not a handler itself, just something handlers can import.
+#
+# The naive way of doing this, recv_buf += sock.recv(n) and then
+# recv_buf = recv_buf[msg_len:], copies everything buffered on every read and
+# every message, which gets quadratic fast for large messages. RecvBuffer
+# instead reads straight into spare room at the end of one bytearray, and
+# consuming a message just moves an offset.
+###############################################################################
+
+SMALL_TAKE = 4096  # Bytes up to which take() copies the quick way
+
+
+class RecvBuffer():
+    """
+    A growable receive buffer with a consume offset. Unconsumed bytes live in
+    self.buf[self.start:self.end].
+
+    Views returned by view() are only good until the next fill(), which may
+    move the bytes they point at. Copy out anything you need to keep, e.g.
+    with take().
+    """
+    def __init__(self, size=4096):
+        self.buf = bytearray(size)
+        self.start = 0  # First unconsumed byte
+        self.end = 0  # One past the last byte received
+
+    def __len__(self):
+        return self.end - self.start
+
+    def view(self):
+        """
+        A memoryview of every unconsumed byte, without copying them.
+        """
+        return memoryview(self.buf)[self.start:self.end]
+
+    def fill(self, sock, num_bytes):
+        """
+        Read up to num_bytes from sock straight into the buffer, making room if
+        needed. Returns the number of bytes read, 0 meaning the socket is
+        closed.
+        """
+        self.reserve(num_bytes)
+        with memoryview(self.buf) as buf_view:
+            recvd = recv_into(sock, buf_view[self.end:self.end + num_bytes],
+                              num_bytes)
+        self.end += recvd
+        return recvd
+
+    def reserve(self, num_bytes):
+        """
+        Ensure there's room for num_bytes more after the last byte received.
+        """
+        if len(self.buf) - self.end >= num_bytes:
+            return
+        unconsumed = self.end - self.start
+        if self.start > 0 and len(self.buf) - unconsumed >= num_bytes:
+            # Enough room if we slide the unconsumed bytes back to the front.
+            self.buf[:unconsumed] = self.buf[self.start:self.end]
+        else:
+            # Grow geometrically so growth is amortized O(1) per byte. This
+            # makes a new bytearray instead of resizing, since resizing isn't
+            # allowed while anyone holds a view of the old one.
+            new_buf = bytearray(max(2 * len(self.buf), unconsumed + num_bytes))
+            new_buf[:unconsumed] = self.buf[self.start:self.end]
+            self.buf = new_buf
+        self.start = 0
+        self.end = unconsumed
+
+    def consume(self, num_bytes):
+        """
+        Discard the first num_bytes unconsumed bytes.
+        """
+        self.start += num_bytes
+        if self.start >= self.end:  # Empty, so start over from the front
+            self.start = 0
+            self.end = 0
+
+    def take(self, num_bytes):
+        """
+        Consume the first num_bytes unconsumed bytes, returning a copy of them.
+        """
+        if num_bytes <= SMALL_TAKE:
+            # Copying twice through a slice beats setting up a memoryview.
+            taken = bytes(self.buf[self.start:self.start + num_bytes])
+        else:
+            with memoryview(self.buf) as buf_view:
+                taken = bytes(buf_view[self.start:self.start + num_bytes])
+        self.consume(num_bytes)
+        return taken
+
+
+def recv_into(sock, buffer, num_bytes):
+    """
+    Read up to num_bytes from sock into buffer (a writable bytes-like object,
+    e.g. a memoryview), returning how many were read. Handler sockets should
+    offer a recv_into(buffer, num_bytes) like a socket's, but for those that
+    don't we fall back to copying in the result of recv(). Either way, 0 means
+    the socket is closed.
+    """
+    if hasattr(sock, "recv_into"):
+        return sock.recv_into(buffer, num_bytes)
+    recvd = sock.recv(num_bytes)
+    if not recvd:  # Handler sockets may say closed with None
+        return 0
+    buffer[:len(recvd)] = recvd
+    return len(recvd)
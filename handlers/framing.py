@@ -0,0 +1,240 @@
+###############################################################################
+# Cutting a stream of bytes into messages, for handler sockets. Not a handler
+# itself, just something handlers can import, like buffering.py, which this
+# sits on top of.
+#
+# Most protocols mark where their messages end in one of a few ways, and each
+# has a framer here that works out, from the bytes received so far, how long
+# the next message is:
+#     Fixed(size)              every message is size bytes
+#     LengthPrefixed(...)      a length field in a header says how long; with
+#                              offset, a fixed-size tag before it, this is also
+#                              fixed-size TLV (tag, length, value)
+#     Delimited(delimiter)     messages end with a delimiter, like b"\r\n"
+#     BER()                    each message is a BER element, as in LDAP; BER's
+#                              own TLV, with variable-size tags and lengths
+# A FrameReader puts a framer together with a socket and a RecvBuffer, and
+# hands back one whole message per call, either as a view into the buffer or
+# as bytes. So a handler socket for a protocol with, say, 2 byte big-endian
+# length prefixes can receive with
+#
+#     self.frames = framing.FrameReader(sock, framing.LengthPrefixed(2))
+#     ...
+#     def recv(self, num_bytes):
+#         return self.frames.recv(num_bytes)
+#
+# and only has to turn the bytes into something more useful. Framers keep
+# state between calls (Delimited remembers how far it's searched), so each
+# FrameReader needs a framer of its own.
+#
+# A framer is anything with these two methods, if none of these fit:
+#     length(recv_buf): the total length of the message at the start of
+#         recv_buf's unconsumed bytes, counting any header and trailer, or
+#         None if not enough has been received to say yet. It may be more
+#         than has been received, in which case the reader reads the rest.
+#     payload(frame): the part of a whole frame (a memoryview) that's the
+#         message proper, without the header or trailer, also as a view.
+###############################################################################
+
+from . import buffering
+
+# Most we ask for in one read to finish a message we know the length of.
+MAX_READ_AHEAD = 16 * 1024 * 1024
+
+
+class Fixed():
+    """
+    Messages of size bytes each.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def length(self, recv_buf):
+        return self.size
+
+    def payload(self, frame):
+        return frame
+
+
+class LengthPrefixed():
+    """
+    Messages with a size byte length field, offset bytes into the message,
+    read as byteorder ("big" or "little"). The length counts what comes after
+    the field, unless inclusive, in which case it counts the whole message,
+    header and all. adjust is added to it either way, for protocols whose
+    length leaves out (or counts) something else, like a checksum.
+
+    For example, TLS records are LengthPrefixed(2, offset=3): a content type
+    and version, then a 2 byte big-endian length of the rest.
+    """
+    def __init__(self, size=4, byteorder="big", offset=0, inclusive=False,
+                 adjust=0):
+        self.size = size
+        self.byteorder = byteorder
+        self.offset = offset
+        self.header = offset + size  # Bytes up to the end of the length field
+        self.inclusive = inclusive
+        self.adjust = adjust
+
+    def length(self, recv_buf):
+        start = recv_buf.start
+        if recv_buf.end - start < self.header:
+            return None
+        field = int.from_bytes(recv_buf.buf[start + self.offset:start + self.header],
+                               self.byteorder)
+        return field + self.adjust + (0 if self.inclusive else self.header)
+
+    def payload(self, frame):
+        return frame[self.header:]
+
+
+class Delimited():
+    """
+    Messages ending with delimiter, which is part of each frame. Searches with
+    bytearray.find() in the receive buffer itself, starting from where the
+    last search left off, so each byte is only looked at once however many
+    reads a message takes to arrive.
+    """
+    def __init__(self, delimiter=b"\r\n"):
+        self.delimiter = bytes(delimiter)
+        self.searched = 0  # Unconsumed bytes known not to start a delimiter
+
+    def length(self, recv_buf):
+        found = recv_buf.buf.find(self.delimiter, recv_buf.start + self.searched,
+                                  recv_buf.end)
+        if found == -1:
+            # The last few bytes could be the start of a delimiter that's still
+            # arriving, so search those again next time.
+            self.searched = max(0, len(recv_buf) - len(self.delimiter) + 1)
+            return None
+        self.searched = 0  # The reader consumes this message next
+        return found - recv_buf.start + len(self.delimiter)
+
+    def payload(self, frame):
+        return frame[:len(frame) - len(self.delimiter)]
+
+
+class BER():
+    """
+    Messages that are each one BER element (identifier octets, length octets,
+    then that many contents octets), like LDAP's. The indefinite length form
+    isn't supported, since its end can only be found by decoding the contents;
+    length() raises ValueError if it's used.
+    """
+    def length(self, recv_buf):
+        with recv_buf.view() as view:
+            msg_len = ber_message_length(view)
+        if msg_len == -1:
+            raise ValueError("BER element with indefinite length")
+        return msg_len
+
+    def payload(self, frame):
+        return frame[ber_header(frame)[0]:]
+
+
+def ber_header(view):
+    """
+    Read the header (identifier and length octets) of the BER element at the
+    start of view. Returns how long the header is and how many contents octets
+    it says follow, -1 meaning the indefinite length form, or None if view
+    doesn't hold the whole header yet.
+    """
+    if len(view) < 2:
+        return None
+    i = 1
+    if view[0] & 0x1f == 0x1f:  # High tag number; more identifier octets follow
+        while i < len(view) and view[i] & 0x80:
+            i += 1
+        i += 1
+    if i >= len(view):
+        return None
+    first_length_octet = view[i]
+    i += 1
+    if first_length_octet < 0x80:  # Short form, length fits in this octet
+        return i, first_length_octet
+    num_length_octets = first_length_octet & 0x7f
+    if num_length_octets == 0:
+        return i, -1
+    if i + num_length_octets > len(view):
+        return None
+    return (i + num_length_octets,
+            int.from_bytes(view[i:i + num_length_octets], 'big'))
+
+
+def ber_message_length(view):
+    """
+    Work out the total length (identifier, length, and contents octets) of the
+    BER element at the start of view from its header alone, so we only try to
+    decode once we have all of it. Returns None if view doesn't hold enough of
+    the header to say yet, or -1 for the indefinite length form, which LDAP
+    doesn't allow but which we can still try to decode the slow way.
+    """
+    header = ber_header(view)
+    if header is None:
+        return None
+    header_len, contents_len = header
+    return -1 if contents_len == -1 else header_len + contents_len
+
+
+class FrameReader():
+    """
+    Receives whole messages from sock, as cut up by framer, through a
+    RecvBuffer. A message longer than max_length bytes (or, for framers that
+    can't tell how long a message is until its end, that many bytes without
+    one ending) raises ValueError rather than being buffered without limit.
+    """
+    def __init__(self, sock, framer, max_length=None):
+        self.sock = sock  # Underlying transport
+        self.framer = framer
+        self.max_length = max_length
+        self.recv_buf = buffering.RecvBuffer()
+        self.lent = 0  # Length of the frame recv_frame() last returned
+
+    def next_length(self, num_bytes):
+        """
+        Read until there's a whole message buffered, returning its length, or
+        None if the socket closes first.
+        """
+        recv_buf = self.recv_buf
+        if self.lent:
+            recv_buf.consume(self.lent)
+            self.lent = 0
+        while True:
+            msg_len = self.framer.length(recv_buf)
+            buffered = recv_buf.end - recv_buf.start
+            if self.max_length is not None and \
+               (buffered if msg_len is None else msg_len) > self.max_length:
+                raise ValueError("Message longer than " + str(self.max_length)
+                                 + " bytes")
+            if msg_len is not None and msg_len <= buffered:
+                return msg_len
+            # If we know how much is missing, ask for all of it at once, within
+            # reason: the buffer grows to fit what we ask for before anything
+            # arrives, and the length could be garbage.
+            if msg_len is not None:
+                num_bytes = max(num_bytes, min(msg_len - buffered, MAX_READ_AHEAD))
+            if recv_buf.fill(self.sock, num_bytes) == 0:
+                return None  # Socket is closed
+
+    def recv_frame(self, num_bytes):
+        """
+        The next whole message as a memoryview into the buffer, without
+        copying it, or None if the socket's closed. Only good until the next
+        call; copy out anything you need to keep.
+        """
+        msg_len = self.next_length(num_bytes)
+        if msg_len is None:
+            return None
+        self.lent = msg_len
+        with self.recv_buf.view() as view:
+            return view[:msg_len]
+
+    def recv(self, num_bytes):
+        """
+        The next whole message as bytes of its own, or None if the socket's
+        closed.
+        """
+        msg_len = self.next_length(num_bytes)
+        if msg_len is None:
+            return None
+        return self.recv_buf.take(msg_len)
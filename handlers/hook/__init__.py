@@ -0,0 +1,262 @@
+import argparse
+import importlib, importlib.util
+import multiprocessing
+import os, sys
+import pickle
+import queue
+import threading
+import traceback
+
+# A handler for changing messages with code instead of the editor. Put it last
+# in --handlers, after the handler whose messages you want to change, and
+# point --hook_module at a Python file defining either or both of
+#
+#     def on_client(msg, cnxn_locals): ...
+#     def on_server(msg, cnxn_locals): ...
+#
+# on_client gets every message from the client and on_server every message
+# from the server, in the connection's own process, as soon as the handler
+# before this one has made it (bytes for rawbytes, an LDAPMessage for ldap),
+# before alsanna does anything else with it. Return the message to send on:
+# the same one, maybe changed in place, or a new one. Returning None sends on
+# msg as it now is, and returning handlers.hook.DROP drops it altogether.
+# cnxn_locals is the connection's (see handlers/prototype), so hooks can keep
+# state for a connection there under keys of their own.
+#
+# For example, with --handlers tls ldap hook:
+#
+#     def on_client(msg, cnxn_locals):
+#         if 'bindRequest' in msg['protocolOp']:
+#             msg['protocolOp']['bindRequest']['name'] = 'cn=guest,dc=example,dc=com'
+#
+# Everything else about messages (showing, editing, capturing) is left to the
+# handler before this one. A hook that raises has its message sent on as the
+# hook left it. With a --hook_timeout, hooks are given a copy of each message,
+# so one that takes too long has the message sent on as it arrived, while the
+# hook carries on with the copy; it's switched off for the rest of that
+# connection, rather than leaving another thread stuck with each message.
+# Hooks run on daemon threads, so one that never finishes doesn't keep its
+# connection (or alsanna) from exiting.
+# After --hook_errors of either, a hook's switched off for the rest of the
+# session.
+
+DROP = object()  # Compared by identity
+CALLBACKS = ("on_client", "on_server")
+
+# Optional handler methods that are whatever the handler before this one has.
+DELEGATED = ("obj_to_preview", "obj_to_bytes", "bytes_to_fields")
+
+
+class Handler:
+    def __init__(self, arg_parser, final):
+        self.arg_parser = argparse.ArgumentParser(parents=[arg_parser],
+                                                  add_help=final,
+                                                  allow_abbrev=False)
+        self.arg_parser.add_argument(
+            "--hook_module", type=str, required=True,
+            help="Python file (or importable module) defining on_client(msg, "
+                 "cnxn_locals) and/or on_server(msg, cnxn_locals), called on "
+                 "each message from the client or server. See handlers/hook."
+        )
+        self.arg_parser.add_argument(
+            "--hook_timeout", type=float, default=1.0,
+            help="Seconds a hook can take with a message before it's sent on "
+                 "as it arrived, without waiting for the hook any longer. 0 "
+                 "waits for as long as it takes, and saves handing a copy of "
+                 "each message to another thread, which is the fastest way to "
+                 "run hooks you trust."
+        )
+        self.arg_parser.add_argument(
+            "--hook_errors", type=int, default=10,
+            help="Number of times each hook can raise or time out, over the "
+                 "whole session, before it's switched off. 0 never switches "
+                 "hooks off."
+        )
+        self.args, self.remaining_args = self.arg_parser.parse_known_args()
+
+        if self.args.handlers.index("hook") == 0:
+            self.arg_parser.error("hook has to come after the handler whose "
+                                  "messages it's given.")
+        try:
+            self.module = load_module(self.args.hook_module)
+        except Exception:
+            self.arg_parser.error("Couldn't load --hook_module "
+                                  + self.args.hook_module + ":\n"
+                                  + traceback.format_exc())
+        self.hooks = {name: getattr(self.module, name, None)
+                      for name in CALLBACKS}
+        if not any(self.hooks.values()):
+            self.arg_parser.error(self.args.hook_module + " defines neither "
+                                  + " nor ".join(CALLBACKS) + ".")
+        # Shared by every connection process, so the budget is for the session.
+        self.errors = multiprocessing.Array('L', len(CALLBACKS))
+        self.previous = None  # The handler before us; see set_previous()
+
+    def set_previous(self, handler):
+        """
+        Called by alsanna once the handler chain's built, with the handler
+        before this one, which we leave everything but the hooks to.
+        """
+        self.previous = handler
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have: the optional methods we
+        # have exactly when the handler before us does.
+        previous = self.__dict__.get("previous")
+        if name in DELEGATED and previous is not None:
+            return getattr(previous, name)
+        raise AttributeError(name)
+
+    def setup_client_facing(self, listen_sock, cnxn_locals):
+        return HookSocket(listen_sock, self, "on_client", cnxn_locals)
+
+    def setup_server_facing(self, send_sock, cnxn_locals):
+        return HookSocket(send_sock, self, "on_server", cnxn_locals)
+
+    def obj_to_printable(self, py_obj):
+        return self.previous.obj_to_printable(py_obj)
+
+    def printable_to_obj(self, message, unprintable_state):
+        return self.previous.printable_to_obj(message, unprintable_state)
+
+    def failed(self, name, cnxn_locals, what, details="", sent="as the hook left it"):
+        """
+        Count a hook's failure against its budget and say so, switching it off
+        if that's the last straw. sent is how the message went on. Returns
+        whether it's still on.
+        """
+        number = CALLBACKS.index(name)
+        with self.errors.get_lock():
+            self.errors[number] += 1
+            errors = self.errors[number]
+        budget = self.args.hook_errors
+        message = (name + " " + what + " on connection " + cnxn_locals['cnxn_id']
+                   + (" (" + str(errors) + " of " + str(budget) + " errors)"
+                      if budget > 0 else "")
+                   + "; sent the message on " + sent + ".")
+        if 0 < budget <= errors:
+            message += " Switched " + name + " off."
+        report(cnxn_locals, message, details)
+        return not 0 < budget <= errors
+
+    def enabled(self, name):
+        budget = self.args.hook_errors
+        return not 0 < budget <= self.errors[CALLBACKS.index(name)]
+
+
+def load_module(name):
+    """
+    Import a hook module from a file path, or failing that by module name.
+    """
+    if name.endswith(".py") or os.path.sep in name:
+        spec = importlib.util.spec_from_file_location(
+            "alsanna_hook_" + os.path.splitext(os.path.basename(name))[0], name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return importlib.import_module(name)
+
+
+def duplicate(msg):
+    """
+    A copy of msg for a hook to change as it likes. Bytes (rawbytes' messages)
+    can't be changed, so they needn't be copied. copy.deepcopy() would do for
+    most of the rest, but pyasn1 objects like ldap's refuse it, and they
+    pickle fine.
+    """
+    if isinstance(msg, (bytes, str)):
+        return msg
+    return pickle.loads(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+
+
+def call_hook(hook, msg, cnxn_locals, results):
+    """
+    Run hook on msg, putting what it returned on results, along with the
+    traceback if it raised (None if it didn't).
+    """
+    try:
+        results.put((hook(msg, cnxn_locals), None))
+    except Exception:
+        results.put((None, traceback.format_exc()))
+
+
+def report(cnxn_locals, message, details):
+    """
+    Tell the user interface about a problem, if we can reach it.
+    """
+    display_q = cnxn_locals.get("display_q")
+    if display_q is not None:
+        display_q.put(("Err", (message, details)))
+    else:
+        print(message + "\n" + details, file=sys.stderr)
+
+
+class HookSocket():
+    """
+    Passes everything through to the socket beneath, except that recv() runs
+    each message past the hook for its direction (the client-facing socket
+    receives from the client, so it gets on_client, and vice versa).
+    """
+    def __init__(self, sock, handler, name, cnxn_locals):
+        self.sock = sock  # Underlying transport
+        self.handler = handler
+        self.name = name
+        self.hook = handler.hooks[name]
+        self.cnxn_locals = cnxn_locals
+        self.timeout = handler.args.hook_timeout
+
+    def connect(self, target_tuple):
+        self.sock.connect(target_tuple)
+
+    def close(self):
+        self.sock.close()
+
+    def send(self, msg):
+        return self.sock.send(msg)
+
+    def recv(self, num_bytes):
+        while True:
+            msg = self.sock.recv(num_bytes)
+            if msg is None or self.hook is None:
+                return msg
+            result = self.run_hook(msg)
+            if result is not DROP:
+                return result
+
+    def run_hook(self, msg):
+        """
+        Call the hook on msg, returning what to send on (or DROP).
+        """
+        if not self.handler.enabled(self.name):
+            self.hook = None  # Switched off, maybe by another connection
+            return msg
+        hooked = msg  # What the hook's working on
+        results = queue.Queue()
+        if self.timeout <= 0:
+            call_hook(self.hook, msg, self.cnxn_locals, results)
+            result, details = results.get()
+        else:
+            # The hook might still be changing it after we stop waiting,
+            # so it gets a copy, and msg stays as it arrived until then.
+            hooked = duplicate(msg)
+            threading.Thread(target=call_hook, daemon=True, name="hook",
+                             args=(self.hook, hooked, self.cnxn_locals,
+                                   results)).start()
+            try:
+                result, details = results.get(timeout=self.timeout)
+            except queue.Empty:
+                # It's still running, and can keep its thread and its copy. It
+                # might never finish, so don't start another thread for the
+                # next message on this connection.
+                self.hook = None
+                self.handler.failed(self.name, self.cnxn_locals,
+                                    "took longer than --hook_timeout",
+                                    sent="as it arrived, and switched it off "
+                                         "for this connection")
+                return msg
+        if details is not None:
+            if not self.handler.failed(self.name, self.cnxn_locals, "raised",
+                                       details):
+                self.hook = None
+            return hooked
+        return hooked if result is None else result
@@ -9,15 +9,16 @@ from . import edit_utils
 import json
 import collections
 
-from .. import tls
+from .. import tls, buffering, framing, preview
 import ssl
 
-def build_ldap_encoder(unprintable_storage):
+def build_ldap_encoder(unprintable_storage, value_budget=0):
     """
     Return a JSONEncoder class that stores information on object we know we can't print.
     Converts LDAP structures into Python equivalents which are understood by the
     pyasn1 native decoder. Needs to be a closure like this because built-in json doesn't
-    support an argument that does this kind of storage.
+    support an argument that does this kind of storage. If value_budget is set, values
+    longer than that are elided (see merge_metadata), which is only any good for display.
     """
     class LDAPEncoder(json.JSONEncoder):
         def default(self, obj, iskey=False, path=None):
@@ -51,7 +52,7 @@ def build_ldap_encoder(unprintable_storage):
                or isinstance(obj, tuple):
                 return [self.default(e, iskey=False, path=path + [i]) for i, e in enumerate(obj)]
             else:
-                return merge_metadata(obj, iskey=iskey)
+                return merge_metadata(obj, iskey=iskey, budget=value_budget)
     return LDAPEncoder
 
 
@@ -133,7 +134,7 @@ def decode_ldap_structure(obj, descending=False):
     return decoded
 
 
-def merge_metadata(obj, iskey):
+def merge_metadata(obj, iskey, budget=0):
     """
     Store object metadata in a recoverable format in a string representation
     Key metadata stored to the left, value metadata to the right
@@ -142,12 +143,15 @@ def merge_metadata(obj, iskey):
     then chop off the b'' for a nicer UI. This may need editing depending on the
     metadata you want to display or what string representation you want of the 
     objects the protocol handles - you need to be able to recover the original 
-    object.
+    object. Values longer than budget characters, if it's set, have their middle
+    elided, and then you can't.
     """
     if iskey:
         return str(type(obj)).split("'")[1] + '~' + str(str(obj).encode('utf-8'))[2:-1]
     else:
-        return str(str(obj).encode('utf-8'))[2:-1] + '#' + str(type(obj)).split("'")[1]
+        value = preview.elide_text(str(str(obj).encode('utf-8'))[2:-1], budget,
+                                   separator=' ')
+        return value + '#' + str(type(obj)).split("'")[1]
 
 
 class Handler:
@@ -178,13 +182,13 @@ class Handler:
         """
         See LDAPSocket below for implementation. No special actions for the listener.
         """
-        return LDAPSocket(listen_sock, self.tls_handler)
+        return LDAPSocket(listen_sock, self.tls_handler, cnxn_locals)
 
     def setup_server_facing(self, send_sock, cnxn_locals):
         """
         See LDAPSocket below for implementation. No special actions for the sender.
         """
-        return LDAPSocket(send_sock, self.tls_handler)
+        return LDAPSocket(send_sock, self.tls_handler, cnxn_locals)
 
     def obj_to_printable(self, ldap_msg):
         """
@@ -211,6 +215,52 @@ class Handler:
 
         return ldap_json, unprintable_state
 
+    def obj_to_preview(self, ldap_msg, budget):
+        """
+        Like obj_to_printable(), but big attribute values (think jpegPhoto or
+        userCertificate in a SearchResultEntry) only have their start and end
+        shown, and messages with very many attributes are cut short. Padding
+        makes the JSON display a good deal longer than the message it shows, so
+        the whole display gets a few times budget.
+        """
+        ldap_json = json.dumps(ldap_msg,
+                               cls=build_ldap_encoder([], value_budget=max(budget // 4, 64)),
+                               indent=2)
+        ldap_json = edit_utils.raw_to_editable_mangle(ldap_json, self.args)
+        return preview.elide_text(ldap_json, budget * 4)
+
+    def obj_to_bytes(self, ldap_msg):
+        """
+        The BER encoding of an LDAPMessage, as LDAPSocket.send() would send it.
+        """
+        return pyasn1_codec_ber.encoder.encode(ldap_msg)
+
+    def bytes_to_fields(self, data):
+        """
+        The operation, messageID, DN (whichever of an operation's fields names
+        the entry it's about), and for results the resultCode, matchedDN and
+        diagnosticMessage of a BER-encoded LDAPMessage, for session_store.py.
+        """
+        ldap_msg, remaining = pyasn1_codec_ber.decoder.decode(
+            bytes(data), asn1Spec=ldapasn1.LDAPMessage())
+        operation = ldap_msg['protocolOp'].getName()
+        body = ldap_msg['protocolOp'][operation]
+        fields = {"operation": operation,
+                  "messageID": int(ldap_msg['messageID'])}
+        if operation == "delRequest":  # The DN is all there is
+            fields["dn"] = bytes(body).decode("utf-8", "replace")
+            return fields
+        if not isinstance(body, pyasn1.type.univ.Sequence):
+            return fields  # unbindRequest, abandonRequest, searchResRef
+        for name, field in LDAP_FIELDS.items():
+            if name in body.componentType and body[name].isValue:
+                value = body[name]
+                if name == "resultCode":
+                    fields[field] = int(value)
+                else:
+                    fields[field] = bytes(value).decode("utf-8", "replace")
+        return fields
+
     def printable_to_obj(self, message, unprintable_state):
         """
         Convert a human-readable message back into a bytestring to be forwarded to
@@ -233,16 +283,26 @@ class Handler:
         ldap_msg = pyasn1_codec_native_decode(msg, asn1Spec=ldapasn1.LDAPMessage())
         return ldap_msg
 
+# Fields of LDAP operations indexed by bytes_to_fields(), and what they're
+# indexed as. Each operation names its entry in one of the "dn" ones.
+LDAP_FIELDS = {"name": "dn", "baseObject": "dn", "entry": "dn", "object": "dn",
+               "objectName": "dn", "resultCode": "resultCode",
+               "matchedDN": "matchedDN",
+               "diagnosticMessage": "diagnosticMessage",
+               "requestName": "oid", "responseName": "oid"}
+
+
 class LDAPSocket():
     """
     Socket that recvs bytes and returns an LDAPMessage, and accepts LDAPMessages to
     convert them into bytes to send. Uses impacket and pyasn1 to do the decoding.
     """
 
-    def __init__(self, sock, tls_handler):
+    def __init__(self, sock, tls_handler, cnxn_locals):
         self.sock = sock  # Underlying transport
-        self.recv_buf = b''  # Store unread bytes
+        self.recv_buf = buffering.RecvBuffer()  # Store unread bytes
         self.tls_handler = tls_handler
+        self.cnxn_locals = cnxn_locals  # For the TLS handler, on STARTTLS
         self.send_lock = threading.Lock()
         self.recv_lock =  threading.Lock()
 
@@ -255,12 +315,13 @@ class LDAPSocket():
     def send(self, ldap_msg):
         bytestr = pyasn1_codec_ber.encoder.encode(ldap_msg)
         sent = 0
-        while sent < len(bytestr):
-            try:
-                with self.send_lock:
-                    sent += self.sock.send(bytestr)
-            except ConnectionResetError:
-                return sent
+        with memoryview(bytestr) as view:
+            while sent < len(view):
+                try:
+                    with self.send_lock:
+                        sent += self.sock.send(view[sent:])
+                except ConnectionResetError:
+                    return sent
 
         if 'protocolOp' in ldap_msg \
            and 'extendedResp' in ldap_msg['protocolOp'] \
@@ -270,26 +331,42 @@ class LDAPSocket():
             if str(ldap_msg['protocolOp']['extendedResp']['resultCode']) == 'success' \
                and not isinstance(self.sock, tls.TLSSock):
                 with self.send_lock:
-                    self.sock = self.tls_handler.setup_client_facing(self.sock, cnxn_locals={})
+                    self.sock = self.tls_handler.setup_client_facing(self.sock, self.cnxn_locals)
             self.recv_lock.release()
         return sent
 
     def recv(self, num_bytes):
         while True:
-            try:
-                message, remaining = pyasn1_codec_ber.decoder.decode(self.recv_buf,
+            # Only decode once the header says the whole message is here, rather
+            # than attempting (and failing) a decode after every read.
+            with self.recv_buf.view() as view:
+                msg_len = framing.ber_message_length(view)
+            if msg_len is not None and 0 <= msg_len <= len(self.recv_buf):
+                message, remaining = pyasn1_codec_ber.decoder.decode(self.recv_buf.take(msg_len),
                                                                      asn1Spec=ldapasn1.LDAPMessage())
                 break
-            except pyasn1.error.SubstrateUnderrunError:
-                recvd = len(self.recv_buf)
+            if msg_len == -1:
                 try:
-                    with self.recv_lock:
-                        self.recv_buf += self.sock.recv(num_bytes)
-                except ConnectionResetError:  # Socket is closed here, give up
-                    return None
-                if len(self.recv_buf) == recvd:  # Socket is closed here, too
-                    return None
-        self.recv_buf = remaining
+                    with self.recv_buf.view() as view:
+                        message, remaining = pyasn1_codec_ber.decoder.decode(bytes(view),
+                                                                             asn1Spec=ldapasn1.LDAPMessage())
+                    self.recv_buf.consume(len(self.recv_buf) - len(remaining))
+                    break
+                except pyasn1.error.SubstrateUnderrunError:
+                    pass
+            # If we know how much is missing, ask for all of it at once, within
+            # reason: the buffer grows to fit what we ask for before anything
+            # arrives, and the length is whatever the peer says it is.
+            if msg_len is not None and msg_len > len(self.recv_buf):
+                num_bytes = max(num_bytes, min(msg_len - len(self.recv_buf),
+                                               framing.MAX_READ_AHEAD))
+            try:
+                with self.recv_lock:
+                    recvd = self.recv_buf.fill(self.sock, num_bytes)
+            except ConnectionResetError:  # Socket is closed here, give up
+                return None
+            if recvd == 0:  # Socket is closed here, too
+                return None
         if 'protocolOp' in message \
            and 'extendedResp' in message['protocolOp'] \
            and 'resultCode' in message['protocolOp']['extendedResp'] \
@@ -298,7 +375,7 @@ class LDAPSocket():
            and str(message['protocolOp']['extendedResp']['responseName']) == '1.3.6.1.4.1.1466.20037' \
            and not isinstance(self.sock, tls.TLSSock):
             with self.send_lock:
-                self.sock = self.tls_handler.setup_server_facing(self.sock, cnxn_locals={})
+                self.sock = self.tls_handler.setup_server_facing(self.sock, self.cnxn_locals)
         if 'protocolOp' in message \
            and 'extendedReq' in message['protocolOp'] \
            and 'requestName' in message['protocolOp']['extendedReq'] \
@@ -0,0 +1,66 @@
+###############################################################################
+# Bounded-size previews of messages, for displaying traffic that's only being
+# watched (see --display_budget). Not a handler itself, just something handlers
+# (and alsanna) can import.
+#
+# Making a multi-megabyte message printable, pickling it across to the user
+# interface and writing it to the terminal costs far more than forwarding it.
+# So watched messages are shown as their first and last few bytes (or fields),
+# with a marker saying how much was elided in between, how long the whole thing
+# is and its hash, so identical payloads can still be told apart. Intercepted
+# messages are always made printable in full, since they're being edited.
+###############################################################################
+
+import hashlib
+
+
+def digest(data):
+    """
+    A short hash of data (bytes-like), enough to tell payloads apart by eye.
+    """
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def marker(elided, total, unit, data):
+    return ("[... " + str(elided) + " " + unit + " elided; " + str(total) + " "
+            + unit + " in all, sha256 " + digest(data) + " ...]")
+
+
+def split_budget(budget):
+    """
+    How much of a budget goes to the start of a message, and how much to the
+    end. Mostly the start, which is where headers live.
+    """
+    tail = budget // 4
+    return budget - tail, tail
+
+
+def preview_bytes(data, budget):
+    """
+    str() of data (bytes-like), or if it's longer than budget bytes, of its
+    first and last few bytes with a marker in between. Only the bytes shown are
+    ever made printable.
+    """
+    if budget <= 0 or len(data) <= budget:
+        return str(bytes(data))
+    head, tail = split_budget(budget)
+    with memoryview(data) as view:
+        return (str(bytes(view[:head])) + " "
+                + marker(len(view) - head - tail, len(view), "bytes", view) + " "
+                + str(bytes(view[len(view) - tail:])))
+
+
+def elide_text(text, budget, separator="\n"):
+    """
+    text, or if it's longer than budget characters, its first and last few
+    characters with a marker in between, set off by separator. For handlers
+    that can only make a whole message (or field) printable; this still saves
+    sending it all to the terminal.
+    """
+    if budget <= 0 or len(text) <= budget:
+        return text
+    head, tail = split_budget(budget)
+    return (text[:head] + separator
+            + marker(len(text) - head - tail, len(text), "characters",
+                     text.encode("utf-8", "backslashreplace"))
+            + separator + text[len(text) - tail:])
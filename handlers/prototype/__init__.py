@@ -6,10 +6,15 @@
 # to communicate with each other or alsanna. It contains the following key:
 #     "cnxn_id": A numeric ID for the connection. Useful for debugging.
 #                Used by alsanna's core module, guaranteed available.
+#     "display_q": The queue the user interface reads from, for telling it
+#                about problems with ("Err", (message, details)) or anything
+#                else with ("Note", message). Available in connections alsanna
+#                forwards, but not in tools like replay.py.
 # More may be added as handlers are added that need to share information, and
 # this documentation will be updated as this happens.
 
 import argparse, ast
+from .. import framing, preview
 
 class Handler:
     def __init__(self, arg_parser, final):
@@ -34,6 +39,18 @@ class Handler:
         # Anything else you do on startup goes here.#
         #############################################
 
+    # Optional. If your handler works on the messages the handler before it
+    # makes, rather than adding a layer of its own (like hook), give it a
+    # set_previous(handler) method, and alsanna will call it with that handler
+    # once the chain's built.
+
+    # Optional. With --eager_connect, alsanna sets up the server-facing socket
+    # at the same time as the client-facing one instead of waiting for the
+    # client. If your setup_server_facing() relies on something only learned in
+    # setup_client_facing() (like the tls handler relying on the client's SNI),
+    # set this to True and alsanna will wait for the client-facing setup first.
+    needs_client_handshake = False
+
     def setup_client_facing(self, listen_sock, cnxn_locals):
         """
         Do anything you need to as part of setting up the client-facing socket.
@@ -82,13 +99,46 @@ class Handler:
         """
         return str(py_obj), None # Return no unprintable features of the message
 
+    def obj_to_preview(self, py_obj, budget):
+        """
+        Optional. Like obj_to_printable(), but for messages that are only being
+        watched, so it needn't be invertible: return a human-readable string
+        showing roughly budget bytes' worth of py_obj, saying what was left out
+        (handlers/preview.py has helpers for this). Only make printable the
+        parts you show - that's the point. Without this method, alsanna calls
+        obj_to_printable() and cuts the result down afterwards. Also only called
+        for the last handler in a chain.
+        """
+        return preview.preview_bytes(py_obj, budget)
+
+    def obj_to_bytes(self, py_obj):
+        """
+        Optional. The bytes py_obj stands for on the wire, for --capture. Only
+        needed if recv() returns something other than bytes, and also only
+        called for the last handler in a chain. Without it, captures record
+        str(py_obj) instead, marked as such.
+        """
+        return bytes(py_obj)
+
+    def bytes_to_fields(self, data):
+        """
+        Optional. Protocol fields worth searching on in a message, given the
+        bytes it was captured as, as a dict of field names to strs or ints,
+        for session_store.py. Called by the last handler in a chain only, away
+        from the forwarding path, and anything it raises just means no fields.
+        Without it, messages are only indexed by connection, direction, time,
+        size and their printable strings.
+        """
+        return {"length": len(data)}
+
     def printable_to_obj(self, message, unprintable_state):
         """
         Convert a human-readable message back into a bytestring to be forwarded to
         the server. This should invert whatever happened in bytes_to_message(). If
         this fails, the original bytestring that was supplied to bytes_to_message()
         will be sent instead. This, too, is called only by the last handler in a
-        chain.
+        chain, and only if the message was actually edited - otherwise the
+        object returned by recv() is sent as it was.
         """
         return ast.literal_eval(message)
 
@@ -100,8 +150,12 @@ class HandlerSock():
     """
     def __init__(self, sock):
         self.sock = sock  # Underlying transport
-        self.send_buf = b''  # Store unsent bytes
-        self.recv_buf = b''  # Store unread bytes
+        self.send_buf = bytearray()  # Store unsent bytes
+        # Cut what we receive into messages. handlers/framing.py has framers for
+        # fixed-length, length-prefixed, delimited and BER messages, reading
+        # into a buffer that messages are sliced off the front of without
+        # copying everything behind them. Use one unless your messages are tiny.
+        self.frames = framing.FrameReader(sock, framing.Fixed(64))
 
     def connect(self, target_tuple):
         self.sock.connect(target_tuple)
@@ -109,20 +163,28 @@ class HandlerSock():
     def close(self):
         self.sock.close()
 
+    # Optionally, your socket can have a passthrough_socket() method. If your
+    # socket adds nothing on top of the one beneath it (which rawbytes does not,
+    # but this one does), return that socket when it's a plain TCP socket, and
+    # alsanna can move bytes between sockets directly when traffic is only
+    # being watched. Return None, or leave the method out, otherwise.
+
     def send(self, bytes):
         sent = 0
         self.send_buf += bytes
-        while len(self.send_buf) >= 64:  # Send everything we can
-            self.sock.send(self.send_buf[:64])
-            self.send_buf = self.send_buf[64:]
-            sent += 64
+        with memoryview(self.send_buf) as view:
+            while len(view) - sent >= 64:  # Send everything we can
+                self.sock.send(view[sent:sent + 64])
+                sent += 64
+        del self.send_buf[:sent]  # Shift what's left once, not once per message
 
     # Your socket should accept a num_bytes in its recv(), but can ignore it if it
     # doesn't make sense, for instance if you don't read from a socket that recv()s
-    # bytestrings.
+    # bytestrings. Sockets that do deal in bytestrings should also offer a
+    # recv_into(buffer, num_bytes) like a standard socket's, so that handlers
+    # stacked on top of yours can read without copying.
     def recv(self, num_bytes):
-        while len(self.recv_buf) < 64: # Read until we get enough to work with
-            self.recv_buf += self.sock.recv(num_bytes)
-        recvd = self.recv_buf[:64]
-        self.recv_buf = self.recv_buf[64:]
-        return recvd
+        # Read until we have a whole message, None meaning the socket closed.
+        # recv_frame() would return a view of it instead of a copy, if you
+        # only need to look at it before the next recv().
+        return self.frames.recv(num_bytes)
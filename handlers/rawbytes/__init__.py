@@ -1,4 +1,7 @@
-import argparse, ast
+import argparse
+import socket
+from .. import buffering, preview
+from . import codec
 
 # Simplest possible handler.
 
@@ -8,7 +11,16 @@ class Handler:
         self.arg_parser = argparse.ArgumentParser(parents=[arg_parser], 
                                                   add_help=final,
                                                   allow_abbrev=False)
+        self.arg_parser.add_argument(
+            "--rawbytes_format", type=str, choices=sorted(codec.FORMATS),
+            default="literal",
+            help="How messages look in the editor: 'literal' is a Python bytes "
+                 "literal, b'...'; 'hexdump' is offset, hex and ASCII columns, "
+                 "16 bytes to a line, of which only the hex is read back. See "
+                 "handlers/rawbytes/codec.py."
+        )
         self.args, self.remaining_args = self.arg_parser.parse_known_args()
+        self.encode, self.decode = codec.FORMATS[self.args.rawbytes_format]
 
     def setup_client_facing(self, listen_sock, cnxn_locals=None):
         return RawSocket(listen_sock)
@@ -17,14 +29,28 @@ class Handler:
         return RawSocket(send_sock)
 
     def obj_to_printable(self, bytes):
-        return str(bytes), None # Return no unprintable features of the message
+        return self.encode(bytes), None # Return no unprintable features of the message
+
+    def obj_to_preview(self, bytes, budget):
+        if self.args.rawbytes_format == "literal":
+            return preview.preview_bytes(bytes, budget)
+        if budget <= 0 or len(bytes) <= budget:
+            return codec.to_hexdump(bytes)
+        head, tail = preview.split_budget(budget)
+        head -= head % codec.WIDTH  # Keep whole lines
+        tail -= tail % codec.WIDTH
+        return (codec.to_hexdump(bytes[:head]) + "\n"
+                + preview.marker(len(bytes) - head - tail, len(bytes), "bytes",
+                                 bytes) + "\n"
+                + codec.to_hexdump(bytes[len(bytes) - tail:], len(bytes) - tail))
 
     def printable_to_obj(self, message, unprintable_state):
-        return ast.literal_eval(message)
+        return self.decode(message)
 
 class RawSocket():
     def __init__(self, sock):
         self.sock = sock  # Underlying transport
+        self.recv_buf = bytearray()  # Reused by every recv()
 
     def connect(self, target_tuple):
         self.sock.connect(target_tuple)
@@ -32,21 +58,35 @@ class RawSocket():
     def close(self):
         self.sock.close()
 
+    def passthrough_socket(self):
+        # We add nothing on top of the transport, so if that's a plain TCP
+        # socket alsanna can move bytes on it directly when just watching.
+        return self.sock if type(self.sock) is socket.socket else None
+
     def send(self, bytestr):
         sent = 0
-        while sent < len(bytestr):
-            try:
-                sent += self.sock.send(bytestr)
-            except ConnectionResetError:
-                return sent
+        with memoryview(bytestr) as view:
+            while sent < len(view):
+                try:
+                    sent += self.sock.send(view[sent:])
+                except ConnectionResetError:
+                    return sent
 
         return sent  # Unused by alsanna
 
-    def recv(self, num_bytes):
+    def recv_into(self, buffer, num_bytes=0):
         try:
-            recvd = self.sock.recv(num_bytes)
+            return buffering.recv_into(self.sock, buffer, num_bytes or len(buffer))
         except ConnectionResetError:  # Socket is closed here, give up
-            return None
-        if len(recvd) == 0:  # Socket is closed here, too
-            return None
-        return recvd
+            return 0
+
+    def recv(self, num_bytes):
+        # Receive into a buffer we keep around, then copy out only what we got,
+        # rather than having recv() allocate num_bytes every time.
+        if len(self.recv_buf) < num_bytes:
+            self.recv_buf = bytearray(num_bytes)
+        with memoryview(self.recv_buf) as view:
+            recvd = self.recv_into(view[:num_bytes], num_bytes)
+            if recvd == 0:  # Socket is closed here
+                return None
+            return bytes(view[:recvd])
@@ -0,0 +1,108 @@
+import array
+import codecs
+import itertools
+import operator
+import struct
+import sys
+
+# Printable forms of raw bytes for the editor, and back again, for
+# --rawbytes_format. Both round-trip exactly, and both work on the whole
+# message at once with C-level operations rather than going byte by byte in
+# Python, or through Python's parser (ast.literal_eval() used to be how edited
+# messages were read back, which is slow on anything big).
+#
+# literal (the default) is a Python bytes literal, as str(bytes) makes it:
+#     b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+# Edit it as you would the literal in Python source. Anything you type that
+# isn't ASCII is taken as its UTF-8.
+#
+# hexdump is an offset, sixteen bytes in hex and the same bytes as ASCII (with
+# . for anything unprintable) per line, much as hexdump -C shows them:
+#     00000000  47 45 54 20 2f 20 48 54 54 50 2f 31 2e 31 0d 0a  |GET / HTTP/1.1..|
+# Reading it back, the offset at the start of each line and everything from
+# the first | on are ignored; the hex in between is the message. So edit the
+# hex, and add or remove bytes wherever you like without fixing up the lines.
+# Lines you add needn't have an offset: it's only an offset if it's 8 or more
+# hex digits and then two spaces, as above, and otherwise it's hex like the
+# rest.
+
+WIDTH = 16  # Bytes per hexdump line
+HEX_DIGITS = "0123456789abcdefABCDEF"
+
+# Bytes as hexdump shows them in the ASCII column.
+GUTTER = bytes(byte if 0x20 <= byte < 0x7f else ord(".") for byte in range(256))
+
+# A whole hexdump line, laid out as pieces for struct to pack: the offset, the
+# hex (sixteen bytes of it, spaced), the ASCII column, and what goes between.
+# Each piece comes from the whole message made into that piece at once, and
+# struct cuts them up and puts them together, so Python only loops over lines
+# inside struct's iterators and b"".join().
+LINE = struct.Struct("8s2s47s3s{0}s2s".format(WIDTH))
+
+
+def to_literal(data):
+    return str(bytes(data))
+
+
+def from_literal(text):
+    """
+    The bytes a bytes literal stands for. Raises ValueError if text isn't one.
+    """
+    text = text.strip()
+    if len(text) < 3 or text[0] not in "bB" or text[1] not in "'\"" \
+       or text[-1] != text[1]:
+        raise ValueError("Not a bytes literal: " + text[:20] + "...")
+    # The same escapes as the bytes literal, decoded by the codec pickle uses.
+    return codecs.escape_decode(text[2:-1])[0]
+
+
+def to_hexdump(data, start=0):
+    """
+    The hexdump of data, numbering lines from offset start.
+    """
+    data = bytes(data)
+    whole = len(data) // WIDTH * WIDTH  # The bytes on lines of their own
+    if start + whole >= 2 ** 32:  # Offsets longer than the 8 digits LINE has
+        whole = 0
+    first = operator.itemgetter(0)
+    # Offsets as big-endian 64-bit ints in hex, of which we want the last 8
+    # digits.
+    offsets = array.array("Q", range(start, start + whole, WIDTH))
+    if sys.byteorder == "little":
+        offsets.byteswap()
+    offsets = offsets.tobytes().hex().encode("ascii")
+    hexed = data[:whole].hex(" ").encode("ascii") + b" " * bool(whole)
+    text = b"".join(map(LINE.pack,
+                        map(first, struct.iter_unpack("8x8s", offsets)),
+                        itertools.repeat(b"  "),
+                        map(first, struct.iter_unpack("47sx", hexed)),
+                        itertools.repeat(b"  |"),
+                        map(first, struct.iter_unpack(str(WIDTH) + "s",
+                                                      data[:whole].translate(GUTTER))),
+                        itertools.repeat(b"|\n"))).decode("ascii")
+    if whole == len(data):
+        return text[:-1]  # No newline after the last line
+    return text + "\n".join(
+        "{0:08x}  {1:<47}  |{2}|".format(start + offset, data[offset:offset + WIDTH].hex(" "),
+                                         data[offset:offset + WIDTH].translate(GUTTER).decode("ascii"))
+        for offset in range(whole, len(data), WIDTH))
+
+
+def from_hexdump(text):
+    """
+    The bytes a hexdump stands for. Raises ValueError if the hex isn't hex.
+    """
+    # Everything from a line's first | on goes, and then the offset, if the
+    # line has one; fromhex() doesn't mind the spaces left over.
+    kept = []
+    for line in text.splitlines():
+        offset, gutter, rest = line.partition("|")[0].lstrip().partition("  ")
+        if gutter and len(offset) >= 8 and not offset.strip(HEX_DIGITS):
+            kept.append(rest)
+        else:  # Just hex
+            kept.append(offset + gutter + rest)
+    return bytes.fromhex(" ".join(kept))
+
+
+FORMATS = {"literal": (to_literal, from_literal),
+           "hexdump": (to_hexdump, from_hexdump)}
@@ -1,6 +1,24 @@
 import ssl
 import os, subprocess, uuid
 import argparse
+import collections, concurrent.futures, datetime, ipaddress, tempfile, threading
+
+# Leaf certificates are minted in-process with cryptography if it's installed,
+# which takes a millisecond or so for an ECDSA key, and otherwise by running
+# openssl, which takes seconds, mostly making the RSA key.
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+except ImportError:
+    x509 = None
+
+# Parts of an openssl-style subject, like --tls_root_ca, we know the OIDs of.
+SUBJECT_OIDS = {"C": "COUNTRY_NAME", "ST": "STATE_OR_PROVINCE_NAME",
+                "L": "LOCALITY_NAME", "O": "ORGANIZATION_NAME",
+                "OU": "ORGANIZATIONAL_UNIT_NAME", "CN": "COMMON_NAME",
+                "emailAddress": "EMAIL_ADDRESS"}
 
 class Handler:
     def __init__(self, arg_parser, final):
@@ -53,6 +71,21 @@ class Handler:
             default=os.path.join(os.path.dirname(os.path.realpath(__file__)), 'certs/tls_key.pem'),
             help="Path to the private key corresponding to --serv_cert."
         )
+        self.arg_parser.add_argument(
+            "--tls_key_type", type=str, choices=["ec", "rsa"], default="ec",
+            help="Key type for certificates alsanna generates. 'ec' makes an "
+                 "ECDSA P-256 key for each leaf certificate, which is quick; "
+                 "'rsa' is for clients that won't take ECDSA, and makes one "
+                 "RSA key (kept in handlers/tls/certs) that every leaf "
+                 "certificate shares, rather than one per server name."
+        )
+        self.arg_parser.add_argument(
+            "--tls_cache_size", type=int, default=1024,
+            help="Number of server names to keep ready-to-use TLS contexts for "
+                 "in memory, shared by every connection a process handles (so "
+                 "most useful with --workers or --engine asyncio), on top of "
+                 "the leaf certificates kept on disk. 0 keeps none."
+        )
         self.args, self.remaining_args = self.arg_parser.parse_known_args()
 
         self.servname = self.args.tls_server_name
@@ -63,6 +96,11 @@ class Handler:
         self.client_key = self.args.tls_client_key
         self.root_subj = self.args.tls_root_ca
 
+        # The server-facing socket asks for whatever server name the client
+        # asked us for (see leaf_sign()), so it can't be set up before the
+        # client handshake unless that name is fixed.
+        self.needs_client_handshake = not self.static_servername
+
         self.cert_dir = os.path.join(
           os.path.abspath(os.path.dirname(__file__)),  # This file's location
           "certs"
@@ -72,6 +110,26 @@ class Handler:
         # https://gist.github.com/toolness/3073310
         self.key_size = 4096  # Should be >= 2048 or new OpenSSL versions grumble
         self.days_valid = 90  # It's on you to rotate your certs every 90 days
+        self.key_type = self.args.tls_key_type
+        self.cache_size = self.args.tls_cache_size
+
+        # Contexts are made once and shared by every connection in a process,
+        # rather than loading certificates from disk for each one. Leaf
+        # contexts are kept by server name, least recently used first, and
+        # the lock's for engines setting up connections on several threads.
+        # It's only held to look things up and put them away: leaf contexts
+        # are made without it, with a Future in minting for each name being
+        # made, so that other handshakes for the name wait on that instead of
+        # making it again, and handshakes for other names don't wait at all.
+        # ca_lock is for making the root CA and the things leaves share.
+        self.listen_context = None
+        self.send_context = None
+        self.leaf_contexts = collections.OrderedDict()
+        self.minting = {}
+        self.lock = threading.RLock()
+        self.ca_lock = threading.RLock()
+        self.ca = None  # Root CA certificate and key, once loaded
+        self.shared_key = None  # The one key for --tls_key_type rsa
     
         self.openssl_template = (
             "prompt = no\r\n"
@@ -98,69 +156,257 @@ class Handler:
         signed by that certificate based on the SNI of any connecting clients (if SNI
         is present anyway).
         """
-        tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        tls_context.verify_mode = ssl.CERT_NONE
-        if self.static_servername:
-            tls_context.load_cert_chain(self.serv_cert, self.serv_key)
-        else:
-            tls_context.set_servername_callback(
-                self.leaf_sign  # I literally cannot believe this worked
-            )
-        listen_sock = tls_context.wrap_socket(listen_sock,
-                                              server_side=True)
+        with self.lock:
+            if self.listen_context is None:
+                tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                tls_context.verify_mode = ssl.CERT_NONE
+                if self.static_servername:
+                    tls_context.load_cert_chain(self.serv_cert, self.serv_key)
+                else:
+                    tls_context.set_servername_callback(
+                        self.leaf_sign  # I literally cannot believe this worked
+                    )
+                self.listen_context = tls_context
+        listen_sock = self.listen_context.wrap_socket(listen_sock,
+                                                      server_side=True)
+        # Every connection shares this handler, so the server name the client
+        # asked for is kept with its connection, not on self.
+        cnxn_locals["tls_server_name"] = getattr(listen_sock, "intended_server_name",
+                                                 self.servname)
         listen_sock = TLSSock(listen_sock)
         return listen_sock
 
     def setup_server_facing(self, send_sock, cnxn_locals):
         # Core alsanna logic ensures this is only ever called after negotiating
-        # the client handshake, which is why we can assume self.servname is
-        # already set by leaf_sign() if it needed to be.
-        tls_context = ssl._create_unverified_context()
-        if self.client_cert is not None and self.client_key is not None:
-            tls_context.verify_mode = ssl.CERT_OPTIONAL
-            tls_context.load_cert_chain(certfile=self.client_cert,
-                                        keyfile=self.client_key)
-        tls_context.check_hostname = False
-        send_sock = tls_context.wrap_socket(
+        # the client handshake (see needs_client_handshake), which is why we
+        # can assume setup_client_facing() has put the server name the client
+        # asked for in cnxn_locals.
+        with self.lock:
+            if self.send_context is None:
+                tls_context = ssl._create_unverified_context()
+                if self.client_cert is not None and self.client_key is not None:
+                    tls_context.verify_mode = ssl.CERT_OPTIONAL
+                    tls_context.load_cert_chain(certfile=self.client_cert,
+                                                keyfile=self.client_key)
+                tls_context.check_hostname = False
+                self.send_context = tls_context
+        send_sock = self.send_context.wrap_socket(
                         send_sock,
-                        server_hostname=self.servname
+                        server_hostname=cnxn_locals.get("tls_server_name",
+                                                        self.servname)
                     )
         send_sock = TLSSock(send_sock)
         return send_sock
 
     def leaf_sign(self, ssl_sock, intended_server_name, ssl_context):
         """
-        Generate and sign a leaf certificate using the certificate supplied in the args.
+        Hand the client a leaf certificate for the server name it asked for,
+        signed by the certificate supplied in the args, making it if need be.
+        The name is noted on ssl_sock for setup_client_facing() to pick up.
+        """
+        if intended_server_name is not None:
+            ssl_sock.intended_server_name = intended_server_name
+        ssl_sock.context = self.leaf_context(getattr(ssl_sock, "intended_server_name",
+                                                     self.servname))
+
+    def leaf_context(self, servname):
+        """
+        A context with a leaf certificate for servname: from the cache if
+        we've used one lately, otherwise loaded from disk if we've made one
+        before, otherwise made now.
+        """
+        with self.lock:
+            new_context = self.leaf_contexts.get(servname)
+            if new_context is not None:
+                self.leaf_contexts.move_to_end(servname)
+                return new_context
+            minting = self.minting.get(servname)
+            if minting is not None:
+                waiting = True  # Someone else is making it already
+            else:
+                waiting = False
+                minting = self.minting[servname] = concurrent.futures.Future()
+        if waiting:
+            return minting.result()  # Raises whatever making it raised
+
+        try:
+            new_context = self.make_leaf_context(servname)
+        except BaseException as e:
+            with self.lock:
+                del self.minting[servname]
+            minting.set_exception(e)
+            raise
+        with self.lock:
+            del self.minting[servname]
+            if self.cache_size > 0:
+                self.leaf_contexts[servname] = new_context
+                if len(self.leaf_contexts) > self.cache_size:
+                    self.leaf_contexts.popitem(last=False)
+        minting.set_result(new_context)
+        return new_context
+
+    def make_leaf_context(self, servname):
+        """
+        A new context with a leaf certificate for servname, loaded from disk
+        or made now. Called without self.lock, since making one can take
+        seconds.
         """
-        self.servname = intended_server_name if intended_server_name is not None else self.servname
+        dom_dir = os.path.join(self.cert_dir, servname)
+        os.makedirs(dom_dir, exist_ok=True)
+        if x509 is not None:
+            leaf_cert, leaf_key = self.mint_leaf(servname, dom_dir)
+        else:
+            leaf_cert, leaf_key = self.openssl_leaf(servname, dom_dir)
+
+        new_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        new_context.verify_mode = ssl.CERT_NONE
+        new_context.load_cert_chain(leaf_cert, leaf_key)
+        return new_context
+
+    def mint_leaf(self, servname, dom_dir):
+        """
+        Make a leaf certificate for servname with cryptography, unless there's
+        one on disk already. The key and certificate go in one file, written
+        in one go, so other processes never find half of them. Returns the
+        certificate and key paths for load_cert_chain().
+        """
+        leaf_pem = os.path.join(dom_dir, servname + ".pem")
+        if os.path.isfile(leaf_pem):
+            return leaf_pem, None
+        ca_cert, ca_key = self.load_ca()
+        if self.key_type == "rsa":
+            leaf_key = self.load_shared_key()
+        else:
+            leaf_key = ec.generate_private_key(ec.SECP256R1())
+        try:
+            alt_names = [x509.IPAddress(ipaddress.ip_address(servname))]
+        except ValueError:
+            alt_names = [x509.DNSName(servname), x509.DNSName("*." + servname)]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = (x509.CertificateBuilder()
+                   .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, servname)]))
+                   .issuer_name(ca_cert.subject)
+                   .public_key(leaf_key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=self.days_valid))
+                   .add_extension(x509.BasicConstraints(ca=False, path_length=None),
+                                  critical=True)  # Leaf can't be CA
+                   .add_extension(x509.KeyUsage(
+                       digital_signature=True, content_commitment=True,
+                       key_encipherment=self.key_type == "rsa",
+                       data_encipherment=False, key_agreement=False,
+                       key_cert_sign=False, crl_sign=False, encipher_only=False,
+                       decipher_only=False), critical=True)
+                   .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]),
+                                  critical=False)
+                   .add_extension(x509.SubjectAlternativeName(alt_names),
+                                  critical=False)
+                   .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                       ca_key.public_key()), critical=False))
+        leaf_cert = builder.sign(ca_key, hashes.SHA256())
+        write_atomically(leaf_pem, private_pem(leaf_key)
+                         + leaf_cert.public_bytes(serialization.Encoding.PEM))
+        return leaf_pem, None
 
+    def load_ca(self):
+        """
+        The root CA's certificate and key, made first if there aren't any.
+        """
+        with self.ca_lock:
+            if self.ca is None:
+                if not os.path.isfile(self.serv_cert) or not os.path.isfile(self.serv_key):
+                    self.mint_ca()
+                with open(self.serv_cert, "rb") as cert_file:
+                    ca_cert = x509.load_pem_x509_certificate(cert_file.read())
+                with open(self.serv_key, "rb") as key_file:
+                    ca_key = serialization.load_pem_private_key(key_file.read(), None)
+                self.ca = ca_cert, ca_key
+            return self.ca
+
+    def mint_ca(self):
+        """
+        Make a root CA with the subject in --tls_root_ca, at --tls_serv_cert
+        and --tls_serv_key.
+        """
         if not os.path.isdir(self.cert_dir):
             os.mkdir(self.cert_dir)
+        if self.key_type == "rsa":
+            ca_key = rsa.generate_private_key(public_exponent=65537,
+                                              key_size=self.key_size)
+        else:
+            ca_key = ec.generate_private_key(ec.SECP256R1())
+        subject = x509.Name([
+            x509.NameAttribute(getattr(NameOID, SUBJECT_OIDS[name]), value)
+            for name, _, value in (part.partition("=")
+                                   for part in self.root_subj.split("/") if part)
+            if name in SUBJECT_OIDS
+        ])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        ca_cert = (x509.CertificateBuilder()
+                   .subject_name(subject)
+                   .issuer_name(subject)
+                   .public_key(ca_key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=self.days_valid))
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None),
+                                  critical=True)
+                   .add_extension(x509.KeyUsage(
+                       digital_signature=True, content_commitment=False,
+                       key_encipherment=False, data_encipherment=False,
+                       key_agreement=False, key_cert_sign=True, crl_sign=True,
+                       encipher_only=False, decipher_only=False), critical=True)
+                   .add_extension(x509.SubjectKeyIdentifier.from_public_key(
+                       ca_key.public_key()), critical=False)
+                   .sign(ca_key, hashes.SHA256()))
+        write_atomically(self.serv_key, private_pem(ca_key))
+        write_atomically(self.serv_cert, ca_cert.public_bytes(serialization.Encoding.PEM))
 
-        if not os.path.isfile(self.serv_cert) or not os.path.isfile(self.serv_key):
-            subprocess.check_output(
-                ['openssl', 'req', '-nodes', '-new', '-newkey', str(self.key_size),
-                 '-x509', '-subj', self.root_subj, '-keyout', self.serv_key, '-out', self.serv_cert],
-                stderr=subprocess.DEVNULL
-            )
+    def load_shared_key(self):
+        """
+        The RSA key every leaf certificate shares with --tls_key_type rsa,
+        made the first time it's needed and kept in the certs directory.
+        """
+        with self.ca_lock:
+            if self.shared_key is None:
+                key_path = os.path.join(self.cert_dir, "leaf_rsa_key.pem")
+                if not os.path.isfile(key_path):
+                    write_atomically(key_path, private_pem(rsa.generate_private_key(
+                        public_exponent=65537, key_size=2048)))
+                with open(key_path, "rb") as key_file:
+                    self.shared_key = serialization.load_pem_private_key(key_file.read(), None)
+            return self.shared_key
 
-        dom_dir = os.path.join(self.cert_dir, self.servname)
-        if not os.path.isdir(dom_dir):
-            os.mkdir(dom_dir)
-    
-        conf_path = os.path.join(dom_dir, self.servname + ".conf")
-        leaf_cert = os.path.join(dom_dir, self.servname + ".cert")
-        leaf_key = os.path.join(dom_dir, self.servname + ".key")
-        sign_req_path = os.path.join(dom_dir, self.servname + ".req")
+    def openssl_leaf(self, servname, dom_dir):
+        """
+        Make a leaf certificate for servname by running openssl, unless there's
+        one on disk already, for when cryptography isn't installed. Returns the
+        certificate and key paths for load_cert_chain().
+        """
+        with self.ca_lock:
+            if not os.path.isfile(self.serv_cert) or not os.path.isfile(self.serv_key):
+                subprocess.check_output(
+                    ['openssl', 'req', '-nodes', '-new', '-newkey', self.openssl_key_spec(),
+                     '-x509', '-subj', self.root_subj, '-keyout', self.serv_key, '-out', self.serv_cert],
+                    stderr=subprocess.DEVNULL
+                )
+
+        conf_path = os.path.join(dom_dir, servname + ".conf")
+        leaf_cert = os.path.join(dom_dir, servname + ".cert")
+        leaf_key = os.path.join(dom_dir, servname + ".key")
+        sign_req_path = os.path.join(dom_dir, servname + ".req")
 
         if not os.path.isfile(leaf_cert) or not os.path.isfile(leaf_key):
             with open(conf_path, "w") as conffile:
-                conffile.write(self.openssl_template.format(self.servname))
+                conffile.write(self.openssl_template.format(servname))
             # Generate key
-            subprocess.check_output(
-                ['openssl', 'genrsa', '-out', leaf_key, str(self.key_size)],
-                stderr=subprocess.DEVNULL
-            )
+            if self.key_type == "rsa":
+                key_command = ['openssl', 'genrsa', '-out', leaf_key, str(self.key_size)]
+            else:
+                key_command = ['openssl', 'ecparam', '-genkey', '-noout',
+                               '-name', 'prime256v1', '-out', leaf_key]
+            subprocess.check_output(key_command, stderr=subprocess.DEVNULL)
             # Generate cert signing request
             subprocess.check_output(
                 ['openssl', 'req', '-new', '-key', leaf_key, '-out',
@@ -176,10 +422,27 @@ class Handler:
                  conf_path],
                 stderr=subprocess.DEVNULL
             )
-        new_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        new_context.verify_mode = ssl.CERT_NONE
-        new_context.load_cert_chain(leaf_cert, leaf_key)
-        ssl_sock.context = new_context
+        return leaf_cert, leaf_key
+
+    def openssl_key_spec(self):
+        """
+        openssl req's -newkey argument for --tls_key_type.
+        """
+        return str(self.key_size) if self.key_type == "rsa" else "ec:" + self.ec_params()
+
+    def ec_params(self):
+        """
+        A file of P-256 parameters, for openssl req -newkey ec:...
+        """
+        params_path = os.path.join(self.cert_dir, "prime256v1.pem")
+        if not os.path.isfile(params_path):
+            if not os.path.isdir(self.cert_dir):
+                os.mkdir(self.cert_dir)
+            subprocess.check_output(
+                ['openssl', 'ecparam', '-name', 'prime256v1', '-out', params_path],
+                stderr=subprocess.DEVNULL
+            )
+        return params_path
 
     # Haven't implemented dissection of TLS as a protocol, just relying on
     # Python. For cases like this, where you haven't actually got a way of
@@ -191,6 +454,26 @@ class Handler:
     def printable_to_obj(self, printable, unprintable_state):
         raise NotImplementedError  # Don't use tls as the final handler
 
+def private_pem(key):
+    """
+    key, unencrypted, as PEM bytes.
+    """
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def write_atomically(path, data):
+    """
+    Write data to path through a temporary file renamed into place, so no one
+    reading path sees it half written.
+    """
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(descriptor, "wb") as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+
 class TLSSock():
     """
     Implements the needed loops for sending/recving on a socket (similar to recvall and
@@ -208,11 +491,12 @@ class TLSSock():
 
     def send(self, bytes):
         sent = 0
-        while sent < len(bytes):  # Send everything we can
-            try:
-                sent += self.sock.send(bytes[sent:])
-            except ssl.SSLWantWriteError:
-                continue
+        with memoryview(bytes) as view:  # Slicing a view doesn't copy
+            while sent < len(view):  # Send everything we can
+                try:
+                    sent += self.sock.send(view[sent:])
+                except ssl.SSLWantWriteError:
+                    continue
         return sent
 
     def recv(self, num_bytes):
@@ -221,3 +505,10 @@ class TLSSock():
                 return self.sock.recv(num_bytes)
             except ssl.SSLWantReadError:
                 continue
+
+    def recv_into(self, buffer, num_bytes=0):
+        while True:
+            try:
+                return self.sock.recv_into(buffer, num_bytes)
+            except ssl.SSLWantReadError:
+                continue
@@ -0,0 +1,205 @@
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+
+# Plumbing for getting messages between connections and the user interface
+# process. Connections register one of these with the UI per direction of
+# travel, the same way they used to register a Manager's Queue, and the UI
+# put()s each message back on it once it's been displayed (and maybe edited).
+# Registration waits until the first message that needs to come back, so
+# connections that are only ever watched never bother the UI with one.
+
+class ResultChannel():
+    """
+    A one-way pipe from the user interface back to a connection. Much cheaper
+    than a Manager Queue: there's no server process to start, and put()/get()
+    are a single write/read on a pipe rather than a proxied call.
+
+    Only the writing end survives being sent to another process (e.g. over
+    display_q), since the reading end is only any use to the connection.
+
+    With a payload_size (--payload_transport shm), the channel also gets a
+    PayloadSlab when it's registered, and wrap()/unwrap() pass messages through
+    it: both ways, the queue or pipe carries only a small Payload descriptor.
+    """
+    def __init__(self, reader=None, writer=None, payload_size=0, slab_name=None):
+        if reader is None and writer is None:
+            reader, writer = multiprocessing.Pipe(duplex=False)
+        self.reader = reader
+        self.writer = writer
+        self.registered = False
+        self.payload_size = payload_size
+        self.slab = None
+        self.slab_name = slab_name  # Attached by the UI when it's first used
+
+    def __reduce__(self):
+        return (ResultChannel, (None, self.writer, self.payload_size,
+                                self.slab.name if self.slab else None))
+
+    def register(self, display_q, name):
+        """
+        Hand the writing end to the user interface as name, unless we already
+        have. The UI can only pick it up while this process is alive to pass it
+        over, so do this right before a message we're going to wait on.
+        """
+        if not self.registered:
+            if self.payload_size:
+                self.slab = PayloadSlab(self.payload_size)
+            display_q.put((name, self))
+            self.registered = True
+
+    def put(self, message):
+        self.writer.send(message)
+
+    def get(self):
+        return self.reader.recv()  # Blocks until message available
+
+    def wrap(self, message):
+        """
+        What to send in place of message (a string): a Payload if it's been
+        written to the slab, or message itself if there's no slab or it doesn't
+        fit.
+        """
+        if self.slab is None and self.slab_name is not None:
+            self.slab = PayloadSlab(name=self.slab_name)
+        if self.slab is None or not isinstance(message, str):
+            return message
+        return self.slab.write(message)
+
+    def unwrap(self, message):
+        """
+        The inverse of wrap(), on the other side.
+        """
+        if not isinstance(message, Payload):
+            return message
+        if self.slab is None:
+            self.slab = PayloadSlab(name=self.slab_name)
+        return self.slab.read(message)
+
+    def fileno(self):
+        """
+        The reading end's file descriptor, for use with select() or an event
+        loop.
+        """
+        return self.reader.fileno()
+
+    def close(self):
+        for end in (self.reader, self.writer):
+            if end is not None:
+                end.close()
+        if self.slab is not None:
+            self.slab.close()
+
+
+# Where a message passed through a PayloadSlab is: length bytes of UTF-8 after
+# the header, written as the generation'th message.
+Payload = collections.namedtuple("Payload", ["length", "generation"])
+
+
+class PayloadSlab():
+    """
+    A shared memory segment that one direction of a connection and the user
+    interface pass intercepted messages through, in place of pickling them
+    onto display_q and back down the ResultChannel's pipe. Only one message per
+    direction is ever in flight (the connection waits for it to come back), so
+    it only needs the one slot: an 8 byte generation count, then the message.
+    The generation catches a descriptor being read after its message has been
+    overwritten, which would be a bug.
+
+    Made with a size by the connection, which owns it and unlinks it on
+    close(); attached to by name in the user interface.
+    """
+    HEADER = 8
+
+    def __init__(self, size=0, name=None):
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=size + self.HEADER)
+        else:
+            # Python < 3.13 tells the resource tracker about segments we only
+            # attach to, as if we'd made them, but alsanna.main() starts one
+            # tracker for every process to share, so that's harmless.
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+    def write(self, message):
+        """
+        Write message (a string) to the slab, returning its Payload, or
+        message itself if it doesn't fit.
+        """
+        encoded = message.encode("utf-8", "surrogatepass")
+        if len(encoded) > self.shm.size - self.HEADER:
+            return message
+        generation = int.from_bytes(self.shm.buf[:self.HEADER], "little") + 1
+        self.shm.buf[self.HEADER:self.HEADER + len(encoded)] = encoded
+        self.shm.buf[:self.HEADER] = generation.to_bytes(self.HEADER, "little")
+        return Payload(len(encoded), generation)
+
+    def read(self, payload):
+        """
+        The message a Payload describes, decoded straight out of the slab.
+        """
+        if int.from_bytes(self.shm.buf[:self.HEADER], "little") != payload.generation:
+            raise RuntimeError("Payload overwritten before it was read")
+        return str(self.shm.buf[self.HEADER:self.HEADER + payload.length],
+                   "utf-8", "surrogatepass")
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:  # Still being read; it goes when the reader's done
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class InterceptState():
+    """
+    Which directions of travel are currently intercepted for editing. Lives in
+    shared memory so that the user interface can flip it with a keypress and
+    every connection, in whatever process, sees the change on its next message.
+    """
+    hosts = ("client", "server")
+
+    def __init__(self, client, server):
+        self.flags = multiprocessing.RawArray('b', [client, server])
+
+    def __getitem__(self, host):
+        return bool(self.flags[self.hosts.index(host)])
+
+    def __setitem__(self, host, intercept):
+        self.flags[self.hosts.index(host)] = intercept
+
+
+class DisplayRing():
+    """
+    Bounds how many watched-only messages can be waiting on the user interface
+    at once, across every connection. A connection offer()s before sending one
+    and the user interface release()s once it's been printed, so when the
+    terminal can't keep up messages are skipped rather than queued forever.
+    With wait, connections wait for the user interface to catch up instead,
+    for when every message has to be recorded (--headless).
+    """
+    def __init__(self, size, wait=False):
+        self.slots = multiprocessing.BoundedSemaphore(size)
+        self.wait = wait  # Whether offer() waits for a slot instead
+
+    def offer(self):
+        """
+        Claim a slot if one's free, without waiting unless self.wait. Returns
+        whether we did.
+        """
+        return self.slots.acquire(block=self.wait)
+
+    def release(self):
+        self.slots.release()
+
+
+# What connections send the user interface (with the id "View") about traffic
+# it's only watching: readable is the message's printable form (or the message
+# itself, with --session_log_raw), skipped counts earlier messages there was no
+# room for (see DisplayRing), size is the message's size in bytes if it has
+# one, and kind is "message", or "summary" for --watch_mode summary's counts.
+View = collections.namedtuple("View", ["connection_id", "readable", "skipped",
+                                       "size", "timestamp", "kind"])
@@ -0,0 +1,349 @@
+import argparse
+import importlib
+import socket
+import statistics
+import threading
+import time
+import capture, cnxn_utils
+
+# Replays the client side of connections recorded with --capture against a
+# server, through the same handlers alsanna would use to connect to it, and
+# reports how quickly the server kept up. Run this file instead of alsanna.py;
+# it takes the same --handlers (and handler options), --server_ip and
+# --server_port, e.g.
+#
+#     python replay.py session.cap --handlers tls rawbytes --server_port 443 \
+#                      --copies 50 --speed 0
+#
+# Each connection is replayed in order: the client's messages are sent as they
+# were sent on by alsanna (edited, if they were), and after each one we wait
+# for as many bytes as the server sent back in the capture before sending the
+# next, at most --response_timeout seconds. The time that takes is the
+# response latency. With --speed, messages also wait for their turn in the
+# original timeline, sped up or slowed down; --speed 0 doesn't wait at all.
+#
+# Captures record each message as the last handler's bytes on the wire, so
+# if the last handler's messages aren't bytes (it has obj_to_bytes(), like
+# ldap), those bytes are sent through the handlers before it instead. Protocol
+# logic in that last handler (like LDAP's StartTLS) isn't replayed.
+
+arg_parser = argparse.ArgumentParser(allow_abbrev=False, add_help=False,
+                                     conflict_handler='resolve')
+arg_parser.add_argument(
+    "capture", type=str,
+    help="A capture made with alsanna's --capture."
+)
+arg_parser.add_argument(
+    "--handlers", type=str, nargs="+", default=["tls", "rawbytes"],
+    help="Handlers to connect to the server through, as for alsanna. They "
+         "should be the ones the capture was made with."
+)
+arg_parser.add_argument(
+    "--server_ip", type=str, default="127.0.0.1",
+    help="The IP address of the server to replay against."
+)
+arg_parser.add_argument(
+    "--server_port", type=int, default=3125,
+    help="TCP port on the server to replay against."
+)
+arg_parser.add_argument(
+    "--connections", type=int, nargs="+", default=None,
+    help="Ids of the captured connections to replay. All of them by default."
+)
+arg_parser.add_argument(
+    "--copies", type=int, default=1,
+    help="Number of copies of each connection to replay at once."
+)
+arg_parser.add_argument(
+    "--speed", type=float, default=1.0,
+    help="Multiplier for the pace of the original timeline: 2 replays twice "
+         "as fast, 0.5 half as fast, and 0 as fast as the server answers."
+)
+arg_parser.add_argument(
+    "--response_timeout", type=float, default=5.0,
+    help="Seconds to wait for the server's response to a message before "
+         "giving up on it and sending the next one."
+)
+arg_parser.add_argument(
+    "--read_size", type=int, default=65536,
+    help="Number of bytes to read from the server at once."
+)
+
+args, remaining_args = arg_parser.parse_known_args()
+for i in range(len(args.handlers)):
+    final = True if i == len(args.handlers)-1 else False
+    handler_module = importlib.import_module('handlers.' + args.handlers[i])
+    args.handlers[i] = handler_module.Handler(arg_parser, final)
+    arg_parser = args.handlers[i].arg_parser
+    if i > 0 and hasattr(args.handlers[i], "set_previous"):
+        args.handlers[i].set_previous(args.handlers[i-1])
+handlers = args.handlers
+args = args.handlers[-1].args
+args.handlers = handlers
+
+
+class Session():
+    """
+    The client's side of one captured connection: what the server said before
+    the client's first message (greeting bytes), then for each client message,
+    when it was sent (ns since the connection's first record), its bytes, and
+    how many bytes the server sent back before the client's next one.
+    """
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.greeting = 0
+        self.steps = []  # [delay_ns, data, response_bytes]
+        self.start = None
+        self.offset = 0  # ns from the capture's first connection to this one
+        self.original = {}  # Intercepted message waiting on its outcome
+
+
+def load_sessions(path, connection_ids=None):
+    """
+    Read the captured connections, in order of connection id.
+    """
+    sessions = {}
+    reader = capture.Reader(path)
+    for offset, rtype, role, direction, flags, connection, timestamp, payload \
+            in reader.messages():
+        if connection_ids is not None and connection not in connection_ids:
+            continue
+        session = sessions.setdefault(connection, Session(connection))
+        if session.start is None:
+            session.start = timestamp
+        if flags & capture.NOT_WIRE:
+            raise ValueError("Connection " + str(connection) + " wasn't "
+                             "captured as bytes, so it can't be replayed")
+        if role == capture.ORIGINAL:
+            session.original[direction] = payload
+            if direction == capture.CLIENT:
+                continue
+            sent = payload  # The server sent the original, whatever we did
+        elif direction == capture.SERVER:
+            if role != capture.WATCHED:
+                continue  # Already counted as the original
+            sent = payload
+        else:
+            sent = session.original.pop(direction, b"") \
+                   if role == capture.UNCHANGED else payload
+        if direction == capture.CLIENT:
+            session.steps.append([timestamp - session.start, sent, 0])
+        elif session.steps:
+            session.steps[-1][2] += len(sent)
+        else:
+            session.greeting += len(sent)
+    reader.close()
+    if sessions:
+        first = min(session.start for session in sessions.values())
+        for session in sessions.values():
+            session.offset = session.start - first
+    return [sessions[connection] for connection in sorted(sessions)]
+
+
+def replay_handlers(handlers):
+    """
+    The handlers to send captured bytes through: all of them, unless the last
+    one's messages aren't bytes (see obj_to_bytes() in handlers/prototype).
+    Handlers that only work on the messages of the one before them (like hook)
+    add nothing on the wire, and what was captured has been through them.
+    """
+    while len(handlers) > 1 and hasattr(handlers[-1], "set_previous"):
+        handlers = handlers[:-1]
+    if hasattr(handlers[-1], "obj_to_bytes"):
+        return handlers[:-1]
+    return handlers
+
+
+class Replayer():
+    """
+    Replays one copy of a Session, collecting statistics in results.
+    """
+    def __init__(self, session, results, args):
+        self.session = session
+        self.results = results
+        self.args = args
+        self.received = 0
+        self.closed = False
+        self.arrived = threading.Condition()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        cnxn_locals = {"cnxn_id": str(self.session.connection_id)}
+        for handler in replay_handlers(self.args.handlers):
+            sock = handler.setup_server_facing(send_sock=sock,
+                                               cnxn_locals=cnxn_locals)
+        sock.connect((self.args.server_ip, self.args.server_port))
+        return sock
+
+    def send(self, sock, data):
+        if type(sock) is socket.socket:
+            sock.sendall(data)
+        else:
+            sock.send(data)
+
+    def receive(self, sock):
+        """
+        The receiving thread: count what the server sends.
+        """
+        try:
+            while True:
+                data = sock.recv(self.args.read_size)
+                if not data:  # Handler sockets say closed with None
+                    break
+                with self.arrived:
+                    self.received += len(data)
+                    self.arrived.notify()
+        except OSError:
+            pass
+        finally:
+            with self.arrived:
+                self.closed = True
+                self.arrived.notify()
+
+    def pace(self, start, delay):
+        """
+        Sleep until delay ns (of the original timeline) after start.
+        """
+        wait = start + delay / 1e9 / self.args.speed - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def wait_for(self, total):
+        """
+        Wait until the server's sent total bytes, returning whether it did.
+        """
+        deadline = time.monotonic() + self.args.response_timeout
+        with self.arrived:
+            while self.received < total and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.arrived.wait(remaining)
+            return self.received >= total
+
+    def run(self):
+        if self.args.speed > 0:  # Connect when this connection first did
+            self.pace(self.results.start, self.session.offset)
+        try:
+            sock = self.connect()
+        except Exception as e:
+            self.results.error("Connecting: " + repr(e))
+            return
+        receiver = threading.Thread(target=self.receive, args=(sock,),
+                                    daemon=True)
+        receiver.start()
+        try:
+            expected = self.session.greeting
+            if expected and not self.wait_for(expected):
+                self.results.timed_out()
+            start = time.monotonic()
+            for delay, data, response in self.session.steps:
+                if self.args.speed > 0:
+                    self.pace(start, delay)
+                sent = time.monotonic()
+                self.send(sock, data)
+                self.results.sent(len(data))
+                if response:
+                    expected += response
+                    if self.wait_for(expected):
+                        self.results.responded(time.monotonic() - sent)
+                    else:
+                        self.results.timed_out()
+        except Exception as e:
+            self.results.error("Replaying: " + repr(e))
+        finally:
+            # Hang up without waiting on the server to: shutting the socket
+            # down wakes the receiving thread, if we can get at it.
+            raw = sock if type(sock) is socket.socket \
+                  else cnxn_utils.raw_socket(sock)
+            try:
+                if raw is not None:
+                    raw.shutdown(socket.SHUT_RDWR)
+                sock.close()
+            except OSError:
+                pass
+            receiver.join(self.args.response_timeout)
+            self.results.received(self.received)
+
+
+class Results():
+    """
+    Statistics for the whole replay, shared by every Replayer.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = None  # When the replay began
+        self.messages = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = []
+        self.timeouts = 0
+        self.errors = []
+
+    def sent(self, num_bytes):
+        with self.lock:
+            self.messages += 1
+            self.bytes_sent += num_bytes
+
+    def received(self, num_bytes):
+        with self.lock:
+            self.bytes_received += num_bytes
+
+    def responded(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+    def report(self, sessions, elapsed):
+        megabytes = 1024 * 1024
+        print("Replayed " + str(sessions) + " connections in "
+              + "{0:.2f} s".format(elapsed))
+        print("  sent {0} messages ({1:.2f} MB): {2:.1f} messages/s, "
+              "{3:.2f} MB/s".format(self.messages, self.bytes_sent / megabytes,
+                                    self.messages / elapsed,
+                                    self.bytes_sent / megabytes / elapsed))
+        print("  received {0:.2f} MB: {1:.2f} MB/s".format(
+              self.bytes_received / megabytes,
+              self.bytes_received / megabytes / elapsed))
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            if len(latencies) > 1:
+                percentiles = statistics.quantiles(latencies, n=100,
+                                                   method="inclusive")
+            else:
+                percentiles = latencies * 99
+            print("  response latency (ms): min {0:.2f}, p50 {1:.2f}, p90 {2:.2f}, "
+                  "p99 {3:.2f}, max {4:.2f} ({5} responses)".format(
+                  latencies[0] * 1000, percentiles[49] * 1000,
+                  percentiles[89] * 1000, percentiles[98] * 1000,
+                  latencies[-1] * 1000, len(latencies)))
+        print("  timed out waiting for a response: " + str(self.timeouts))
+        print("  errors: " + str(len(self.errors)))
+        for error in sorted(set(self.errors)):
+            print("    " + error + " (x" + str(self.errors.count(error)) + ")")
+
+
+def main():
+    sessions = load_sessions(args.capture, args.connections)
+    results = Results()
+    replayers = [Replayer(session, results, args)
+                 for session in sessions for i in range(args.copies)]
+    threads = [threading.Thread(target=replayer.run, daemon=True)
+               for replayer in replayers]
+    results.start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.report(len(replayers), time.monotonic() - results.start)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import json
+import multiprocessing
+import re
+
+# --rules: tampering that doesn't need a person. A rules file is a JSON list
+# of rules, compiled once at startup and applied by the connection processes
+# to every message as it arrives, before it goes anywhere near the user
+# interface. For example:
+#
+# [
+#   {"name": "guest bind", "direction": "client",
+#    "where": {"protocolOp/bindRequest/name": "cn=admin,dc=example,dc=com"},
+#    "set": {"protocolOp/bindRequest/name": "cn=guest,dc=example,dc=com"}},
+#   {"name": "no paged results", "remove": "controls",
+#    "where_item": {"controlType": "1.2.840.113556.1.4.319"}},
+#   {"name": "http 1.0", "bytes": "HTTP/1\\.1\\r\\n", "replace": "HTTP/1.0\\r\\n"},
+#   {"name": "flip a bit", "bytes": "^\\x16\\x03", "xor": {"5": 1}},
+#   {"name": "no pings", "bytes": "^PING", "drop": true},
+#   {"name": "don't stop for uploads", "bytes": "^PUT ", "intercept": false}
+# ]
+#
+# Every rule can say which "direction" it's for ("client" for messages from
+# the client, "server" for messages from the server), and has a "name" for the
+# hit counts alsanna notes every --rules_report seconds. Then it either works
+# on bytes, for handlers whose messages are bytes (like rawbytes):
+#     bytes    a regular expression over the message (a str, taken byte for
+#              byte; escapes like \x00 work as they do in Python's re), which
+#              has to match for the rule to apply
+#     replace  what to replace each match with, as re.sub() takes it
+#     count    at most how many matches to replace, 0 (the default) for all
+#     xor      {offset: mask}: XOR the byte at each offset (negative counts
+#              from the end) with mask
+# or on the fields of messages that are objects (like ldap's), named by paths
+# through the message as it's shown in the editor, separated by "/":
+#     where       {path: value}: every path has to be in the message, with
+#                 that value, for the rule to apply
+#     set         {path: value}: set each path to value
+#     remove      a path to remove from the message, or with where_item, a
+#                 path to a list to remove items from
+#     where_item  {path: value}: which items of the remove list to remove,
+#                 with paths from each item
+# Either kind can instead "drop" the message, so it's never sent on, or say
+# whether it's "intercept"ed. Messages a rule says aren't intercepted go
+# straight on (rewritten) even while interception is on, which is how mostly
+# automated tampering keeps up; rules can intercept messages while it's off,
+# too. Rules apply in order, each to what the one before left.
+
+BYTES_ACTIONS = ("replace", "count", "xor")
+FIELD_ACTIONS = ("where", "set", "remove", "where_item")
+COMMON = ("name", "direction", "drop", "intercept", "comment")
+
+
+class Rule():
+    """
+    One compiled rule.
+    """
+    def __init__(self, number, spec):
+        if not isinstance(spec, dict):
+            raise ValueError("Rule " + str(number) + " isn't a JSON object")
+        self.name = str(spec.get("name", "rule " + str(number)))
+        known = COMMON + (("bytes",) + BYTES_ACTIONS if "bytes" in spec
+                          else FIELD_ACTIONS)
+        unknown = [key for key in spec if key not in known]
+        if unknown:
+            raise ValueError("Rule '" + self.name + "' has "
+                             + ", ".join(unknown) + ", which "
+                             + ("don't go with bytes" if "bytes" in spec
+                                else "aren't rule keys")
+                             + " (see rewrite_rules.py)")
+        self.direction = spec.get("direction")
+        if self.direction not in (None, "client", "server"):
+            raise ValueError("Rule '" + self.name + "' has a direction other "
+                             "than client or server")
+        self.drop = bool(spec.get("drop", False))
+        self.intercept = spec.get("intercept")
+
+        self.pattern = None
+        if "bytes" in spec:
+            try:
+                self.pattern = re.compile(spec["bytes"].encode("latin-1"),
+                                          re.DOTALL)
+                self.replace = None
+                if "replace" in spec:
+                    self.replace = spec["replace"].encode("latin-1")
+                    self.pattern.sub(self.replace, b"")  # Check the template
+            except (re.error, UnicodeEncodeError, AttributeError) as e:
+                raise ValueError("Rule '" + self.name + "' has a bad bytes "
+                                 "pattern or replacement: " + str(e))
+            self.count = int(spec.get("count", 0))
+            self.xor = [(int(offset), int(mask) & 0xff)
+                        for offset, mask in spec.get("xor", {}).items()]
+        else:
+            self.where = [(split_path(path), value)
+                          for path, value in spec.get("where", {}).items()]
+            self.set = [(split_path(path), value)
+                        for path, value in spec.get("set", {}).items()]
+            self.remove = split_path(spec["remove"]) if "remove" in spec else None
+            self.where_item = [(split_path(path), value) for path, value
+                               in spec.get("where_item", {}).items()]
+            if self.where_item and self.remove is None:
+                raise ValueError("Rule '" + self.name + "' has where_item "
+                                 "without remove")
+
+    def applies(self, msg_obj, listen):
+        """
+        Whether this rule applies to msg_obj from listen.
+        """
+        if self.direction is not None and self.direction != listen:
+            return False
+        if self.pattern is not None:
+            return isinstance(msg_obj, (bytes, bytearray)) \
+                   and self.pattern.search(msg_obj) is not None
+        if isinstance(msg_obj, (bytes, bytearray)):
+            return False
+        return all(matches(msg_obj, path, value) for path, value in self.where)
+
+    def rewrite(self, msg_obj):
+        """
+        Make this rule's changes to msg_obj, which it applies to, returning
+        the result. Bytes are replaced; objects are changed in place.
+        """
+        if self.pattern is not None:
+            if self.replace is not None:
+                msg_obj = self.pattern.sub(self.replace, msg_obj, self.count)
+            if self.xor:
+                msg_obj = bytearray(msg_obj)
+                for offset, mask in self.xor:
+                    if -len(msg_obj) <= offset < len(msg_obj):
+                        msg_obj[offset] ^= mask
+                msg_obj = bytes(msg_obj)
+            return msg_obj
+        for path, value in self.set:
+            parent = lookup(msg_obj, path[:-1])
+            if parent is not None:
+                parent[path[-1]] = value
+        if self.remove is not None:
+            remove(msg_obj, self.remove, self.where_item)
+        return msg_obj
+
+    def changes(self):
+        """
+        Whether this rule ever changes a message, rather than just dropping
+        it or deciding whether it's intercepted.
+        """
+        if self.pattern is not None:
+            return self.replace is not None or bool(self.xor)
+        return bool(self.set) or self.remove is not None
+
+
+class Rules():
+    """
+    Every rule from a rules file, compiled, with hit counts shared by every
+    process (a hit being a message a rule applied to). Made once by alsanna
+    before any connection process starts, and shared with them through args.
+    """
+    def __init__(self, path):
+        try:
+            with open(path) as rules_file:
+                specs = json.load(rules_file)
+        except (OSError, ValueError) as e:
+            raise ValueError("Can't read rules from " + path + ": " + str(e))
+        if not isinstance(specs, list):
+            raise ValueError(path + " should hold a JSON list of rules")
+        self.rules = [Rule(number, spec) for number, spec in enumerate(specs, 1)]
+        self.hits = multiprocessing.RawArray('Q', len(self.rules))
+        self.lock = multiprocessing.Lock()
+
+    def apply(self, msg_obj, listen, intercept, on_change=None):
+        """
+        Apply the rules to msg_obj, from listen. intercept is whether it'd be
+        intercepted without them, and on_change, if given, is called with the
+        message as it arrived before anything changes it.
+
+        Returns the message to send on (None if a rule dropped it), whether
+        it's intercepted, and whether any rule changed it.
+        """
+        hits = []
+        changed = False
+        if isinstance(msg_obj, list):  # Coalesced reads are still bytes
+            msg_obj = b"".join(msg_obj)  # Read together, matched together
+        for number, rule in enumerate(self.rules):
+            if not rule.applies(msg_obj, listen):
+                continue
+            hits.append(number)
+            if rule.drop:
+                msg_obj = None
+                break
+            if rule.intercept is not None:
+                intercept = bool(rule.intercept)
+            if rule.changes():
+                if not changed and on_change is not None:
+                    on_change(msg_obj)
+                msg_obj = rule.rewrite(msg_obj)
+                changed = True
+        if hits:
+            with self.lock:
+                for number in hits:
+                    self.hits[number] += 1
+        return msg_obj, intercept, changed
+
+    def report(self):
+        """
+        The hit counts, for a Note.
+        """
+        return "Rewrite rule hits: " + ", ".join(
+            rule.name + ": " + str(self.hits[number])
+            for number, rule in enumerate(self.rules))
+
+
+def split_path(path):
+    """
+    Steps along a path like "protocolOp/bindRequest/name" or "controls/0",
+    with list indexes as ints.
+    """
+    return [int(step) if step.lstrip("-").isdigit() else step
+            for step in str(path).split("/") if step != ""]
+
+
+def lookup(obj, path):
+    """
+    What's at path in obj, or None if it isn't there. Only steps into
+    components that are actually present, so looking doesn't add anything
+    (asking an ASN.1 CHOICE for an alternative it isn't can switch it).
+    """
+    for step in path:
+        try:
+            if isinstance(step, int):
+                obj = obj[step]
+            elif step in obj:
+                obj = obj[step]
+            else:
+                return None
+        except (KeyError, IndexError, TypeError):
+            return None
+        if getattr(obj, "isValue", True) is False:  # An unset ASN.1 component
+            return None
+    return obj
+
+
+def matches(obj, path, value):
+    """
+    Whether what's at path in obj is value, comparing as the thing itself or
+    as text (so an enumeration matches by number or by name).
+    """
+    found = lookup(obj, path)
+    if found is None:
+        return False
+    try:
+        if found == value:
+            return True
+    except Exception:  # Some types won't compare with just anything
+        pass
+    return str(found) == str(value)
+
+
+def remove(obj, path, where_item):
+    """
+    Remove what's at path in obj, or with where_item, the items of the list
+    at path that match all of it.
+    """
+    parent = lookup(obj, path[:-1])
+    if parent is None or lookup(parent, path[-1:]) is None:
+        return
+    if where_item:
+        items = parent[path[-1]]
+        keep = [item for item in items
+                if not all(matches(item, item_path, value)
+                           for item_path, value in where_item)]
+        if len(keep) < len(items):
+            items.clear()
+            items.extend(keep)
+        return
+    if isinstance(path[-1], int):  # An item of a list, so the rest move up
+        keep = [item for number, item in enumerate(parent)
+                if number != path[-1] % len(parent)]
+        parent.clear()
+        parent.extend(keep)
+        return
+    try:
+        del parent[path[-1]]
+    except (TypeError, AttributeError):  # ASN.1 components are unset instead
+        from pyasn1.type.univ import noValue
+        parent[path[-1]] = noValue
@@ -0,0 +1,131 @@
+import base64
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+# Writing for --headless: instead of printing to a terminal, the user interface
+# process writes every message it's sent as one line of JSON to a session log.
+# Records are buffered and written in large blocks, flushed at least every
+# flush_interval seconds, and once the log reaches max_bytes it's set aside as
+# <path>.000001, <path>.000002, ... (gzipped in the background if asked) and a
+# new one started.
+
+class SessionLog():
+    """
+    A rotating, buffered JSON Lines log. Only the user interface process should
+    write to it.
+    """
+    def __init__(self, path, max_bytes, keep, flush_interval, compress):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep  # Rotated logs to keep, 0 for all of them
+        self.flush_interval = flush_interval
+        self.compressor = None
+        if compress:
+            self.to_compress = queue.Queue()
+            self.compressor = threading.Thread(target=self.compress_rotated,
+                                               daemon=True)
+            self.compressor.start()
+
+        # Carry on numbering from any logs rotated by a previous run.
+        self.rotations = max([self.rotation_number(rotated)
+                              for rotated in self.rotated_logs()] + [0])
+        self.log = open(path, "ab", buffering=1024 * 1024)
+        self.size = self.log.tell()
+        self.last_flush = time.monotonic()
+
+    def record(self, kind, connection_id=None, direction=None, message=None,
+               size=None, timestamp=None):
+        """
+        Write one record. kind is "message", "summary", "error" or "note".
+        message is the printable form of a message, or the message itself if
+        it's bytes (stored base64-encoded as "raw").
+        """
+        entry = {"time": time.time() if timestamp is None else timestamp,
+                 "kind": kind}
+        if connection_id is not None:
+            entry["connection"] = connection_id
+            entry["direction"] = direction
+        if size is not None:
+            entry["size"] = size
+        if isinstance(message, (bytes, bytearray)):
+            entry["raw"] = base64.b64encode(message).decode("ascii")
+        elif message is not None:
+            entry["printable"] = message
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        self.log.write(line)
+        self.size += len(line)
+        if self.size >= self.max_bytes:
+            self.rotate()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.log.flush()
+            self.last_flush = time.monotonic()
+
+    def rotate(self):
+        """
+        Set the current log aside under the next rotation number and start a
+        new one.
+        """
+        self.log.close()
+        self.rotations += 1
+        rotated = self.path + "." + str(self.rotations).zfill(6)
+        os.replace(self.path, rotated)
+        self.log = open(self.path, "ab", buffering=1024 * 1024)
+        self.size = 0
+        self.last_flush = time.monotonic()
+        if self.compressor is not None:
+            self.to_compress.put(rotated)  # Pruned once it's compressed
+        else:
+            self.prune()
+
+    def compress_rotated(self):
+        """
+        The background compression thread: gzip each rotated log in turn.
+        """
+        while True:
+            rotated = self.to_compress.get()
+            if rotated is None:
+                return
+            with open(rotated, "rb") as source, \
+                 gzip.open(rotated + ".gz", "wb") as destination:
+                shutil.copyfileobj(source, destination)
+            os.remove(rotated)
+            self.prune()
+
+    def rotated_logs(self):
+        return glob.glob(glob.escape(self.path) + ".[0-9]*")
+
+    @staticmethod
+    def rotation_number(rotated):
+        return int(rotated.rsplit(".gz", 1)[0].rsplit(".", 1)[1])
+
+    def prune(self):
+        """
+        Delete all but the newest self.keep rotated logs. When compressing,
+        only compressed ones count; the rest are still waiting their turn.
+        """
+        if self.keep <= 0:
+            return
+        rotated = [log for log in self.rotated_logs()
+                   if self.compressor is None or log.endswith(".gz")]
+        rotated.sort(key=self.rotation_number)
+        for old in rotated[:-self.keep]:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.log.close()
+        if self.compressor is not None:
+            self.to_compress.put(None)
+            self.compressor.join()
@@ -0,0 +1,372 @@
+import argparse
+import importlib
+import re
+import sqlite3
+import time
+import traceback
+import capture
+
+# An indexed store of the messages in a --capture, for finding them again
+# without scrolling: by connection, direction, time and size, by protocol
+# fields the final handler pulls out of them (see bytes_to_fields() in
+# handlers/prototype; for ldap, things like the operation, messageID, DN and
+# resultCode), and by full text search over their printable strings.
+#
+# The store is an SQLite database. It doesn't keep the messages themselves,
+# just where they are in the capture, so it stays small and the capture stays
+# the one true record. Build (or catch up) a store from a capture with
+#     python session_store.py index <capture> <store> --handlers ...
+# or have alsanna keep one up to date as it goes with --store <store>, which
+# follows the capture from a process of its own, so forwarding never waits on
+# it. Then search it with
+#     python session_store.py query <store> --field dn=cn=admin,dc=example,dc=com
+#     python session_store.py query <store> --field resultCode=49 --direction server
+#     python session_store.py query <store> --text '"jpegPhoto"' --min_size 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,  -- The record's offset in the capture
+    connection INTEGER NOT NULL,
+    direction INTEGER NOT NULL,  -- capture.CLIENT or SERVER
+    role INTEGER NOT NULL,  -- capture.WATCHED, ORIGINAL, EDITED or UNCHANGED
+    time REAL NOT NULL,  -- Seconds since the capture started
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_connection ON messages (connection, time);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+CREATE INDEX IF NOT EXISTS messages_size ON messages (size);
+CREATE TABLE IF NOT EXISTS fields (
+    name TEXT NOT NULL,
+    value,
+    message INTEGER NOT NULL,
+    PRIMARY KEY (name, value, message)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS fields_message ON fields (message);
+CREATE VIRTUAL TABLE IF NOT EXISTS strings USING fts5(text, content='');
+"""
+
+BATCH = 5000  # Messages per transaction while indexing
+TEXT_BYTES = 64 * 1024  # How much of each message to look for strings in
+STRINGS = re.compile(rb"[\x20-\x7e]{4,}")  # Printable runs, as strings(1) finds
+
+
+class Store():
+    """
+    A session store, tied to the one capture it was built from.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")  # Queries while indexing
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def clear(self):
+        """
+        Forget everything, to start on a new capture.
+        """
+        with self.db:
+            for table in ("meta", "messages", "fields"):
+                self.db.execute("DELETE FROM " + table)
+            # The only way to empty a contentless full text index.
+            self.db.execute("INSERT INTO strings (strings) VALUES ('delete-all')")
+
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?",
+                              (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                        (key, value))
+
+    def attach(self, reader):
+        """
+        Check that this store is for reader's capture (or new), and return
+        the offset in the capture to carry on indexing from.
+        """
+        if self.get("capture_start") is None:
+            with self.db:
+                self.set("capture", reader.path)
+                self.set("capture_start", reader.wall_start)
+                self.set("position", capture.HEADER_SIZE)
+        elif self.get("capture_start") != reader.wall_start:
+            raise ValueError("This store was built from another capture ("
+                             + str(self.get("capture")) + ")")
+        return self.get("position")
+
+    def ingest(self, reader, handler=None, live=False):
+        """
+        Index every message in the capture we haven't yet, BATCH to a
+        transaction. handler is the final handler, for its fields. Returns
+        the number of messages indexed.
+        """
+        position = self.attach(reader)
+        count = 0
+        batch = []
+        for record in reader.messages(position, live):
+            batch.append(record)
+            if len(batch) == BATCH:
+                self.insert(batch, reader, handler)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.insert(batch, reader, handler)
+            count += len(batch)
+        return count
+
+    def insert(self, batch, reader, handler):
+        messages, fields, text = [], [], []
+        for offset, rtype, role, direction, flags, connection, timestamp, payload \
+                in batch:
+            messages.append((offset, connection, direction, role,
+                             (timestamp - reader.monotonic_start) / 1e9,
+                             len(payload)))
+            found = message_fields(payload, flags, handler)
+            fields.extend((name, value, offset) for name, value in found.items())
+            strings = [str(value) for value in found.values()]
+            strings.extend(run.decode("ascii") for run in
+                           STRINGS.findall(payload[:TEXT_BYTES]))
+            if strings:
+                text.append((offset, " ".join(strings)))
+        offset, rtype, role, direction, flags, connection, timestamp, payload = \
+            batch[-1]
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO messages VALUES "
+                                "(?, ?, ?, ?, ?, ?)", messages)
+            self.db.executemany("INSERT OR IGNORE INTO fields VALUES (?, ?, ?)",
+                                fields)
+            self.db.executemany("INSERT INTO strings (rowid, text) VALUES (?, ?)",
+                                text)
+            self.set("position", offset + capture.RECORD.size
+                                 + capture.padded(len(payload)))
+
+    def query(self, connections=None, direction=None, roles=None, after=None,
+              before=None, min_size=None, max_size=None, fields=(), text=None,
+              limit=50, count=False):
+        """
+        Messages matching everything given, as (id, connection, direction,
+        role, time, size, {field: value}) in the order they were recorded, or
+        just how many there are if count. fields is (name, value) pairs.
+        """
+        where, params = [], []
+        if connections:
+            where.append("connection IN (" + ", ".join("?" * len(connections)) + ")")
+            params.extend(connections)
+        if direction is not None:
+            where.append("direction = ?")
+            params.append(direction)
+        if roles:
+            where.append("role IN (" + ", ".join("?" * len(roles)) + ")")
+            params.extend(roles)
+        for column, operator, value in (("time", ">=", after),
+                                        ("time", "<=", before),
+                                        ("size", ">=", min_size),
+                                        ("size", "<=", max_size)):
+            if value is not None:
+                where.append(column + " " + operator + " ?")
+                params.append(value)
+        for name, value in fields:
+            where.append("id IN (SELECT message FROM fields "
+                         "WHERE name = ? AND value = ?)")
+            params.extend((name, value))
+        if text is not None:
+            where.append("id IN (SELECT rowid FROM strings WHERE strings MATCH ?)")
+            params.append(text)
+        condition = (" WHERE " + " AND ".join(where)) if where else ""
+        if count:
+            return self.db.execute("SELECT count(*) FROM messages" + condition,
+                                   params).fetchone()[0]
+        rows = self.db.execute("SELECT * FROM messages" + condition
+                               + " ORDER BY id LIMIT ?",
+                               params + [limit]).fetchall()
+        found = {row[0]: {} for row in rows}
+        if found:
+            for name, value, message in self.db.execute(
+                    "SELECT name, value, message FROM fields WHERE message IN ("
+                    + ", ".join("?" * len(found)) + ")", list(found)):
+                found[message][name] = value
+        return [row + (found[row[0]],) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def message_fields(payload, flags, handler):
+    """
+    The protocol fields of one message, from the final handler if it can say,
+    or nothing if it can't (or the message isn't what it expects).
+    """
+    if handler is None or not hasattr(handler, "bytes_to_fields") \
+       or flags & capture.NOT_WIRE or not payload:
+        return {}
+    try:
+        return handler.bytes_to_fields(payload)
+    except Exception:  # Whatever it was, it isn't indexable
+        return {}
+
+
+def follow(capture_path, store_path, handler, display_q, interval=0.5):
+    """
+    Keep store_path up to date with a capture alsanna's still writing, every
+    interval seconds. Run in its own process by alsanna.main() for --store.
+    The capture's started afresh, so the store is too.
+    """
+    try:
+        reader = capture.Reader(capture_path)
+        store = Store(store_path)
+        store.clear()
+        while True:
+            reader.refresh()
+            store.ingest(reader, handler, live=True)
+            time.sleep(interval)
+    except:
+        display_q.put(("Err", ("Session store stopped indexing.",
+                               traceback.format_exc())
+                        ))
+
+
+def parse_field(field):
+    """
+    NAME=VALUE from the command line, with VALUE an int if it looks like one
+    (fields like LDAP's messageID and resultCode are stored as numbers).
+    """
+    name, equals, value = field.partition("=")
+    if not equals:
+        raise argparse.ArgumentTypeError("fields are given as NAME=VALUE")
+    try:
+        return name, int(value)
+    except ValueError:
+        return name, value
+
+
+def print_results(store, rows, show):
+    reader = None
+    if show:
+        reader = capture.Reader(store.get("capture"))
+    for message_id, connection, direction, role, seconds, size, fields in rows:
+        print("{0:.6f} {1}{2} {3} {4} bytes{5}".format(
+              seconds, connection,
+              "server" if direction == capture.SERVER else "client",
+              capture.ROLES[role], size,
+              "".join(" " + name + "=" + str(value)
+                      for name, value in sorted(fields.items()))))
+        if reader is not None:
+            start = message_id + capture.RECORD.size
+            print("    " + repr(reader.map[start:start + min(size, 256)]))
+    if reader is not None:
+        reader.close()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(allow_abbrev=False, add_help=False,
+                                         conflict_handler='resolve')
+    arg_parser.add_argument(
+        "command", choices=["index", "query"],
+        help="index a capture into a store, or query a store."
+    )
+    arg_parser.add_argument(
+        "paths", type=str, nargs="+",
+        help="For index, the capture and the store to build or catch up. For "
+             "query, the store."
+    )
+    arg_parser.add_argument(
+        "--handlers", type=str, nargs="+", default=["tls", "rawbytes"],
+        help="For index, the handlers the capture was made with. The last one "
+             "decides which protocol fields are indexed."
+    )
+    arg_parser.add_argument(
+        "--connections", type=int, nargs="+", default=None,
+        help="Only messages from these connections."
+    )
+    arg_parser.add_argument(
+        "--direction", choices=["client", "server"], default=None,
+        help="Only messages sent by the client, or by the server."
+    )
+    arg_parser.add_argument(
+        "--roles", choices=capture.ROLES, nargs="+", default=None,
+        help="Only messages recorded in these roles (see capture.py)."
+    )
+    arg_parser.add_argument(
+        "--after", type=float, default=None,
+        help="Only messages recorded at least this many seconds into the capture."
+    )
+    arg_parser.add_argument(
+        "--before", type=float, default=None,
+        help="Only messages recorded at most this many seconds into the capture."
+    )
+    arg_parser.add_argument(
+        "--min_size", type=int, default=None,
+        help="Only messages of at least this many bytes."
+    )
+    arg_parser.add_argument(
+        "--max_size", type=int, default=None,
+        help="Only messages of at most this many bytes."
+    )
+    arg_parser.add_argument(
+        "--field", type=parse_field, action="append", default=[],
+        help="Only messages whose protocol field NAME is VALUE, given as "
+             "NAME=VALUE. Can be given more than once."
+    )
+    arg_parser.add_argument(
+        "--text", type=str, default=None,
+        help="Only messages matching this SQLite FTS5 query over their fields "
+             "and printable strings, e.g. 'admin' or '\"cn admin\"'."
+    )
+    arg_parser.add_argument(
+        "--limit", type=int, default=50,
+        help="Most messages to list."
+    )
+    arg_parser.add_argument(
+        "--count", action="store_true",
+        help="Just say how many messages match."
+    )
+    arg_parser.add_argument(
+        "--show", action="store_true",
+        help="Show the start of each message, read from the capture."
+    )
+    args, remaining_args = arg_parser.parse_known_args()
+
+    if args.command == "index":
+        if len(args.paths) != 2:
+            arg_parser.error("index needs a capture and a store.")
+        # Build the handler chain as alsanna does, for its options.
+        for i in range(len(args.handlers)):
+            final = True if i == len(args.handlers)-1 else False
+            handler_module = importlib.import_module('handlers.' + args.handlers[i])
+            args.handlers[i] = handler_module.Handler(arg_parser, final)
+            arg_parser = args.handlers[i].arg_parser
+            if i > 0 and hasattr(args.handlers[i], "set_previous"):
+                args.handlers[i].set_previous(args.handlers[i-1])
+        reader = capture.Reader(args.paths[0])
+        store = Store(args.paths[1])
+        start = time.perf_counter()
+        try:
+            indexed = store.ingest(reader, args.handlers[-1])
+        except ValueError as e:
+            arg_parser.error(str(e))
+        print("Indexed {0} messages in {1:.2f} s".format(
+              indexed, time.perf_counter() - start))
+    else:
+        if len(args.paths) != 1:
+            arg_parser.error("query needs just a store.")
+        arg_parser = argparse.ArgumentParser(parents=[arg_parser])
+        arg_parser.parse_args()  # Complain about anything we don't know
+        store = Store(args.paths[0])
+        start = time.perf_counter()
+        result = store.query(
+            connections=args.connections,
+            direction=None if args.direction is None
+                      else ["client", "server"].index(args.direction),
+            roles=None if args.roles is None
+                  else [capture.ROLES.index(role) for role in args.roles],
+            after=args.after, before=args.before, min_size=args.min_size,
+            max_size=args.max_size, fields=args.field, text=args.text,
+            limit=args.limit, count=args.count)
+        elapsed = time.perf_counter() - start
+        if args.count:
+            print(result)
+        else:
+            print_results(store, result, args.show)
+        print("({0:.1f} ms)".format(elapsed * 1000))
+    store.close()
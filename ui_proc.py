@@ -1,7 +1,15 @@
 import signal, threading
+import collections
 import os
+import queue
 import traceback
 
+# Most messages to take off display_q before writing them to the terminal.
+MAX_BATCH = 1000
+# Most lines of output to hold back while the editor has the terminal. Past
+# this, output is dropped (and counted) rather than piling up.
+MAX_HELD = 10000
+
 def user_interface(display_q, args):
     """
     Define the process that runs the user interface. This process will:
@@ -10,12 +18,22 @@ def user_interface(display_q, args):
         * Return messages back to their originating connections
         * Print status information such as error messages
     Putting all this in a single process eliminates the worst concurrency
-    headaches we might otherwise run into.
+    headaches we might otherwise run into. Intercepted messages wait in lanes
+    (see EditLanes) for a separate editor thread, so while the user is busy
+    editing one message, everything else is still sent straight back to its
+    connection.
+
+    With --headless, none of that happens; see headless_interface() instead.
 
     display_q is the queue which all other processes will use to communicate
     with this process.
     """
+    if args.headless:
+        headless_interface(display_q, args)
+        return
+
     import ui_utils
+    ui_utils.init_terminal()
 
     # This is here so you know about it. SIGINT (so ctrl+c) and SIGTERM will,
     # instead of their normal behavior, repair the terminal and then kill
@@ -26,8 +44,7 @@ def user_interface(display_q, args):
     # This is also here so you know about it. There is a separate thread running
     # that checks for keystrokes and updates the intercept dict as needed.
     ui_locals = {}
-    ui_locals["intercept"] = {"client": not args.pass_client,
-                              "server": args.intercept_server,
+    ui_locals["intercept"] = {"hosts": args.intercept,  # Shared with connections
                               "i_c_key": args.intercept_client_keypress,
                               "i_s_key": args.intercept_server_keypress,
                               "lock": threading.Lock()}
@@ -40,62 +57,312 @@ def user_interface(display_q, args):
     ui_utils.enable_toggles()
     toggle_catcher.start()
 
+    # Output is held back while the editor has the terminal (see show()).
+    terminal = {"lock": threading.Lock(),
+                "editing": False,
+                "held": ui_utils.Frame(batch=True),
+                "dropped": 0}
     forwarding_queues = {}
+    lanes = EditLanes()
+    editor = threading.Thread(target=edit_intercepted,
+                              kwargs={"lanes": lanes,
+                                      "forwarding_queues": forwarding_queues,
+                                      "ui_locals": ui_locals,
+                                      "terminal": terminal,
+                                      "args": args},
+                              daemon=True)
+    editor.start()
+
     while True:
         # If orphaned, reset terminal and die
         if os.getppid() == 1:
             ui_utils.disable_toggles()
             return
 
-        # Get a message
+        # Wait for a message, then take every other message that's already
+        # waiting too, so they can all be written to the terminal at once.
+        frame = ui_utils.Frame(batch=True)
         try:
-            connection_id, message = display_q.get()
+            batch = get_batch(display_q)
         except:
+            batch = []
             ui_utils.print_ui(message=("Failed to get message",
                                        traceback.format_exc()),
-                              color=args.error_color)
-            continue
-
-        # Act on special messages
-        if connection_id == "Err":
-            ui_utils.print_ui(message=message, color=args.error_color)
-            continue
-        if connection_id == "Note":
-            ui_utils.print_ui(message=message, color=args.notification_color)
-            continue
-        if connection_id == "Kill":
-            del forwarding_queues[message]  # Destroy reference to dead queue.
-            continue
-        if connection_id not in forwarding_queues.keys():  # Register new queue
-            forwarding_queues[connection_id] = message  # "message" is Queue object
-            continue
-
-        # Colorize text and choose whether to intercept for editing
-        with ui_locals["intercept"]["lock"]:
-            if connection_id[-6:] == "client":
-                intercept = ui_locals["intercept"]["client"]
-                color = args.client_color
-            elif connection_id[-6:] == "server":
-                intercept = ui_locals["intercept"]["server"]
-                color = args.server_color
-            else:  # If this ever happens it's a bug
-                intercept = False
-                color = 8
+                              color=args.error_color, frame=frame)
 
         try:
+            for connection_id, message in batch:
+                display(connection_id, message, forwarding_queues, lanes,
+                        ui_locals, frame, args)
+        finally:
+            show(frame, terminal, args)
+
+
+def get_batch(display_q, timeout=None):
+    """
+    Wait for a message on display_q (raising queue.Empty if timeout seconds go
+    by without one), then take up to MAX_BATCH - 1 more if they're already
+    waiting. Returns a list of messages.
+    """
+    batch = [display_q.get(timeout=timeout)]
+    try:
+        try:
+            # A blocking get() is much cheaper than get_nowait(), which has to
+            # poll the pipe first, so ask how many are waiting up front.
+            waiting = display_q.qsize()
+        except NotImplementedError:  # macOS can't count them
+            while len(batch) < MAX_BATCH:
+                batch.append(display_q.get_nowait())
+            return batch
+        for i in range(min(waiting, MAX_BATCH - 1)):
+            batch.append(display_q.get())
+    except queue.Empty:
+        pass
+    return batch
+
+
+def headless_interface(display_q, args):
+    """
+    The user interface for --headless: no terminal, no keystrokes and no
+    editor, just a record of everything in the session log (see
+    session_log.py). Connections never wait on us, since alsanna.main() turns
+    interception off, but if anything does, it gets its message straight back.
+    """
+    import session_log
+
+    log = session_log.SessionLog(args.session_log,
+                                 max_bytes=args.session_log_size * 1024 * 1024,
+                                 keep=args.session_log_keep,
+                                 flush_interval=args.session_log_flush,
+                                 compress=args.session_log_compress)
+
+    def stop(*args):
+        raise SystemExit()
+    signal.signal(signal.SIGINT, stop)  # Write out what's buffered, then exit
+    signal.signal(signal.SIGTERM, stop)
+
+    forwarding_queues = {}
+    try:
+        while True:
+            if os.getppid() == 1:  # If orphaned, die
+                return
             try:
-                message = ui_utils.print_and_edit(message=message,
-                                                  intercept=intercept,
-                                                  color=color,
-                                                  editor=args.editor)
-            except:
-                ui_utils.print_ui(message=("Error in printing/editing.",
-                                           traceback.format_exc()),
-                                  color=args.error_color)
-                break
+                batch = get_batch(display_q, timeout=args.session_log_flush)
+            except queue.Empty:
+                log.flush_if_due()
+                continue
+            except Exception:  # Not SystemExit, that's stop()
+                log.record("error", message="Failed to get message\n"
+                                            + traceback.format_exc())
+                continue
+            for connection_id, message in batch:
+                log_message(log, connection_id, message, forwarding_queues, args)
+    finally:
+        log.close()
+
+
+def log_message(log, connection_id, message, forwarding_queues, args):
+    """
+    The headless equivalent of display(): record one message from display_q.
+    """
+    if connection_id == "View":  # The usual case, so check for it first
+        args.display_ring.release()
+        log.record(message.kind, connection_id=message.connection_id[:-6],
+                   direction=message.connection_id[-6:],
+                   message=message.readable, size=message.size,
+                   timestamp=message.timestamp)
+    elif connection_id in ("Err", "Note"):
+        if type(message) is tuple:
+            message = message[0] + "\n" + message[1]
+        log.record("error" if connection_id == "Err" else "note",
+                   message=message)
+    elif connection_id == "Kill":
+        forget(message, forwarding_queues)
+    elif connection_id not in forwarding_queues.keys():
+        forwarding_queues[connection_id] = message
+    else:
+        try:
+            message = forwarding_queues[connection_id].unwrap(message)
+        except FileNotFoundError:
+            return  # The connection's already gone, and its memory with it
+        log.record("message", connection_id=connection_id[:-6],
+                   direction=connection_id[-6:], message=message)
+        reply(connection_id, None, forwarding_queues)  # Unchanged
+
+
+def display(connection_id, message, forwarding_queues, lanes, ui_locals, frame,
+            args):
+    """
+    Act on one message from display_q: print it to frame and send it back to its
+    connection if it's waiting on it, or leave it in lanes for the editor
+    thread if it's intercepted.
+    """
+    import ui_utils
+
+    # Act on special messages
+    if connection_id == "Err":
+        ui_utils.print_ui(message=message, color=args.error_color, frame=frame)
+        return
+    if connection_id == "Note":
+        ui_utils.print_ui(message=message, color=args.notification_color,
+                          frame=frame)
+        return
+    if connection_id == "Kill":
+        lanes.drop(message)  # Nobody left to edit for
+        forget(message, forwarding_queues)
+        return
+    view_only = connection_id == "View"  # Already forwarded, just print it
+    if view_only:
+        args.display_ring.release()  # Room for the next one
+        connection_id, message, skipped = message[:3]
+        if skipped:
+            ui_utils.print_ui(message="[" + str(skipped) + " messages from "
+                                      + connection_id + " not displayed to "
+                                      "keep up]",
+                              color=args.notification_color, frame=frame)
+    elif connection_id not in forwarding_queues.keys():  # Register new queue
+        forwarding_queues[connection_id] = message  # "message" is a ResultChannel
+        return
+    else:  # Read it out of shared memory, if that's how it came
+        try:
+            message = forwarding_queues[connection_id].unwrap(message)
+        except FileNotFoundError:
+            return  # The connection's already gone, and its memory with it
+
+    intercept, color = classify(connection_id, ui_locals, args)
+    if intercept and not view_only:
+        lanes.put(connection_id, message)  # The editor thread takes it from here
+        return
+
+    ui_utils.print_and_edit(message=message, intercept=False, color=color,
+                            editor=args.editor, frame=frame)
+    if not view_only:
+        reply(connection_id, None, forwarding_queues)  # Unchanged
+
 
+def classify(connection_id, ui_locals, args):
+    """
+    Colorize text and choose whether to intercept for editing. Returns whether
+    to intercept and the color to print in.
+    """
+    with ui_locals["intercept"]["lock"]:
+        if connection_id[-6:] == "client":
+            intercept = ui_locals["intercept"]["hosts"]["client"]
+            color = args.client_color
+        elif connection_id[-6:] == "server":
+            intercept = ui_locals["intercept"]["hosts"]["server"]
+            color = args.server_color
+        else:  # If this ever happens it's a bug
+            intercept = False
+            color = 8
+    return intercept, color
+
+
+def reply(connection_id, message, forwarding_queues):
+    """
+    Send a message back to the connection waiting on it. message is None if it
+    wasn't changed, so the connection can send what it had as-is instead of
+    converting the printable form back (which can be most of the work of an
+    intercepted message that nobody edits), and we don't send it all back.
+    """
+    try:
+        channel = forwarding_queues[connection_id]
+        channel.put(channel.wrap(message))
+    except:
+        pass  # If a subprocess died and its queue is gone, continue
+
+
+def forget(connection_id, forwarding_queues):
+    """
+    Let go of a finished connection's channel.
+    """
+    channel = forwarding_queues.pop(connection_id, None)
+    if channel is not None:
+        channel.close()
+
+
+def show(frame, terminal, args):
+    """
+    Write frame to the terminal, unless the editor has it, in which case hold
+    the output back until the editor's done.
+    """
+    with terminal["lock"]:
+        if not terminal["editing"]:
+            frame.flush()
+        elif len(terminal["held"]) < MAX_HELD:
+            terminal["held"].extend(frame)
+        else:
+            terminal["dropped"] += len(frame)
+
+
+def edit_intercepted(lanes, forwarding_queues, ui_locals, terminal, args):
+    """
+    The editor thread. Works through intercepted messages one at a time,
+    opening each in the editor and sending the result back to its connection.
+    """
+    import ui_utils
+
+    while True:
+        connection_id, message = lanes.get()
+        intercept, color = classify(connection_id, ui_locals, args)
+        with terminal["lock"]:
+            terminal["editing"] = intercept  # Interception may be off by now
+        edited = message
+        try:
+            edited = ui_utils.print_and_edit(message=message,
+                                             intercept=intercept,
+                                             color=color,
+                                             editor=args.editor,
+                                             title=connection_id)
+        except:
+            ui_utils.print_ui(message=("Error in printing/editing.",
+                                       traceback.format_exc()),
+                              color=args.error_color)
         finally:
-            try:
-                forwarding_queues[connection_id].put(message)
-            except:
-                pass  # If a subprocess died and its queue is gone, continue
+            reply(connection_id, None if edited == message else edited,
+                  forwarding_queues)
+            with terminal["lock"]:
+                terminal["editing"] = False
+                if terminal["dropped"]:
+                    ui_utils.print_ui(message="[" + str(terminal["dropped"])
+                                              + " lines not displayed while "
+                                              "editing]",
+                                      color=args.notification_color,
+                                      frame=terminal["held"])
+                    terminal["dropped"] = 0
+                terminal["held"].flush()
+
+
+class EditLanes():
+    """
+    Intercepted messages waiting for the editor thread, in a lane for each
+    connection and direction. The editor takes turns between lanes, oldest
+    first, so one busy connection can't keep the others waiting.
+    """
+    def __init__(self):
+        self.lanes = collections.OrderedDict()
+        self.ready = threading.Condition()
+
+    def put(self, connection_id, message):
+        with self.ready:
+            self.lanes.setdefault(connection_id, collections.deque()).append(message)
+            self.ready.notify()
+
+    def get(self):
+        """
+        Wait for a message to edit, returning it with its connection_id.
+        """
+        with self.ready:
+            while not self.lanes:
+                self.ready.wait()
+            connection_id, lane = next(iter(self.lanes.items()))
+            message = lane.popleft()
+            if lane:
+                self.lanes.move_to_end(connection_id)  # Back of the line
+            else:
+                del self.lanes[connection_id]
+            return connection_id, message
+
+    def drop(self, connection_id):
+        with self.ready:
+            self.lanes.pop(connection_id, None)
@@ -1,60 +1,86 @@
-import fcntl, termios
+import termios
+import select
 import signal
 import threading, subprocess
 import copy
 import os, sys
 import tempfile
-import time
 
-# This gets executed just by importing the module, which is convenient for
-# ensuring it only runs once and gets the initial state of things, but might be
-# unexpected if you're expecting alsanna to be a proper python module.
 stdin_lock = threading.RLock()
-stdin = open(0)
-
-# Store the original settings of stdin for use whenever we restore them
-stdin_attrs = termios.tcgetattr(stdin.fileno())
-stdin_flags = fcntl.fcntl(stdin.fileno(), fcntl.F_GETFL)
+stdin = None  # Set up by init_terminal(), unless we're headless
+stdin_attrs = None
+
+def init_terminal():
+    """
+    Take over the terminal on stdin. Called once, by the user interface process,
+    before anything else in here that touches the terminal.
+    """
+    global stdin, stdin_attrs
+    stdin = open(0)
+    # Store the original settings of stdin for use whenever we restore them
+    stdin_attrs = termios.tcgetattr(stdin.fileno())
 
 ###############################################################################
 # print_and_edit() and handle_toggles() are the functions you're likeliest to
 # edit, if you want to modify what alsanna does with messages or you want to
 # add or modify what different keystrokes do.
 ###############################################################################
-def print_and_edit(message, intercept, color, editor):
-    colorful = "\033[38;5;" + str(color) + "m" + message + "\033[0m"
-    disable_toggles()  # Turn off keystroke toggles for editing
-    print(colorful)  # Print received message
+def print_and_edit(message, intercept, color, editor, frame=None, title=""):
+    """
+    Print a message and, if intercept, open it in an editor, returning the
+    (possibly edited) message. If frame is given, printing is left to the frame
+    unless the editor needs the terminal. editor "builtin" is the editor in
+    builtin_editor.py, which shows title on its status line.
+    """
+    if frame is None:
+        frame = Frame()
+    frame.add(message, color)
 
     # Open the message in an editor if required
     if intercept:
-        with tempfile.NamedTemporaryFile(mode="w+") as tmpfile:
-            tmpfile.write(str(message))
-            tmpfile.flush()
-            subprocess.call([editor, tmpfile.name])
-            tmpfile.seek(0)
-            message = tmpfile.read()
-
-    enable_toggles()
+        frame.flush()  # Everything before this message has to be shown first
+        disable_toggles()  # Turn off keystroke toggles for editing
+        try:
+            if editor == "builtin":
+                import builtin_editor
+                message = builtin_editor.edit(str(message), title)
+            else:
+                with tempfile.NamedTemporaryFile(mode="w+") as tmpfile:
+                    tmpfile.write(str(message))
+                    tmpfile.flush()
+                    subprocess.call([editor, tmpfile.name])
+                    tmpfile.seek(0)
+                    message = tmpfile.read()
+        finally:
+            enable_toggles()
+    frame.flush_if_unbatched()
     return message
 
 def handle_toggles(ui_locals, stdin_lock, stdin, display_q):
     while True:
         try:
+            # Sleep until a key is pressed. While an editor has the terminal we
+            # can be woken by keys meant for it, in which case we wait on the
+            # lock until the editor's done and find they've already been read.
+            select.select([stdin], [], [])
             with stdin_lock:
-                c = stdin.read(1)
-                time.sleep(1/1000000) # Sleep a bit to reduce CPU stress; can't use blocking stdin because we need the lock :(
-            if c:
+                if not select.select([stdin], [], [], 0)[0]:
+                    continue
+                keys = os.read(stdin.fileno(), 32).decode(errors="replace")
+            if not keys:  # stdin closed, so there will never be any keys
+                return
+            for c in keys:
+                intercepting = ui_locals["intercept"]["hosts"]
                 if c == ui_locals["intercept"]["i_c_key"]:
                     with ui_locals["intercept"]["lock"]:
-                        ui_locals["intercept"]["client"] = not ui_locals["intercept"]["client"]
+                        intercepting["client"] = not intercepting["client"]
                 elif c == ui_locals["intercept"]["i_s_key"]:
                     with ui_locals["intercept"]["lock"]:
-                        ui_locals["intercept"]["server"] = not ui_locals["intercept"]["server"]
+                        intercepting["server"] = not intercepting["server"]
                 hosts = []
-                if ui_locals["intercept"]["client"]:
+                if intercepting["client"]:
                     hosts.append("client")
-                if ui_locals["intercept"]["server"]:
+                if intercepting["server"]:
                     hosts.append("server")
 
                 display_q.put(("Note", "Currently intercepting messages from "
@@ -66,14 +92,64 @@ def handle_toggles(ui_locals, stdin_lock, stdin, display_q):
 # Utility functions for printing and setting terminal flags
 ################################################################################
 
-def print_ui(message, color):
-    try:
-        disable_toggles()
-        if type(message) is tuple:
-            message = message[0] + "\n" + indent(message[1]) + "\n"
-        print("\033[38;5;" + str(color) + "m" + message + "\033[0m", file=sys.stderr)
-    finally:
-        enable_toggles()
+def print_ui(message, color, frame=None):
+    if type(message) is tuple:
+        message = message[0] + "\n" + indent(message[1]) + "\n"
+    if frame is None:
+        frame = Frame()
+    frame.add(message, color, stream=sys.stderr)
+    frame.flush_if_unbatched()
+
+
+class Frame():
+    """
+    Colorized text waiting to go to the terminal. The user interface collects
+    everything it has to print from one batch of messages into a frame and
+    writes it out in one go, rather than a print() (and a flush) apiece.
+    Printing doesn't care what mode the terminal's in, so this never touches
+    terminal settings; only the editor needs that.
+
+    A Frame() made without batch=True is written out as soon as anything's
+    added, which is how print_ui() and print_and_edit() behave if they aren't
+    given a frame.
+    """
+    def __init__(self, batch=False):
+        self.batch = batch
+        self.blocks = []  # [stream, [text, ...]] for each run of one stream
+
+    def add(self, message, color, stream=None):
+        stream = sys.stdout if stream is None else stream
+        if not self.blocks or self.blocks[-1][0] is not stream:
+            self.blocks.append([stream, []])
+        self.blocks[-1][1].append("\033[38;5;" + str(color) + "m" + message
+                                  + "\033[0m\n")
+
+    def __len__(self):
+        return sum(len(chunks) for stream, chunks in self.blocks)
+
+    def extend(self, frame):
+        """
+        Add everything waiting in another frame to this one.
+        """
+        for stream, chunks in frame.blocks:
+            if not self.blocks or self.blocks[-1][0] is not stream:
+                self.blocks.append([stream, []])
+            self.blocks[-1][1].extend(chunks)
+        frame.blocks = []
+
+    def flush_if_unbatched(self):
+        if not self.batch:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out everything added so far, a block at a time, keeping the order
+        of text going to stdout and stderr.
+        """
+        for stream, chunks in self.blocks:
+            stream.write("".join(chunks))
+            stream.flush()
+        self.blocks = []
 
 
 def indent(string):
@@ -85,17 +161,11 @@ def indent(string):
 # Utility functions for catching keystrokes. You shouldn't need to mess with
 # these to handle protocols.
 def enable_toggles():
-    # Disable canonical mode and echo
+    # Disable canonical mode and echo. Keys are only read when select() says
+    # there's one waiting, so stdin can stay blocking.
     new_attrs = copy.deepcopy(stdin_attrs)
     new_attrs[3] = new_attrs[3] & ~termios.ICANON & ~termios.ECHO
-    while termios.tcgetattr(stdin.fileno())[3] != new_attrs[3]:
-        termios.tcsetattr(stdin.fileno(), termios.TCSAFLUSH, new_attrs)
-
-    # Set stdin to nonblocking so the thread never blocks waiting for input
-    new_flags = copy.deepcopy(stdin_flags)
-    new_flags = new_flags | os.O_NONBLOCK
-    while fcntl.fcntl(stdin.fileno(), fcntl.F_GETFL) != new_flags:
-        fcntl.fcntl(stdin.fileno(), fcntl.F_SETFL, new_flags)
+    termios.tcsetattr(stdin.fileno(), termios.TCSAFLUSH, new_attrs)
     # The lock might have been acquired once or twice, so just keep releasing
     # until we're sure it's free.
     while True:
@@ -106,16 +176,24 @@ def enable_toggles():
 
 def disable_toggles():
     stdin_lock.acquire()
-    while termios.tcgetattr(stdin.fileno())[3] != stdin_attrs[3]:
-        termios.tcsetattr(stdin.fileno(), termios.TCSAFLUSH, stdin_attrs)
-    while fcntl.fcntl(stdin.fileno(), fcntl.F_GETFL) != stdin_flags:
-        fcntl.fcntl(stdin.fileno(), fcntl.F_SETFL, stdin_flags)
+    termios.tcsetattr(stdin.fileno(), termios.TCSAFLUSH, stdin_attrs)
     # Deliberately do not release the lock - this stops handle_toggles()
     # from acquiring the lock, and therefore from reading anything, until
     # after we finish editing requests.
 
 def abort(*args):
-    disable_toggles()
+    # Put the terminal back without disable_toggles(): the editor thread holds
+    # stdin_lock for as long as an edit lasts, and this runs on the main thread
+    # as a signal handler, so waiting on the lock would never end.
+    if stdin is not None:
+        curses = sys.modules.get("curses")  # Only if builtin_editor's used it
+        if curses is not None:
+            try:
+                if not curses.isendwin():
+                    curses.endwin()
+            except curses.error:  # Never initialized
+                pass
+        termios.tcsetattr(stdin.fileno(), termios.TCSAFLUSH, stdin_attrs)
     # Die without raising confusing error messages for alsanna internals.
     pid = os.getpid()
     os.kill(pid, signal.SIGKILL)
@@ -0,0 +1,69 @@
+import os
+import socket
+import threading, multiprocessing
+import time
+import cnxn_proc, async_engine
+
+def worker(l_sock, display_q, cnxn_counter, args):
+    """
+    A pre-started process which accepts connections from a listener it shares
+    with its sibling workers, and services each one in a pair of threads
+    instead of a process of its own. With --engine asyncio, the worker runs its
+    own event loop over the shared listener instead.
+
+    l_sock is the listening socket, inherited from alsanna's parent process.
+
+    display_q is the global queue the user interface reads from.
+
+    cnxn_counter is a shared counter used to hand out connection ids which are
+    unique across every worker.
+    """
+    if args.engine == "asyncio":
+        async_engine.serve(l_sock, display_q, cnxn_counter, args)
+        return
+
+    # Wake up every so often to check whether we've been orphaned.
+    l_sock.settimeout(1)
+    while True:
+        if os.getppid() == 1:  # If orphaned, die; connection threads are daemons
+            return
+        try:
+            listen_sock, addr = l_sock.accept()
+        except socket.timeout:
+            continue
+        listen_sock.settimeout(None)  # Handlers expect blocking sockets
+        connection_id = cnxn_proc.next_connection_id(cnxn_counter)
+        threading.Thread(target=cnxn_proc.manage_connections,
+                         args=(listen_sock,
+                               display_q,
+                               connection_id,
+                               args),
+                         daemon=True).start()
+
+
+def run_pool(l_socks, display_q, cnxn_counter, args):
+    """
+    Start args.workers workers (at least one) for each listening socket in
+    l_socks, then babysit them for the life of alsanna, replacing any worker
+    that dies. Each worker only ever accepts from its own listener, so with
+    several SO_REUSEPORT listeners (--listener_shards) the kernel decides which
+    group of workers gets each connection.
+    """
+    listeners = [l_sock for l_sock in l_socks for i in range(max(args.workers, 1))]
+    workers = [None] * len(listeners)
+    while True:
+        for i in range(len(workers)):
+            if workers[i] is not None and workers[i].is_alive():
+                continue
+            if workers[i] is not None:  # Reap the dead worker before replacing it
+                workers[i].join()
+                display_q.put(("Err", "Worker " + str(i) + " died with exit code "
+                                      + str(workers[i].exitcode) + ", restarting."))
+            workers[i] = multiprocessing.Process(target=worker,
+                                                 args=(listeners[i],
+                                                       display_q,
+                                                       cnxn_counter,
+                                                       args),
+                                                 daemon=True)
+            workers[i].start()
+        time.sleep(1)